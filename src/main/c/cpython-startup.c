@@ -31,6 +31,235 @@
 
 #include "org_scijava_plugins_scripting_cpython_CPythonStartup.h"
 #include <python.h>
+#include <marshal.h>
+#include <stdint.h>
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <time.h>
+#endif
+
+#if PY_MAJOR_VERSION >= 3
+#define CODE_OBJECT(o) (o)
+#else
+#include <code.h>
+#define CODE_OBJECT(o) ((PyCodeObject *)(o))
+#endif
+
+/*
+ * The _scijava_cpython module gives the Python side JNI local reference
+ * frames. The engine threads are attached to Java once and never return
+ * to it, so a local reference that the bridge does not delete would live
+ * as long as the thread; handling each request inside a frame bounds
+ * them. The counters are guarded by the GIL.
+ */
+static JavaVM *jvm = NULL;
+static PY_LONG_LONG frames_pushed = 0, frames_popped = 0;
+
+/*
+ * The Python function that handles requests made by Java code running on
+ * an engine thread, which can't go through the engine's queue because
+ * the engine is waiting for that Java code. See CPythonStartup.call().
+ */
+static PyObject *call_handler = NULL;
+
+/*
+ * The native request channel: an engine thread takes its requests from
+ * CPythonEngineWorker.takeRequest() without the GIL, and only takes the
+ * GIL back once there is a request to handle. The class and method are
+ * looked up when Python is started from Java, so with the plugin's class
+ * loader rather than the system class loader that FindClass() would use
+ * on an engine thread.
+ */
+static jclass worker_class = NULL;
+static jmethodID take_request_method = NULL;
+
+/*
+ * The JNI environment of the CPythonStartup.runCompiled() call that is
+ * running the scripting-cpython script, or NULL. While it runs, FindClass()
+ * uses the plugin's class loader, so the script looks up the plugin's
+ * classes then, for all of the threads.
+ */
+static JNIEnv *script_env = NULL;
+
+static PY_LONG_LONG nano_time(void)
+{
+#ifdef _WIN32
+	LARGE_INTEGER count, frequency;
+
+	QueryPerformanceCounter(&count);
+	QueryPerformanceFrequency(&frequency);
+	return (PY_LONG_LONG)(count.QuadPart * (1e9 / frequency.QuadPart));
+#else
+	struct timespec t;
+
+	clock_gettime(CLOCK_MONOTONIC, &t);
+	return (PY_LONG_LONG)t.tv_sec * 1000000000 + t.tv_nsec;
+#endif
+}
+
+static JNIEnv *get_thread_env(void)
+{
+	JNIEnv *env = NULL;
+
+	if (!jvm || (*jvm)->GetEnv(jvm, (void **)&env, JNI_VERSION_1_6) != JNI_OK) {
+		PyErr_SetString(PyExc_RuntimeError, "The thread is not attached to Java");
+		return NULL;
+	}
+	return env;
+}
+
+static PyObject *push_local_frame(PyObject *self, PyObject *args)
+{
+	int capacity;
+	JNIEnv *env;
+
+	if (!PyArg_ParseTuple(args, "i", &capacity)) return NULL;
+	env = get_thread_env();
+	if (!env) return NULL;
+	if ((*env)->PushLocalFrame(env, capacity) < 0) {
+		(*env)->ExceptionClear(env);
+		return PyErr_NoMemory();
+	}
+	frames_pushed++;
+	Py_RETURN_NONE;
+}
+
+static PyObject *pop_local_frame(PyObject *self, PyObject *unused)
+{
+	JNIEnv *env = get_thread_env();
+
+	if (!env) return NULL;
+	(*env)->PopLocalFrame(env, NULL);
+	frames_popped++;
+	Py_RETURN_NONE;
+}
+
+static PyObject *frame_counts(PyObject *self, PyObject *unused)
+{
+	return Py_BuildValue("(LL)", frames_pushed, frames_popped);
+}
+
+static PyObject *set_call_handler(PyObject *self, PyObject *handler)
+{
+	Py_INCREF(handler);
+	Py_XDECREF(call_handler);
+	call_handler = handler;
+	Py_RETURN_NONE;
+}
+
+static PyObject *request_channel_ready(PyObject *self, PyObject *unused)
+{
+	return PyBool_FromLong(take_request_method != NULL);
+}
+
+/*
+ * Returns the request, a local reference in a capsule, and the time it
+ * took to get the GIL back after the request came.
+ */
+static PyObject *take_request(PyObject *self, PyObject *unused)
+{
+	JNIEnv *env = get_thread_env();
+	PyThreadState *state;
+	jobject request;
+	PY_LONG_LONG taken;
+	PyObject *capsule;
+
+	if (!env) return NULL;
+	if (!take_request_method) {
+		PyErr_SetString(PyExc_RuntimeError, "The request channel is not set up");
+		return NULL;
+	}
+	state = PyEval_SaveThread();
+	request = (*env)->CallStaticObjectMethod(env, worker_class, take_request_method);
+	taken = nano_time();
+	PyEval_RestoreThread(state);
+	taken = nano_time() - taken;
+	if (!request) {
+		(*env)->ExceptionClear(env);
+		PyErr_SetString(PyExc_RuntimeError, "Interrupted while taking a request");
+		return NULL;
+	}
+	capsule = PyCapsule_New((void *)request, NULL, NULL);
+	if (!capsule) return NULL;
+	return Py_BuildValue("(NL)", capsule, taken);
+}
+
+static PyObject *get_script_env(PyObject *self, PyObject *unused)
+{
+	if (!script_env) Py_RETURN_NONE;
+	return PyCapsule_New((void *)script_env, NULL, NULL);
+}
+
+static PyMethodDef module_methods[] = {
+	{"push_local_frame", push_local_frame, METH_VARARGS,
+	 "Push a JNI local reference frame with the given capacity"},
+	{"pop_local_frame", pop_local_frame, METH_NOARGS,
+	 "Pop the current frame, deleting its local references"},
+	{"frame_counts", frame_counts, METH_NOARGS,
+	 "Return the numbers of frames pushed and popped"},
+	{"set_call_handler", set_call_handler, METH_O,
+	 "Set the function that handles requests made on an engine thread"},
+	{"request_channel_ready", request_channel_ready, METH_NOARGS,
+	 "Return True if take_request() can be used"},
+	{"take_request", take_request, METH_NOARGS,
+	 "Wait without the GIL for the engine thread's next request"},
+	{"script_env", get_script_env, METH_NOARGS,
+	 "Return the JNIEnv of the Java call running the script, or None"},
+	{NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef module_def = {
+	PyModuleDef_HEAD_INIT, "_scijava_cpython", NULL, -1, module_methods
+};
+
+static PyObject *init_module(void)
+{
+	return PyModule_Create(&module_def);
+}
+#else
+static void init_module(void)
+{
+	Py_InitModule("_scijava_cpython", module_methods);
+}
+#endif
+
+/* Make the module importable; this must come before Py_Initialize(). */
+static void add_module(JNIEnv *env)
+{
+	jclass klass;
+
+	(*env)->GetJavaVM(env, &jvm);
+	klass = (*env)->FindClass(env, "org/scijava/plugins/scripting/cpython/CPythonEngineWorker");
+	if (klass) {
+		worker_class = (jclass)(*env)->NewGlobalRef(env, klass);
+		take_request_method = (*env)->GetStaticMethodID(env, worker_class, "takeRequest",
+			"()Lorg/scijava/plugins/scripting/cpython/CPythonScriptEngine$Message;");
+	}
+	if ((*env)->ExceptionCheck(env)) {
+		/* The engines take their requests through the bridge instead */
+		(*env)->ExceptionClear(env);
+		take_request_method = NULL;
+	}
+	PyImport_AppendInittab("_scijava_cpython", init_module);
+}
+
+/*
+ * Start Python, if it is not running yet, and let go of the GIL: from
+ * here on, the threads that run Python, including this one, take it with
+ * PyGILState_Ensure().
+ */
+static void start_python(JNIEnv *env)
+{
+	if (Py_IsInitialized()) return;
+	add_module(env);
+	Py_Initialize();
+#if PY_VERSION_HEX < 0x03070000
+	PyEval_InitThreads();
+#endif
+	PyEval_SaveThread();
+}
 
 JNIEXPORT void JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_initializePythonThread(JNIEnv *env, jclass clazz, jstring pythonCode)
 {
@@ -38,7 +267,7 @@ JNIEXPORT void JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup
 	const char *python_code;
 	PyObject *err;
 
-	Py_Initialize();
+	start_python(env);
 	state = PyGILState_Ensure();
 	python_code = (*env)->GetStringUTFChars(env, pythonCode, NULL);
 	PyRun_SimpleString(python_code);
@@ -54,9 +283,136 @@ JNIEXPORT void JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup
 	}
 
 	/*
-	 * We cannot really call Py_Finalize(); here: multiple SciJava contexts
-	 * can have their individual CPythonScriptLanguage instances, so we
-	 * cannot call it after tearing down the context, either, so we have to
-	 * introduce a reference counter in the C library (TODO).
+	 * We do not call Py_Finalize(), here or later: the SciJava contexts
+	 * share this interpreter, and the javabridge cannot be started again
+	 * in the same process. CPythonRuntime counts the contexts that use it
+	 * and trims the Python side when the last one is disposed.
 	 */
 }
+
+JNIEXPORT void JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_initializePython(JNIEnv *env, jclass clazz)
+{
+	start_python(env);
+}
+
+JNIEXPORT jstring JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_getPythonVersion(JNIEnv *env, jclass clazz)
+{
+	return (*env)->NewStringUTF(env, Py_GetVersion());
+}
+
+JNIEXPORT jbyteArray JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_compile(JNIEnv *env, jclass clazz, jstring pythonCode, jstring fileName)
+{
+	PyGILState_STATE state;
+	const char *python_code, *file_name;
+	PyObject *code, *data = NULL;
+	char *buffer;
+	Py_ssize_t length;
+	jbyteArray result = NULL;
+
+	state = PyGILState_Ensure();
+	python_code = (*env)->GetStringUTFChars(env, pythonCode, NULL);
+	file_name = (*env)->GetStringUTFChars(env, fileName, NULL);
+	code = Py_CompileString(python_code, file_name, Py_file_input);
+	(*env)->ReleaseStringUTFChars(env, fileName, file_name);
+	(*env)->ReleaseStringUTFChars(env, pythonCode, python_code);
+	if (code) {
+		data = PyMarshal_WriteObjectToString(code, Py_MARSHAL_VERSION);
+		Py_DECREF(code);
+	}
+	if (data) {
+		if (PyBytes_AsStringAndSize(data, &buffer, &length) == 0) {
+			result = (*env)->NewByteArray(env, (jsize)length);
+			if (result) {
+				(*env)->SetByteArrayRegion(env, result, 0, (jsize)length, (jbyte *)buffer);
+			}
+		}
+		Py_DECREF(data);
+	}
+	if (PyErr_Occurred()) {
+		PyErr_Print();
+		PyErr_Clear();
+	}
+	PyGILState_Release(state);
+	if (!result && !(*env)->ExceptionCheck(env)) {
+		(*env)->ThrowNew(env, (*env)->FindClass(env, "java/lang/RuntimeException"), "Could not compile the Python script");
+	}
+	return result;
+}
+
+JNIEXPORT jboolean JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_runCompiled(JNIEnv *env, jclass clazz, jbyteArray compiled)
+{
+	PyGILState_STATE state;
+	jbyte *data;
+	jsize length;
+	PyObject *code, *globals, *result, *err;
+
+	state = PyGILState_Ensure();
+	length = (*env)->GetArrayLength(env, compiled);
+	data = (*env)->GetByteArrayElements(env, compiled, NULL);
+	code = PyMarshal_ReadObjectFromString((char *)data, length);
+	(*env)->ReleaseByteArrayElements(env, compiled, data, JNI_ABORT);
+	if (!code || !PyCode_Check(code)) {
+		/* Not code from this version of Python: let the caller recompile */
+		Py_XDECREF(code);
+		PyErr_Clear();
+		PyGILState_Release(state);
+		return JNI_FALSE;
+	}
+	globals = PyModule_GetDict(PyImport_AddModule("__main__"));
+	script_env = env;
+	result = PyEval_EvalCode(CODE_OBJECT(code), globals, globals);
+	script_env = NULL;
+	Py_DECREF(code);
+	Py_XDECREF(result);
+	err = PyErr_Occurred();
+	if (err) {
+		PyErr_Print();
+		PyErr_Clear();
+	}
+	PyGILState_Release(state);
+	if (err) {
+		(*env)->ThrowNew(env, (*env)->FindClass(env, "java/lang/RuntimeException"), "Python script raised an exception");
+	}
+	return JNI_TRUE;
+}
+
+JNIEXPORT jlong JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_getDirectBufferAddress(JNIEnv *env, jclass clazz, jobject buffer)
+{
+	return (jlong)(intptr_t)(*env)->GetDirectBufferAddress(env, buffer);
+}
+
+JNIEXPORT jobject JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_newDirectByteBuffer(JNIEnv *env, jclass clazz, jlong address, jlong capacity)
+{
+	return (*env)->NewDirectByteBuffer(env, (void *)(intptr_t)address, capacity);
+}
+
+JNIEXPORT void JNICALL Java_org_scijava_plugins_scripting_cpython_CPythonStartup_call(JNIEnv *env, jclass clazz, jobject request, jobjectArray response)
+{
+	PyGILState_STATE state;
+	PyObject *pRequest = NULL, *pResponse = NULL, *result = NULL, *err;
+
+	/*
+	 * The thread is a Python thread, so this takes the GIL with its own
+	 * thread state, which the bridge let go of when it called Java.
+	 */
+	state = PyGILState_Ensure();
+	if (call_handler) {
+		pRequest = PyCapsule_New((void *)request, NULL, NULL);
+		pResponse = PyCapsule_New((void *)response, NULL, NULL);
+		if (pRequest && pResponse) {
+			result = PyObject_CallFunctionObjArgs(call_handler, pRequest, pResponse, NULL);
+		}
+		Py_XDECREF(pRequest);
+		Py_XDECREF(pResponse);
+		Py_XDECREF(result);
+	}
+	err = PyErr_Occurred();
+	if (err) {
+		PyErr_Print();
+		PyErr_Clear();
+	}
+	PyGILState_Release(state);
+	if (err || !call_handler) {
+		(*env)->ThrowNew(env, (*env)->FindClass(env, "java/lang/RuntimeException"), "Could not call Python on the engine thread");
+	}
+}
@@ -0,0 +1,253 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.io.ByteArrayOutputStream;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.StandardCopyOption;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.util.Collections;
+import java.util.EnumMap;
+import java.util.Map;
+
+import org.scijava.log.LogService;
+
+/**
+ * Starts Python and runs the scripting-cpython script, timing each phase
+ * of the start.
+ * <p>
+ * The script is compiled once per version of the script and of Python.
+ * The compiled code is kept in the directory given by the
+ * {@code scijava.cpython.cacheDir} system property (default
+ * {@code ~/.scijava/cpython}) so that later starts skip the compile.
+ * Setting the property to an empty string turns the cache off.
+ * </p>
+ */
+public class CPythonBootstrap {
+
+	/**
+	 * The phases of the start
+	 */
+	public enum Phase {
+		/** Reading the script from the class path */
+		READ_SCRIPT,
+		/** Starting the Python interpreter */
+		INITIALIZE_PYTHON,
+		/** Reading the compiled script from the cache or compiling it */
+		LOAD_BYTECODE,
+		/** Running the script, which starts the engine requester thread */
+		RUN_SCRIPT,
+		/** Starting the first engine thread */
+		START_ENGINE
+	}
+
+	static final String PYTHON_SCRIPT = "scripting-cpython.py";
+
+	private final LogService logService;
+	private final String cacheDir;
+	private final Map<Phase, Long> timings = new EnumMap<Phase, Long>(Phase.class);
+
+	CPythonBootstrap(final LogService logService) {
+		this(logService, System.getProperty("scijava.cpython.cacheDir",
+			System.getProperty("user.home") + File.separator + ".scijava" + File.separator + "cpython"));
+	}
+
+	/**
+	 * @param logService the log for problems with the cache
+	 * @param cacheDir the directory of the compiled scripts or an empty
+	 *          string to compile the script on each start
+	 */
+	CPythonBootstrap(final LogService logService, final String cacheDir) {
+		this.logService = logService;
+		this.cacheDir = cacheDir;
+	}
+
+	/**
+	 * Start Python and run the script
+	 * 
+	 * @throws IOException if the script can't be read
+	 */
+	void run() throws IOException {
+		final long time = System.nanoTime();
+		final byte[] script = readResource(PYTHON_SCRIPT);
+		record(Phase.READ_SCRIPT, time);
+		run(script, PYTHON_SCRIPT);
+	}
+
+	/**
+	 * Start Python, if it is not running yet, and run a script as the
+	 * {@code __main__} module, from the cache if it was compiled before
+	 * 
+	 * @param script the script's source
+	 * @param fileName the file name for the script's tracebacks
+	 */
+	void run(final byte[] script, final String fileName) {
+		long time = System.nanoTime();
+		CPythonStartup.initializePython();
+		time = record(Phase.INITIALIZE_PYTHON, time);
+		final File cacheFile = getCacheFile(script);
+		final byte[] cached = readCache(cacheFile);
+		time = record(Phase.LOAD_BYTECODE, time);
+		if (cached != null) {
+			if (CPythonStartup.runCompiled(cached)) {
+				record(Phase.RUN_SCRIPT, time);
+				return;
+			}
+			logService.warn("Ignoring stale compiled script " + cacheFile);
+			time = System.nanoTime();
+		}
+		final byte[] compiled = CPythonStartup.compile(
+			new String(script, StandardCharsets.UTF_8), fileName);
+		writeCache(cacheFile, compiled);
+		time = record(Phase.LOAD_BYTECODE, time);
+		if (!CPythonStartup.runCompiled(compiled)) {
+			throw new IllegalStateException("Python could not load its own compiled script");
+		}
+		record(Phase.RUN_SCRIPT, time);
+	}
+
+	/**
+	 * Add the time since a start time to a phase
+	 * 
+	 * @param phase the phase to charge
+	 * @param start the start time, from {@link System#nanoTime()}
+	 * @return the current time, to start the next phase
+	 */
+	long record(final Phase phase, final long start) {
+		final long now = System.nanoTime();
+		final Long total = timings.get(phase);
+		timings.put(phase, (total == null ? 0 : total) + now - start);
+		return now;
+	}
+
+	/**
+	 * @return the time, in nanoseconds, that each phase took
+	 */
+	public Map<Phase, Long> getTimings() {
+		return Collections.unmodifiableMap(new EnumMap<Phase, Long>(timings));
+	}
+
+	@Override
+	public String toString() {
+		final StringBuilder sb = new StringBuilder();
+		long total = 0;
+		for (final Map.Entry<Phase, Long> entry : timings.entrySet()) {
+			sb.append(String.format(", %s %.1f ms", entry.getKey().name().toLowerCase(),
+				entry.getValue() / 1e6));
+			total += entry.getValue();
+		}
+		return String.format("CPython started in %.1f ms", total / 1e6) + sb;
+	}
+
+	/**
+	 * Read one of the plugin's resources. The Python side reads the module
+	 * that it shares with its worker processes this way.
+	 * 
+	 * @param name the resource's name
+	 * @return the resource's bytes
+	 * @throws IOException if the resource can't be read
+	 */
+	static byte[] readResource(final String name) throws IOException {
+		final InputStream is = CPythonBootstrap.class.getClassLoader().getResourceAsStream(name);
+		if (is == null) {
+			throw new IOException("Resource not found: " + name);
+		}
+		try {
+			final ByteArrayOutputStream out = new ByteArrayOutputStream(1 << 17);
+			final byte[] buffer = new byte[1 << 16];
+			int n;
+			while ((n = is.read(buffer)) > 0) {
+				out.write(buffer, 0, n);
+			}
+			return out.toByteArray();
+		} finally {
+			is.close();
+		}
+	}
+
+	/**
+	 * @return the cache file for the compiled script or null if the cache is
+	 *         off
+	 */
+	private File getCacheFile(final byte[] script) {
+		if (cacheDir.isEmpty()) return null;
+		try {
+			final MessageDigest digest = MessageDigest.getInstance("SHA-1");
+			digest.update(script);
+			digest.update(CPythonStartup.getPythonVersion().getBytes(StandardCharsets.UTF_8));
+			final StringBuilder name = new StringBuilder("scripting-cpython-");
+			for (final byte b : digest.digest()) {
+				name.append(String.format("%02x", b & 0xff));
+			}
+			return new File(cacheDir, name.append(".bin").toString());
+		} catch (final NoSuchAlgorithmException e) {
+			return null;
+		}
+	}
+
+	private byte[] readCache(final File file) {
+		if (file == null || !file.isFile()) return null;
+		try {
+			return Files.readAllBytes(file.toPath());
+		} catch (final IOException e) {
+			logService.warn("Could not read compiled script " + file, e);
+			return null;
+		}
+	}
+
+	/**
+	 * Write the compiled script to the cache. The file is written under
+	 * another name and then moved into place so that another process never
+	 * reads a partial file.
+	 */
+	private void writeCache(final File file, final byte[] compiled) {
+		if (file == null) return;
+		Path temp = null;
+		try {
+			final Path dir = Files.createDirectories(file.getParentFile().toPath());
+			temp = Files.createTempFile(dir, "scripting-cpython-", ".tmp");
+			Files.write(temp, compiled);
+			Files.move(temp, file.toPath(), StandardCopyOption.REPLACE_EXISTING,
+				StandardCopyOption.ATOMIC_MOVE);
+			temp = null;
+		} catch (final IOException e) {
+			logService.warn("Could not cache compiled script in " + file, e);
+		} finally {
+			if (temp != null) temp.toFile().delete();
+		}
+	}
+}
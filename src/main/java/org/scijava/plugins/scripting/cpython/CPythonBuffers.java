@@ -0,0 +1,117 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.lang.ref.PhantomReference;
+import java.lang.ref.Reference;
+import java.lang.ref.ReferenceQueue;
+import java.nio.Buffer;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.util.ArrayList;
+import java.util.Collections;
+import java.util.HashSet;
+import java.util.List;
+import java.util.Set;
+
+/**
+ * Direct buffers that share memory with Python (numpy) arrays.
+ * 
+ * The Python side wraps an array's memory with {@link #wrap} and keeps
+ * the array alive until {@link #collected} reports that the buffer (and
+ * any views of it) have been garbage collected.
+ */
+public final class CPythonBuffers {
+
+	private static final ReferenceQueue<ByteBuffer> queue = new ReferenceQueue<ByteBuffer>();
+
+	/** The phantom references must stay reachable until they are enqueued. */
+	private static final Set<Export> exports = Collections.synchronizedSet(new HashSet<Export>());
+
+	private static class Export extends PhantomReference<ByteBuffer> {
+		final long token;
+
+		Export(final ByteBuffer buffer, final long token) {
+			super(buffer, queue);
+			this.token = token;
+		}
+	}
+
+	private CPythonBuffers() {
+		// static utility class
+	}
+
+	/**
+	 * Wraps memory owned by Python in a direct buffer.
+	 * 
+	 * @param address the address of the memory
+	 * @param capacity the size of the memory in bytes
+	 * @param token identifies the owner of the memory in {@link #collected}
+	 * @return a direct buffer in native byte order
+	 */
+	public static ByteBuffer wrap(final long address, final long capacity, final long token) {
+		final ByteBuffer buffer = CPythonStartup.newDirectByteBuffer(address, capacity);
+		if (buffer == null) {
+			throw new UnsupportedOperationException("The JVM does not support direct buffer access from JNI");
+		}
+		buffer.order(ByteOrder.nativeOrder());
+		exports.add(new Export(buffer, token));
+		return buffer;
+	}
+
+	/**
+	 * @return the tokens of wrapped buffers that have been garbage collected
+	 *         since the last call
+	 */
+	public static long[] collected() {
+		final List<Long> tokens = new ArrayList<Long>();
+		for (Reference<? extends ByteBuffer> ref = queue.poll(); ref != null; ref = queue.poll()) {
+			exports.remove(ref);
+			tokens.add(((Export) ref).token);
+		}
+		final long[] result = new long[tokens.size()];
+		for (int i = 0; i < result.length; i++) {
+			result[i] = tokens.get(i);
+		}
+		return result;
+	}
+
+	/**
+	 * @param buffer a direct buffer
+	 * @return the address of the buffer's memory
+	 */
+	public static long address(final Buffer buffer) {
+		if (!buffer.isDirect()) {
+			throw new IllegalArgumentException("Not a direct buffer");
+		}
+		return CPythonStartup.getDirectBufferAddress(buffer);
+	}
+}
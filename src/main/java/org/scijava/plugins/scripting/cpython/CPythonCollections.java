@@ -0,0 +1,173 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.Collection;
+import java.util.Iterator;
+import java.util.List;
+import java.util.Map;
+
+/**
+ * Bulk access to Java collections for the Python side.
+ * 
+ * Python iterates a wrapped collection a chunk at a time, one JNI call per
+ * chunk. A chunk whose elements are all boxed numbers, or all booleans,
+ * is returned as a primitive array so that Python can read it into numpy
+ * in one copy.
+ */
+public final class CPythonCollections {
+
+	private CPythonCollections() {
+		// static utility class
+	}
+
+	/**
+	 * @param collection a collection
+	 * @return all of the collection's elements, as for {@link #compact}
+	 */
+	public static Object toArray(final Collection<?> collection) {
+		return compact(collection.toArray());
+	}
+
+	/**
+	 * @param list a list
+	 * @param from the index of the first element
+	 * @param to the index after the last element
+	 * @return the elements from {@code from} to {@code to}, as for
+	 *         {@link #compact}
+	 */
+	public static Object slice(final List<?> list, final int from, final int to) {
+		return compact(list.subList(from, to).toArray());
+	}
+
+	/**
+	 * @param iterator an iterator
+	 * @param n the maximum number of elements
+	 * @return the next {@code n} elements, fewer if the iterator runs out,
+	 *         as for {@link #compact}
+	 */
+	public static Object next(final Iterator<?> iterator, final int n) {
+		final Object[] chunk = new Object[n];
+		int count = 0;
+		while (count < n && iterator.hasNext()) {
+			chunk[count++] = iterator.next();
+		}
+		if (count < n) {
+			final Object[] rest = new Object[count];
+			System.arraycopy(chunk, 0, rest, 0, count);
+			return compact(rest);
+		}
+		return compact(chunk);
+	}
+
+	/**
+	 * @param map a map
+	 * @return the map's keys and its values, each as for {@link #compact},
+	 *         in the same order
+	 */
+	public static Object[] entries(final Map<?, ?> map) {
+		final Object[] keys = new Object[map.size()];
+		final Object[] values = new Object[keys.length];
+		int i = 0;
+		for (final Map.Entry<?, ?> entry : map.entrySet()) {
+			if (i == keys.length) break;
+			keys[i] = entry.getKey();
+			values[i++] = entry.getValue();
+		}
+		return new Object[] { compact(keys), compact(values) };
+	}
+
+	/**
+	 * Converts an array of boxed values to a primitive array.
+	 * 
+	 * @param elements the elements
+	 * @return a primitive array if the elements are all booleans or all
+	 *         boxed numbers: of their type if they are all of one type
+	 *         (bytes become {@code short[]}),
+	 *         {@code long[]} for a mix of integers and {@code double[]} for
+	 *         a mix that includes floating point numbers. Otherwise, the
+	 *         elements themselves.
+	 */
+	static Object compact(final Object[] elements) {
+		if (elements.length == 0) return elements;
+		Class<?> type = elements[0] == null ? null : elements[0].getClass();
+		boolean integral = true, mixed = false;
+		for (final Object element : elements) {
+			if (element == null) return elements;
+			final Class<?> c = element.getClass();
+			if (c != type) {
+				if (type == Boolean.class || c == Boolean.class) return elements;
+				mixed = true;
+			}
+			if (c == Float.class || c == Double.class) {
+				integral = false;
+			}
+			else if (c != Long.class && c != Integer.class && c != Short.class &&
+				c != Byte.class && c != Boolean.class)
+			{
+				return elements;
+			}
+		}
+		final int n = elements.length;
+		if (type == Boolean.class) {
+			final boolean[] a = new boolean[n];
+			for (int i = 0; i < n; i++) a[i] = (Boolean) elements[i];
+			return a;
+		}
+		if (mixed) {
+			type = integral ? Long.class : Double.class;
+		}
+		if (type == Double.class) {
+			final double[] a = new double[n];
+			for (int i = 0; i < n; i++) a[i] = ((Number) elements[i]).doubleValue();
+			return a;
+		}
+		if (type == Float.class) {
+			final float[] a = new float[n];
+			for (int i = 0; i < n; i++) a[i] = ((Number) elements[i]).floatValue();
+			return a;
+		}
+		if (type == Long.class) {
+			final long[] a = new long[n];
+			for (int i = 0; i < n; i++) a[i] = ((Number) elements[i]).longValue();
+			return a;
+		}
+		if (type == Integer.class) {
+			final int[] a = new int[n];
+			for (int i = 0; i < n; i++) a[i] = ((Number) elements[i]).intValue();
+			return a;
+		}
+		// Python reads byte[] as unsigned, so bytes go as shorts
+		final short[] a = new short[n];
+		for (int i = 0; i < n; i++) a[i] = ((Number) elements[i]).shortValue();
+		return a;
+	}
+}
@@ -0,0 +1,81 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import javax.script.Bindings;
+import javax.script.CompiledScript;
+import javax.script.ScriptContext;
+import javax.script.ScriptEngine;
+import javax.script.ScriptException;
+
+/**
+ * A script compiled by a {@link CPythonScriptEngine}.
+ * 
+ * The compiled code lives on the Python side of the engine; this handle
+ * refers to it by ID.
+ */
+public class CPythonCompiledScript extends CompiledScript {
+
+	private final CPythonScriptEngine engine;
+	private final String id;
+
+	CPythonCompiledScript(final CPythonScriptEngine engine, final String id) {
+		this.engine = engine;
+		this.id = id;
+	}
+
+	/**
+	 * @return the ID of the compiled code on the Python side
+	 */
+	public String getId() {
+		return id;
+	}
+
+	@Override
+	public Object eval() throws ScriptException {
+		return eval(engine.getBindings(ScriptContext.ENGINE_SCOPE));
+	}
+
+	@Override
+	public Object eval(final Bindings bindings) throws ScriptException {
+		return engine.evalCompiled(id, bindings);
+	}
+
+	@Override
+	public Object eval(final ScriptContext context) throws ScriptException {
+		return eval(context.getBindings(ScriptContext.ENGINE_SCOPE));
+	}
+
+	@Override
+	public ScriptEngine getEngine() {
+		return engine;
+	}
+}
@@ -0,0 +1,381 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.ArrayDeque;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Deque;
+import java.util.Iterator;
+import java.util.List;
+import java.util.concurrent.Executors;
+import java.util.concurrent.ScheduledExecutorService;
+import java.util.concurrent.ThreadFactory;
+import java.util.concurrent.TimeUnit;
+
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.EngineCommands;
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.Message;
+
+/**
+ * A bounded pool of Python engine threads.
+ * 
+ * Each worker is a Python thread, attached to the JVM, that serves one
+ * pair of request and response queues. A {@link CPythonScriptEngine}
+ * leases a worker for its lifetime and returns it when it is closed, so
+ * engines can be created and dropped without starting Python threads.
+ * <p>
+ * Engines must be closed when they are no longer needed. An engine that
+ * is dropped without being closed keeps its worker until it is garbage
+ * collected, and once all of the workers are leased, creating an engine
+ * waits for one to be returned. If none is returned within the lease
+ * timeout, the engine can't be created and an
+ * {@link IllegalStateException} is thrown.
+ * </p>
+ * <p>
+ * The pool keeps a number of idle workers ready so that leasing one does
+ * not need a handshake with the Python side. Idle workers beyond those
+ * are stopped once they have been idle for longer than the idle timeout.
+ * The pool is configured with system properties:
+ * </p>
+ * <ul>
+ * <li>{@code scijava.cpython.poolSize}: the maximum number of workers
+ * (default 16)</li>
+ * <li>{@code scijava.cpython.prewarm}: the number of idle workers to keep
+ * ready (default 1)</li>
+ * <li>{@code scijava.cpython.idleTimeout}: the idle timeout in seconds
+ * (default 60)</li>
+ * <li>{@code scijava.cpython.queueDepth}: the maximum number of requests in
+ * flight per worker (default 16)</li>
+ * <li>{@code scijava.cpython.leaseTimeout}: how long, in seconds, to wait
+ * for a worker when all of them are leased (default 30)</li>
+ * </ul>
+ */
+public class CPythonEnginePool {
+
+	private static final int DEFAULT_MAX_SIZE = 16;
+	private static final int DEFAULT_PREWARM = 1;
+	private static final long DEFAULT_IDLE_TIMEOUT = 60;
+	private static final int DEFAULT_QUEUE_DEPTH = 16;
+	private static final long DEFAULT_LEASE_TIMEOUT = 30;
+
+	private final int maxSize;
+	private final int prewarm;
+	private final long idleTimeout;
+	private final int queueDepth;
+	private final long leaseTimeout;
+
+	/** Idle workers, most recently used first */
+	private final Deque<CPythonEngineWorker> idle = new ArrayDeque<CPythonEngineWorker>();
+	private int size;
+	private int starting;
+	private boolean closed;
+
+	private final ScheduledExecutorService executor;
+
+	public CPythonEnginePool() {
+		this(Integer.getInteger("scijava.cpython.poolSize", DEFAULT_MAX_SIZE),
+			Integer.getInteger("scijava.cpython.prewarm", DEFAULT_PREWARM),
+			Long.getLong("scijava.cpython.idleTimeout", DEFAULT_IDLE_TIMEOUT), TimeUnit.SECONDS,
+			Integer.getInteger("scijava.cpython.queueDepth", DEFAULT_QUEUE_DEPTH),
+			TimeUnit.SECONDS.toMillis(Long.getLong("scijava.cpython.leaseTimeout", DEFAULT_LEASE_TIMEOUT)));
+	}
+
+	/**
+	 * @param maxSize the maximum number of workers
+	 * @param prewarm the number of idle workers to keep ready
+	 * @param idleTimeout how long a worker beyond the prewarmed ones may
+	 *                    stay idle before it is stopped
+	 * @param unit the unit of the idle timeout
+	 * @param queueDepth the maximum number of requests in flight per worker
+	 */
+	public CPythonEnginePool(final int maxSize, final int prewarm, final long idleTimeout, final TimeUnit unit,
+		final int queueDepth)
+	{
+		this(maxSize, prewarm, idleTimeout, unit, queueDepth,
+			TimeUnit.SECONDS.toMillis(DEFAULT_LEASE_TIMEOUT));
+	}
+
+	/**
+	 * @param maxSize the maximum number of workers
+	 * @param prewarm the number of idle workers to keep ready
+	 * @param idleTimeout how long a worker beyond the prewarmed ones may
+	 *                    stay idle before it is stopped
+	 * @param unit the unit of the idle timeout
+	 * @param queueDepth the maximum number of requests in flight per worker
+	 * @param leaseTimeout how long, in milliseconds, to wait
+	 *                     for a worker when all of them are leased
+	 */
+	public CPythonEnginePool(final int maxSize, final int prewarm, final long idleTimeout, final TimeUnit unit,
+		final int queueDepth, final long leaseTimeout)
+	{
+		if (maxSize < 1) {
+			throw new IllegalArgumentException("The pool size must be at least 1");
+		}
+		if (queueDepth < 1) {
+			throw new IllegalArgumentException("The queue depth must be at least 1");
+		}
+		this.queueDepth = queueDepth;
+		this.leaseTimeout = TimeUnit.MILLISECONDS.toNanos(leaseTimeout);
+		this.maxSize = maxSize;
+		this.prewarm = Math.max(0, Math.min(prewarm, maxSize));
+		this.idleTimeout = unit.toNanos(idleTimeout);
+		executor = Executors.newSingleThreadScheduledExecutor(new ThreadFactory() {
+			@Override
+			public Thread newThread(final Runnable r) {
+				final Thread thread = new Thread(r, "CPython-EnginePool");
+				thread.setDaemon(true);
+				return thread;
+			}
+		});
+		final long period = Math.max(unit.toMillis(idleTimeout) / 2, 1);
+		executor.scheduleWithFixedDelay(new Runnable() {
+			@Override
+			public void run() {
+				reap();
+			}
+		}, period, period, TimeUnit.MILLISECONDS);
+		fill();
+	}
+
+	/**
+	 * Lease a worker, waiting for one to be returned if the pool is at its
+	 * maximum size.
+	 * 
+	 * @return the worker, to be given back with {@link #release(CPythonEngineWorker)}
+	 * @throws InterruptedException
+	 * @throws IllegalStateException if the pool is closed or if no worker
+	 *         was returned within the lease timeout
+	 */
+	CPythonEngineWorker lease() throws InterruptedException {
+		synchronized (this) {
+			final long deadline = System.nanoTime() + leaseTimeout;
+			while (true) {
+				if (closed) {
+					throw new IllegalStateException("The engine pool is closed");
+				}
+				final CPythonEngineWorker worker = idle.pollFirst();
+				if (worker != null) {
+					fill();
+					return worker;
+				}
+				if (size < maxSize) {
+					size++;
+					break;
+				}
+				final long remaining = deadline - System.nanoTime();
+				if (remaining <= 0) {
+					throw new IllegalStateException(String.format(
+						"All %d CPython engine threads are in use and none was returned within %d ms. " +
+						"Close script engines when they are no longer needed, or raise scijava.cpython.poolSize.",
+						maxSize, TimeUnit.NANOSECONDS.toMillis(leaseTimeout)));
+				}
+				TimeUnit.NANOSECONDS.timedWait(this, remaining);
+			}
+		}
+		return start();
+	}
+
+	/**
+	 * Wait until the workers that the pool started when it was created are
+	 * ready, so the first engine does not have to start one.
+	 * 
+	 * @throws InterruptedException
+	 */
+	synchronized void awaitPrewarmed() throws InterruptedException {
+		while (!closed && idle.isEmpty() && starting > 0) {
+			wait();
+		}
+	}
+
+	/**
+	 * Return a leased worker to the pool. A worker whose Python thread
+	 * has stopped is dropped.
+	 */
+	void release(final CPythonEngineWorker worker) {
+		if (worker.isStopped()) {
+			synchronized (this) {
+				size--;
+				notifyAll();
+			}
+			fill();
+			return;
+		}
+		if (!park(worker)) stop(worker);
+	}
+
+	/**
+	 * @return the maximum number of workers
+	 */
+	public int getMaxSize() {
+		return maxSize;
+	}
+
+	/**
+	 * @return the number of workers that are running or starting
+	 */
+	public synchronized int getSize() {
+		return size;
+	}
+
+	/**
+	 * @return the number of workers leased by engines
+	 */
+	public synchronized int getLeasedCount() {
+		return size - starting - idle.size();
+	}
+
+	/**
+	 * @return the number of workers ready to be leased
+	 */
+	public synchronized int getIdleCount() {
+		return idle.size();
+	}
+
+	/**
+	 * Stop the idle workers. Leased workers are stopped when they are
+	 * returned.
+	 */
+	public void close() {
+		final List<CPythonEngineWorker> workers;
+		synchronized (this) {
+			if (closed) return;
+			closed = true;
+			workers = new ArrayList<CPythonEngineWorker>(idle);
+			size -= idle.size();
+			idle.clear();
+			notifyAll();
+		}
+		executor.shutdown();
+		for (final CPythonEngineWorker worker : workers) {
+			stop(worker);
+		}
+	}
+
+	/**
+	 * Add a worker to the idle ones
+	 * 
+	 * @return false if the pool is closed, in which case the caller should
+	 *         stop the worker
+	 */
+	private synchronized boolean park(final CPythonEngineWorker worker) {
+		if (closed) {
+			size--;
+			return false;
+		}
+		worker.idleSince = System.nanoTime();
+		idle.addFirst(worker);
+		notifyAll();
+		return true;
+	}
+
+	/**
+	 * Start workers in the background until there are enough idle ones
+	 */
+	private synchronized void fill() {
+		while (!closed && idle.size() + starting < prewarm && size < maxSize) {
+			size++;
+			starting++;
+			executor.execute(new Runnable() {
+				@Override
+				public void run() {
+					CPythonEngineWorker worker = null;
+					try {
+						worker = start();
+					} catch (final InterruptedException e) {
+						Thread.currentThread().interrupt();
+					} finally {
+						final boolean parked;
+						synchronized (CPythonEnginePool.this) {
+							starting--;
+							parked = worker != null && park(worker);
+							CPythonEnginePool.this.notifyAll();
+						}
+						if (worker != null && !parked) stop(worker);
+					}
+				}
+			});
+		}
+	}
+
+	/**
+	 * Stop the workers that have been idle too long, keeping the prewarmed
+	 * ones
+	 */
+	private void reap() {
+		final List<CPythonEngineWorker> expired = new ArrayList<CPythonEngineWorker>();
+		synchronized (this) {
+			final long now = System.nanoTime();
+			final Iterator<CPythonEngineWorker> it = idle.descendingIterator();
+			while (idle.size() > prewarm && it.hasNext()) {
+				final CPythonEngineWorker worker = it.next();
+				if (now - worker.idleSince < idleTimeout) break;
+				it.remove();
+				size--;
+				expired.add(worker);
+			}
+		}
+		for (final CPythonEngineWorker worker : expired) {
+			stop(worker);
+		}
+	}
+
+	/**
+	 * Start a Python engine thread for a new worker.
+	 * 
+	 * The Python side serves new engine requests one at a time over the
+	 * static queues.
+	 */
+	private CPythonEngineWorker start() throws InterruptedException {
+		final CPythonEngineWorker worker = new CPythonEngineWorker(queueDepth);
+		boolean started = false;
+		try {
+			synchronized (CPythonScriptEngine.engineRequestQueue) {
+				CPythonScriptEngine.engineRequestQueue.put(new Message(EngineCommands.NEW_ENGINE,
+					Arrays.asList((Object) worker.requestQueue, (Object) worker.responseQueue)));
+				CPythonScriptEngine.engineResponseQueue.take();
+			}
+			worker.start();
+			started = true;
+		} finally {
+			if (!started) {
+				synchronized (this) {
+					size--;
+					notifyAll();
+				}
+			}
+		}
+		return worker;
+	}
+
+	private static void stop(final CPythonEngineWorker worker) {
+		worker.stop();
+	}
+}
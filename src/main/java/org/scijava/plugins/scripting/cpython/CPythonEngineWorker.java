@@ -0,0 +1,212 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.ArrayList;
+import java.util.Map;
+import java.util.concurrent.BlockingQueue;
+import java.util.concurrent.CompletableFuture;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.LinkedBlockingQueue;
+import java.util.concurrent.Semaphore;
+import java.util.concurrent.atomic.AtomicLong;
+
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.EngineCommands;
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.Message;
+
+/**
+ * A Python engine thread and the queues it serves.
+ * <p>
+ * Requests are numbered and responses are matched to them by number, so
+ * several requests can be in flight at once. The Python thread handles
+ * them in order. A reader thread takes the responses and completes the
+ * requests' futures. At most {@code depth} requests are in flight:
+ * {@link #submit(Message)} waits for a response before sending more.
+ * </p>
+ * <p>
+ * Once the Python thread has stopped, whether it was asked to or it
+ * failed, the requests still in flight and any submitted later fail with
+ * an {@link IllegalStateException}.
+ * </p>
+ */
+class CPythonEngineWorker {
+
+	final BlockingQueue<Message> requestQueue = new LinkedBlockingQueue<Message>();
+	final BlockingQueue<Message> responseQueue = new LinkedBlockingQueue<Message>();
+
+	/**
+	 * The request queue of the worker whose Python thread is the current
+	 * thread, set when the Python thread starts
+	 */
+	private static final ThreadLocal<BlockingQueue<Message>> serving =
+		new ThreadLocal<BlockingQueue<Message>>();
+
+	private final Semaphore depth;
+	private final AtomicLong ids = new AtomicLong();
+	private final Map<Long, CompletableFuture<Message>> pending =
+		new ConcurrentHashMap<Long, CompletableFuture<Message>>();
+	private volatile boolean stopped;
+
+	/** When the worker was returned to the pool */
+	long idleSince;
+
+	/**
+	 * @param depth the maximum number of requests in flight
+	 */
+	CPythonEngineWorker(final int depth) {
+		this.depth = new Semaphore(depth);
+	}
+
+	/**
+	 * Start taking responses. Call once the Python thread is running.
+	 */
+	void start() {
+		final Thread reader = new Thread(new Runnable() {
+			@Override
+			public void run() {
+				read();
+			}
+		}, "CPython-EngineResponses");
+		reader.setDaemon(true);
+		reader.start();
+	}
+
+	/**
+	 * Send a request, waiting if the maximum number of requests are in flight
+	 * 
+	 * @return a future that is completed with the response
+	 * @throws InterruptedException
+	 */
+	CompletableFuture<Message> submit(final Message request) throws InterruptedException {
+		depth.acquire();
+		final CompletableFuture<Message> future = new CompletableFuture<Message>();
+		request.id = ids.incrementAndGet();
+		pending.put(request.id, future);
+		if (stopped) {
+			// The reader may have failed the pending requests before this one
+			fail(request.id);
+		} else {
+			requestQueue.add(request);
+		}
+		return future;
+	}
+
+	/**
+	 * Send requests without waiting, neither for room in flight nor for
+	 * the responses, which are dropped. For cleaning up after an engine
+	 * on a thread that must not block.
+	 */
+	void post(final Message... requests) {
+		for (final Message request : requests) {
+			requestQueue.add(request);
+		}
+	}
+
+	/**
+	 * Called by the Python thread when it starts serving a request queue
+	 */
+	static void serve(final BlockingQueue<Message> queue) {
+		serving.set(queue);
+	}
+
+	/**
+	 * Take the next request for the current Python thread, waiting if need
+	 * be. Called by the native request channel, without the GIL.
+	 * 
+	 * @return the request
+	 * @throws InterruptedException
+	 */
+	static Message takeRequest() throws InterruptedException {
+		return serving.get().take();
+	}
+
+	/**
+	 * @return true if the current thread is this worker's Python thread,
+	 *         e.g. running Java code that a script called
+	 */
+	boolean isCurrentThread() {
+		return serving.get() == requestQueue;
+	}
+
+	/**
+	 * @return true if the Python thread has stopped
+	 */
+	boolean isStopped() {
+		return stopped;
+	}
+
+	/**
+	 * @return the number of requests sent and not yet answered
+	 */
+	int getInFlightCount() {
+		return pending.size();
+	}
+
+	/**
+	 * Ask the Python thread to stop after the requests in flight. The
+	 * reader stops when the Python thread acknowledges.
+	 */
+	void stop() {
+		requestQueue.add(new Message(EngineCommands.CLOSE_ENGINE, new ArrayList<Object>()));
+	}
+
+	private void read() {
+		try {
+			while (true) {
+				final Message response = responseQueue.take();
+				if (response.command == EngineCommands.CLOSE_ENGINE) break;
+				final CompletableFuture<Message> future = pending.remove(response.id);
+				if (future != null) {
+					depth.release();
+					future.complete(response);
+				}
+			}
+		} catch (final InterruptedException e) {
+			// fall through and fail whatever is left
+		} finally {
+			stopped = true;
+			for (final Long id : new ArrayList<Long>(pending.keySet())) {
+				fail(id);
+			}
+		}
+	}
+
+	/**
+	 * Fail a request that the Python thread won't answer
+	 */
+	private void fail(final long id) {
+		final CompletableFuture<Message> future = pending.remove(id);
+		if (future != null) {
+			depth.release();
+			future.completeExceptionally(new IllegalStateException("The Python engine thread has stopped"));
+		}
+	}
+}
@@ -0,0 +1,312 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.nio.ByteBuffer;
+import java.util.HashMap;
+import java.util.Map;
+
+import net.imglib2.RandomAccess;
+import net.imglib2.RandomAccessibleInterval;
+import net.imglib2.type.BooleanType;
+import net.imglib2.type.logic.BitType;
+import net.imglib2.type.logic.BoolType;
+import net.imglib2.type.numeric.IntegerType;
+import net.imglib2.type.numeric.RealType;
+import net.imglib2.type.numeric.integer.ByteType;
+import net.imglib2.type.numeric.integer.IntType;
+import net.imglib2.type.numeric.integer.LongType;
+import net.imglib2.type.numeric.integer.ShortType;
+import net.imglib2.type.numeric.integer.UnsignedByteType;
+import net.imglib2.type.numeric.integer.UnsignedIntType;
+import net.imglib2.type.numeric.integer.UnsignedLongType;
+import net.imglib2.type.numeric.integer.UnsignedShortType;
+import net.imglib2.type.numeric.real.DoubleType;
+import net.imglib2.type.numeric.real.FloatType;
+import net.imglib2.util.Util;
+
+/**
+ * Block access to ImgLib2 images for the Python side.
+ * 
+ * Python reads and writes an image a block at a time through a direct
+ * buffer that shares memory with a numpy array. Pixels are stored in the
+ * numpy dtype of the image's type, in C order: the last dimension of the
+ * image varies fastest.
+ */
+public final class CPythonImages {
+
+	/** Copies pixels of one numpy dtype between an image and a buffer. */
+	private static abstract class PixelType {
+
+		final String dtype;
+		final int size;
+
+		PixelType(final String dtype, final int size) {
+			this.dtype = dtype;
+			this.size = size;
+		}
+
+		/** Stores a pixel at a byte offset of the buffer. */
+		abstract void read(Object pixel, ByteBuffer block, int offset);
+
+		/** Sets a pixel from a byte offset of the buffer. */
+		abstract void write(Object pixel, ByteBuffer block, int offset);
+	}
+
+	private static class BooleanPixelType extends PixelType {
+
+		BooleanPixelType() {
+			super("bool", 1);
+		}
+
+		@Override
+		void read(final Object pixel, final ByteBuffer block, final int offset) {
+			block.put(offset, (byte) (((BooleanType<?>) pixel).get() ? 1 : 0));
+		}
+
+		@Override
+		void write(final Object pixel, final ByteBuffer block, final int offset) {
+			((BooleanType<?>) pixel).set(block.get(offset) != 0);
+		}
+	}
+
+	private static class IntegerPixelType extends PixelType {
+
+		final boolean unsigned;
+
+		IntegerPixelType(final String dtype, final int size,
+			final boolean unsigned)
+		{
+			super(dtype, size);
+			this.unsigned = unsigned;
+		}
+
+		@Override
+		void read(final Object pixel, final ByteBuffer block, final int offset) {
+			final long value = ((IntegerType<?>) pixel).getIntegerLong();
+			switch (size) {
+				case 1:
+					block.put(offset, (byte) value);
+					break;
+				case 2:
+					block.putShort(offset, (short) value);
+					break;
+				case 4:
+					block.putInt(offset, (int) value);
+					break;
+				default:
+					block.putLong(offset, value);
+			}
+		}
+
+		@Override
+		void write(final Object pixel, final ByteBuffer block, final int offset) {
+			final long value;
+			switch (size) {
+				case 1:
+					value = unsigned ? block.get(offset) & 0xffL : block.get(offset);
+					break;
+				case 2:
+					value = unsigned ? block.getShort(offset) & 0xffffL : block
+						.getShort(offset);
+					break;
+				case 4:
+					value = unsigned ? block.getInt(offset) & 0xffffffffL : block
+						.getInt(offset);
+					break;
+				default:
+					value = block.getLong(offset);
+			}
+			((IntegerType<?>) pixel).setInteger(value);
+		}
+	}
+
+	private static class FloatPixelType extends PixelType {
+
+		FloatPixelType() {
+			super("float32", 4);
+		}
+
+		@Override
+		void read(final Object pixel, final ByteBuffer block, final int offset) {
+			block.putFloat(offset, ((RealType<?>) pixel).getRealFloat());
+		}
+
+		@Override
+		void write(final Object pixel, final ByteBuffer block, final int offset) {
+			((RealType<?>) pixel).setReal(block.getFloat(offset));
+		}
+	}
+
+	private static class DoublePixelType extends PixelType {
+
+		DoublePixelType() {
+			super("float64", 8);
+		}
+
+		@Override
+		void read(final Object pixel, final ByteBuffer block, final int offset) {
+			block.putDouble(offset, ((RealType<?>) pixel).getRealDouble());
+		}
+
+		@Override
+		void write(final Object pixel, final ByteBuffer block, final int offset) {
+			((RealType<?>) pixel).setReal(block.getDouble(offset));
+		}
+	}
+
+	private static final PixelType INT64 = new IntegerPixelType("int64", 8,
+		false);
+	private static final PixelType FLOAT64 = new DoublePixelType();
+
+	private static final Map<Class<?>, PixelType> pixelTypes =
+		new HashMap<Class<?>, PixelType>();
+
+	static {
+		final PixelType bool = new BooleanPixelType();
+		pixelTypes.put(BitType.class, bool);
+		pixelTypes.put(BoolType.class, bool);
+		pixelTypes.put(ByteType.class, new IntegerPixelType("int8", 1, false));
+		pixelTypes.put(UnsignedByteType.class, new IntegerPixelType("uint8", 1,
+			true));
+		pixelTypes.put(ShortType.class, new IntegerPixelType("int16", 2, false));
+		pixelTypes.put(UnsignedShortType.class, new IntegerPixelType("uint16", 2,
+			true));
+		pixelTypes.put(IntType.class, new IntegerPixelType("int32", 4, false));
+		pixelTypes.put(UnsignedIntType.class, new IntegerPixelType("uint32", 4,
+			true));
+		pixelTypes.put(LongType.class, INT64);
+		pixelTypes.put(UnsignedLongType.class, new IntegerPixelType("uint64", 8,
+			true));
+		pixelTypes.put(FloatType.class, new FloatPixelType());
+		pixelTypes.put(DoubleType.class, FLOAT64);
+	}
+
+	private CPythonImages() {
+		// static utility class
+	}
+
+	/**
+	 * @param image an image
+	 * @return the numpy dtype of the image's pixels: that of the pixel type,
+	 *         {@code int64} for other integer types or {@code float64} for
+	 *         other real types
+	 * @throws IllegalArgumentException if the pixels aren't booleans or
+	 *           real numbers
+	 */
+	public static String dtype(final RandomAccessibleInterval<?> image) {
+		return pixelType(image).dtype;
+	}
+
+	/**
+	 * Copies a block of an image into a buffer.
+	 * 
+	 * @param image the image
+	 * @param min the block's minimum in each dimension
+	 * @param max the block's maximum in each dimension
+	 * @param block a buffer in native byte order to hold the pixels
+	 */
+	public static void read(final RandomAccessibleInterval<?> image,
+		final long[] min, final long[] max, final ByteBuffer block)
+	{
+		copy(image, min, max, block, false);
+	}
+
+	/**
+	 * Copies a buffer into a block of an image.
+	 * 
+	 * @param image the image
+	 * @param min the block's minimum in each dimension
+	 * @param max the block's maximum in each dimension
+	 * @param block a buffer in native byte order that holds the pixels
+	 */
+	public static void write(final RandomAccessibleInterval<?> image,
+		final long[] min, final long[] max, final ByteBuffer block)
+	{
+		copy(image, min, max, block, true);
+	}
+
+	private static PixelType pixelType(final RandomAccessibleInterval<?> image) {
+		final Object pixel = Util.getTypeFromInterval(image);
+		final PixelType pixelType = pixelTypes.get(pixel.getClass());
+		if (pixelType != null) return pixelType;
+		if (pixel instanceof IntegerType) return INT64;
+		if (pixel instanceof RealType) return FLOAT64;
+		throw new IllegalArgumentException("No numpy dtype for " + pixel
+			.getClass().getName());
+	}
+
+	private static void copy(final RandomAccessibleInterval<?> image,
+		final long[] min, final long[] max, final ByteBuffer block,
+		final boolean write)
+	{
+		final int n = image.numDimensions();
+		if (n == 0 || min.length != n || max.length != n) {
+			throw new IllegalArgumentException("The block must have " + n +
+				" dimensions");
+		}
+		final PixelType pixelType = pixelType(image);
+		long count = 1;
+		for (int d = 0; d < n; d++) {
+			if (min[d] < image.min(d) || max[d] > image.max(d) || max[d] < min[d]) {
+				throw new IndexOutOfBoundsException("Dimension " + d +
+					" of the block, " + min[d] + " to " + max[d] +
+					", is not in the image");
+			}
+			count *= max[d] - min[d] + 1;
+		}
+		if (count * pixelType.size > block.capacity()) {
+			throw new IllegalArgumentException("The block needs " + count *
+				pixelType.size + " bytes, but the buffer holds " + block.capacity());
+		}
+		final RandomAccess<?> access = image.randomAccess();
+		final long[] position = min.clone();
+		final int last = n - 1;
+		final long rowLength = max[last] - min[last] + 1;
+		int offset = 0;
+		while (true) {
+			access.setPosition(position);
+			for (long i = 0; i < rowLength; i++) {
+				if (write) pixelType.write(access.get(), block, offset);
+				else pixelType.read(access.get(), block, offset);
+				offset += pixelType.size;
+				access.fwd(last);
+			}
+			int d = last - 1;
+			while (d >= 0 && position[d] == max[d]) {
+				position[d] = min[d];
+				d--;
+			}
+			if (d < 0) return;
+			position[d]++;
+		}
+	}
+}
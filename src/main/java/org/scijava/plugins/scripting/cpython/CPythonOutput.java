@@ -0,0 +1,105 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.io.IOException;
+import java.io.OutputStreamWriter;
+import java.io.Writer;
+import java.lang.ref.WeakReference;
+
+import javax.script.ScriptContext;
+import javax.script.ScriptEngine;
+
+/**
+ * The destination of what an engine's scripts print.
+ * <p>
+ * The Python side replaces {@code sys.stdout} and {@code sys.stderr} with
+ * per-engine buffers that are written here in chunks: when a buffer holds
+ * {@code scijava.cpython.outputBuffer} characters (8192 by default), at a
+ * newline if {@code scijava.cpython.lineBuffered} is true, and when a
+ * request is done. The chunks go to the writers of the engine's
+ * {@link ScriptContext}, or to {@link System#out} and {@link System#err}
+ * if it has none.
+ * </p>
+ * <p>
+ * Writing is synchronous: a slow writer holds up the script that prints,
+ * so the buffers stay bounded.
+ * </p>
+ * <p>
+ * The Python side keeps the output for as long as the engine has its
+ * thread, so it only refers to the engine weakly: an engine that is not
+ * closed can still be collected, which gives the thread back to the pool.
+ * </p>
+ */
+public final class CPythonOutput {
+
+	/** The number of the standard output stream, used by the Python side */
+	public static final int STDOUT = 1;
+
+	/** The number of the standard error stream, used by the Python side */
+	public static final int STDERR = 2;
+
+	private static final Writer systemOut = new OutputStreamWriter(System.out);
+	private static final Writer systemErr = new OutputStreamWriter(System.err);
+
+	private final WeakReference<ScriptEngine> engine;
+
+	/**
+	 * @param engine the engine whose context's writers get the output
+	 */
+	CPythonOutput(final ScriptEngine engine) {
+		this.engine = new WeakReference<ScriptEngine>(engine);
+	}
+
+	/**
+	 * Writes a chunk of output and flushes the writer.
+	 * 
+	 * @param stream {@link #STDOUT} or {@link #STDERR}
+	 * @param text the output
+	 * @throws IOException
+	 */
+	public void write(final int stream, final String text) throws IOException {
+		final Writer writer = getWriter(stream);
+		synchronized (writer) {
+			writer.write(text);
+			writer.flush();
+		}
+	}
+
+	private Writer getWriter(final int stream) {
+		final ScriptEngine engine = this.engine.get();
+		final ScriptContext context = engine == null ? null : engine.getContext();
+		final Writer writer = context == null ? null : stream == STDERR ? context
+			.getErrorWriter() : context.getWriter();
+		if (writer != null) return writer;
+		return stream == STDERR ? systemErr : systemOut;
+	}
+}
@@ -0,0 +1,135 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+/**
+ * The profile of one request, made by the Python side when profiling is
+ * turned on with {@link CPythonScriptEngine#setProfileMode(Mode)}.
+ * <p>
+ * The profile covers the handling of the request on the engine thread:
+ * converting the bindings, running the script and converting its result.
+ * Time spent in Java, i.e. in calls through the javabridge, is counted
+ * separately from time spent running Python.
+ * </p>
+ */
+public final class CPythonProfile {
+
+	/**
+	 * How a request is profiled
+	 */
+	public static enum Mode {
+		/**
+		 * Profile every call with cProfile. The report is a table of the
+		 * functions by cumulative time, as pstats prints it. The times are
+		 * exact, but the profiling slows Python down considerably.
+		 */
+		CPROFILE,
+		/**
+		 * Sample the engine thread's stack every
+		 * {@code scijava.cpython.profileInterval} milliseconds (5 by
+		 * default). The report is in the collapsed stack format of
+		 * flame graph tools: one line per stack, its frames from the
+		 * outermost in, separated by semicolons, and the microseconds
+		 * spent in it, each sample standing for the time since the one
+		 * before. Samples taken in a call to Java end in a {@code [java]}
+		 * frame. The overhead is low, but the times are estimates.
+		 */
+		SAMPLE
+	}
+
+	private final Mode mode;
+	private final long totalNanos;
+	private final long javaNanos;
+	private final int samples;
+	private final String report;
+
+	/**
+	 * Made by the Python side
+	 */
+	CPythonProfile(final String mode, final long totalNanos, final long javaNanos, final int samples,
+		final String report)
+	{
+		this.mode = Mode.valueOf(mode);
+		this.totalNanos = totalNanos;
+		this.javaNanos = javaNanos;
+		this.samples = samples;
+		this.report = report;
+	}
+
+	/**
+	 * @return how the request was profiled
+	 */
+	public Mode getMode() {
+		return mode;
+	}
+
+	/**
+	 * @return the time the engine thread took to handle the request
+	 */
+	public long getTotalNanos() {
+		return totalNanos;
+	}
+
+	/**
+	 * @return the part of the total time spent in calls to Java
+	 */
+	public long getJavaNanos() {
+		return javaNanos;
+	}
+
+	/**
+	 * @return the part of the total time spent outside of calls to Java
+	 */
+	public long getPythonNanos() {
+		return totalNanos - javaNanos;
+	}
+
+	/**
+	 * @return the number of stack samples taken, 0 for {@link Mode#CPROFILE}
+	 */
+	public int getSamples() {
+		return samples;
+	}
+
+	/**
+	 * @return the cProfile table or the collapsed stacks, depending on the
+	 *         mode
+	 */
+	public String getReport() {
+		return report;
+	}
+
+	@Override
+	public String toString() {
+		return String.format("CPythonProfile[%s, total=%.3f ms, java=%.3f ms]", mode, totalNanos / 1e6,
+			javaNanos / 1e6);
+	}
+}
@@ -0,0 +1,130 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.io.IOException;
+import java.util.Map;
+
+import org.scijava.log.LogService;
+
+/**
+ * The Python runtime that all of the JVM's SciJava contexts share.
+ * <p>
+ * Python is started once per process. The first context that needs it
+ * starts Python and runs the bootstrap script, which starts the service
+ * thread that makes engine threads; later contexts use the same
+ * interpreter and skip the startup. The contexts share one pool of engine
+ * threads, and each engine has a namespace of its own, which is cleared
+ * when the engine is closed, so contexts don't see each other's scripts.
+ * </p>
+ * <p>
+ * Python can't safely be finalized, so it keeps running, but the runtime
+ * counts the contexts that use it. When the last one lets go, the pool's
+ * engine threads are stopped and the Python side frees its caches and idle
+ * worker processes. The next context gets a new pool.
+ * </p>
+ */
+final class CPythonRuntime {
+
+	private static CPythonBootstrap bootstrap;
+	private static CPythonEnginePool pool;
+	private static int references;
+
+	private CPythonRuntime() {
+		// static methods only
+	}
+
+	/**
+	 * Add a reference to the runtime, starting Python and the engine pool
+	 * if need be and waiting for the pool's first engine thread
+	 * 
+	 * @param logService where to log the startup
+	 * @return the engine pool, to be used until {@link #release()}
+	 * @throws IOException if the bootstrap script could not be read
+	 */
+	static synchronized CPythonEnginePool acquire(final LogService logService) throws IOException {
+		if (bootstrap == null) {
+			final CPythonBootstrap started = new CPythonBootstrap(logService);
+			started.run();
+			bootstrap = started;
+		}
+		if (pool == null) {
+			final long start = System.nanoTime();
+			pool = new CPythonEnginePool();
+			try {
+				pool.awaitPrewarmed();
+			} catch (InterruptedException e) {
+				Thread.currentThread().interrupt();
+			}
+			bootstrap.record(CPythonBootstrap.Phase.START_ENGINE, start);
+			logService.info(bootstrap.toString());
+		}
+		references++;
+		return pool;
+	}
+
+	/**
+	 * Remove a reference to the runtime. The last one closes the engine
+	 * pool and trims the Python side.
+	 */
+	static synchronized void release() {
+		if (references == 0 || --references > 0) return;
+		pool.close();
+		pool = null;
+		try {
+			CPythonScriptEngine.trimService();
+		} catch (InterruptedException e) {
+			Thread.currentThread().interrupt();
+		}
+	}
+
+	/**
+	 * @return the time, in nanoseconds, that each phase of starting Python
+	 *         took, or null if Python has not been started
+	 */
+	static synchronized Map<CPythonBootstrap.Phase, Long> getStartupTimings() {
+		return bootstrap == null ? null : bootstrap.getTimings();
+	}
+
+	/**
+	 * @return the engine pool, or null if no context uses Python
+	 */
+	static synchronized CPythonEnginePool getPool() {
+		return pool;
+	}
+
+	/**
+	 * @return the number of references, one per context that uses Python
+	 */
+	static synchronized int getReferenceCount() {
+		return references;
+	}
+}
@@ -33,15 +33,25 @@ package org.scijava.plugins.scripting.cpython;
 
 import java.io.IOException;
 import java.io.Reader;
+import java.util.ArrayList;
 import java.util.Arrays;
 import java.util.Collections;
+import java.util.EnumSet;
 import java.util.HashMap;
 import java.util.List;
 import java.util.Map;
+import java.util.Set;
+import java.util.TreeMap;
+import java.util.concurrent.CompletableFuture;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.ExecutionException;
 import java.util.concurrent.SynchronousQueue;
 
 import javax.script.Bindings;
+import javax.script.Compilable;
+import javax.script.CompiledScript;
 import javax.script.ScriptContext;
+import javax.script.ScriptEngine;
 import javax.script.ScriptException;
 import javax.script.SimpleBindings;
 
@@ -53,17 +63,47 @@ import org.scijava.script.AbstractScriptEngine;
  *
  * The script engine for CPython scripting via the javabridge.
  * 
- * The engine communicates with a Python thread via two static queues
- * which are used to arrange for the creation of an execution context
- * for the engine via two instance-specific queues.
+ * The engine communicates with a Python thread via two queues. The
+ * thread and its queues are leased from a {@link CPythonEnginePool}, which
+ * starts Python threads through two static queues. Close an engine when
+ * done with it to return its thread to the pool: the pool has a bounded
+ * number of threads, and an engine that is only dropped holds its thread
+ * until it is garbage collected.
+ * 
+ * The engine's scripts share one Python namespace, so modules a script
+ * imports and objects it creates are there for the engine's later scripts.
+ * Before each script, only the bindings whose values changed since the
+ * last script are converted again. {@link #reset()} clears the namespace.
+ * 
+ * What the scripts print goes to the writers of the engine's
+ * {@link ScriptContext}, in chunks (see {@link CPythonOutput}).
+ * 
+ * Python functions can be called from Java through {@link PyFunction}s,
+ * which run them on the engine's Python thread.
+ * 
+ * {@link #setProfileMode(CPythonProfile.Mode)} turns on profiling of the
+ * scripts and calls, which the Python side sends back as a
+ * {@link CPythonProfile} with each response.
  */
-public class CPythonScriptEngine extends AbstractScriptEngine {
+public class CPythonScriptEngine extends AbstractScriptEngine implements Compilable {
 
 	public static final SynchronousQueue<Message> engineRequestQueue = new SynchronousQueue<Message>();
 	public static final SynchronousQueue<Message> engineResponseQueue = new SynchronousQueue<Message>();
 	
-	private final SynchronousQueue<Message> requestQueue = new SynchronousQueue<Message>();
-	private final SynchronousQueue<Message> responseQueue = new SynchronousQueue<Message>();
+	private final CPythonEnginePool pool;
+	private volatile CPythonEngineWorker worker;
+	private final CPythonStatistics statistics = new CPythonStatistics();
+	private final Set<PyObjectRef> refs = Collections.newSetFromMap(new ConcurrentHashMap<PyObjectRef, Boolean>());
+	private volatile CPythonProfile.Mode profileMode;
+	private volatile CPythonProfile lastProfile;
+
+	/**
+	 * The requests that run scripts or functions, which are profiled if
+	 * profiling is on
+	 */
+	private static final Set<EngineCommands> PROFILED_COMMANDS = EnumSet.of(EngineCommands.EXECUTE,
+		EngineCommands.EVALUATE, EngineCommands.EVALUATE_COMPILED, EngineCommands.EVALUATE_BATCH,
+		EngineCommands.EVALUATE_REF, EngineCommands.CALL);
 	
 	/**
 	 * @author Lee Kamentsky
@@ -97,11 +137,19 @@ public class CPythonScriptEngine extends AbstractScriptEngine {
 		NEW_ENGINE_RESULT,
 		/**
 		 * Sent via the responseQueue: indicates successful script execution
+		 * 
+		 * The payload's first argument is null. The second and third hold
+		 * the changes to the script's local context, as for EVALUATE_RESULT.
 		 */
 		EXECUTION,
 		/**
 		 * Sent via the responseQueue: the result of an evaluation
 		 * The payload contains the result
+		 * 
+		 * The payload's second argument is a {@code Map<String, Object>} of
+		 * the names that the script created or rebound and their values.
+		 * The payload's third argument is a {@code List<String>} of
+		 * the names that the script deleted.
 		 */
 		EVALUATE_RESULT,
 		/**
@@ -111,18 +159,149 @@ public class CPythonScriptEngine extends AbstractScriptEngine {
 		EXCEPTION,
 		/**
 		 * Sent via the requestQueue: close and destroy the Python side of the engine
-		 * There is no response.
+		 * The Python side acknowledges with a CLOSE_ENGINE on the responseQueue.
 		 */
 		CLOSE_ENGINE,
 		/**
 		 * Sent when closing the service
 		 */
-		CLOSE_SERVICE
+		CLOSE_SERVICE,
+		/**
+		 * Sent via the engineRequestQueue once no engines are left: free
+		 * the caches and idle worker processes of the Python side. Python
+		 * and its service thread keep running. The response is an
+		 * EVALUATE_RESULT on the engineResponseQueue.
+		 */
+		TRIM,
+		/**
+		 * Sent via the requestQueue: compile a script for later evaluation
+		 * 
+		 * The payload's first argument is the script to be compiled.
+		 * The payload's second argument is the script's file name or null.
+		 */
+		COMPILE,
+		/**
+		 * Sent via the responseQueue: the result of a COMPILE request
+		 * 
+		 * The payload contains the compiled script's ID.
+		 */
+		COMPILE_RESULT,
+		/**
+		 * Sent via the requestQueue: evaluate a compiled script
+		 * 
+		 * The payload's first argument is the ID from the COMPILE_RESULT.
+		 * The payload's second argument is a {@code Map<String, Object>} that's
+		 * used to populate the local context of the script evaluation.
+		 * The response is an EVALUATE_RESULT.
+		 */
+		EVALUATE_COMPILED,
+		/**
+		 * Sent via the requestQueue: evaluate a script once per input
+		 * 
+		 * The payload's first argument is the script.
+		 * The payload's second argument is either a {@code List} of
+		 * {@code Map<String, Object>}, one per evaluation, or a
+		 * {@code Map<String, Object>} of name to a {@code List} or primitive
+		 * array holding one value per evaluation.
+		 * The payload's third argument is the script's file name or null.
+		 * The response is an EVALUATE_BATCH_RESULT.
+		 */
+		EVALUATE_BATCH,
+		/**
+		 * Sent via the responseQueue: the result of an EVALUATE_BATCH request
+		 * 
+		 * The payload contains a {@code List} of the results, with a
+		 * ScriptException in place of the result of an evaluation that failed.
+		 */
+		EVALUATE_BATCH_RESULT,
+		/**
+		 * Sent via the requestQueue: evaluate a script, as for EVALUATE,
+		 * returning the result as a {@link PyObjectRef}
+		 */
+		EVALUATE_REF,
+		/**
+		 * Sent via the requestQueue: get the object held by a PyObjectRef
+		 * 
+		 * The payload's first argument is the PyObjectRef.
+		 * The payload's second argument is a Python index expression for
+		 * an item or slice of the object or null for the whole object.
+		 * The payload's third argument is a Boolean that is true to return
+		 * the item as a new PyObjectRef instead of converting it.
+		 * The response is an EVALUATE_RESULT.
+		 */
+		GET_REF,
+		/**
+		 * Sent via the requestQueue: release the objects held by the
+		 * PyObjectRefs in the payload. The response is an EVALUATE_RESULT.
+		 */
+		RELEASE_REFS,
+		/**
+		 * Sent via the requestQueue: clear the engine's Python namespace.
+		 * The response is an EVALUATE_RESULT.
+		 */
+		RESET,
+		/**
+		 * Sent via the requestQueue: count the Java references that the
+		 * Python side holds. The response is an EVALUATE_RESULT whose
+		 * result is a map of count name to count.
+		 */
+		REFERENCE_COUNTS,
+		/**
+		 * Sent via the requestQueue: send what the engine's scripts print
+		 * to the {@link CPythonOutput} in the payload or, if the payload is
+		 * empty, to the process's standard streams. The response is an
+		 * EVALUATE_RESULT.
+		 */
+		SET_OUTPUT,
+		/**
+		 * Sent via the requestQueue: call a Python function
+		 * 
+		 * The payload's first argument is the {@link PyFunction}.
+		 * The payload's second argument is a Boolean that is true for a
+		 * batch call, whose only argument is a {@code double[]} or a direct
+		 * {@code DoubleBuffer}.
+		 * The rest of the payload are the function's arguments.
+		 * The response is an EVALUATE_RESULT whose result is the function's
+		 * result or, for a batch call of a {@code double[]}, a new
+		 * {@code double[]} of the function's output.
+		 */
+		CALL
 		
 	};
 	public static class Message {
 		final public EngineCommands command;
 		final public List<Object> payload;
+		/**
+		 * Identifies a request. The Python side gives a response the ID
+		 * of its request.
+		 */
+		public long id;
+		/**
+		 * When the request was sent, from {@link System#nanoTime()}, or 0
+		 * if the request isn't timed
+		 */
+		public long sent;
+		/**
+		 * The durations of the request's stages, set by the Python side on
+		 * the response. See {@link CPythonStatistics.Stage}.
+		 */
+		public long[] timings;
+		/**
+		 * How to profile the request, or null not to. Set by the engine.
+		 */
+		public CPythonProfile.Mode profileMode;
+		/**
+		 * The engine that sent the request, set by the engine. The
+		 * {@link PyFunction}s that a script exports while the request is
+		 * handled belong to it. The Python side only holds it for the
+		 * request, so an engine that isn't closed can still be collected.
+		 */
+		public CPythonScriptEngine engine;
+		/**
+		 * The profile of the request, set by the Python side on the
+		 * response if the request was profiled
+		 */
+		public CPythonProfile profile;
 		public Message(EngineCommands command, List<Object> payload) {
 			this.command = command;
 			this.payload = payload;
@@ -132,57 +311,526 @@ public class CPythonScriptEngine extends AbstractScriptEngine {
 		 */
 		@Override
 		public String toString() {
-			return String.format("Command=%s, payload=%s", command, payload.toString() );
+			return String.format("Command=%s, id=%d, payload=%s", command, id, payload.toString() );
 		}
 	}
 	
+	/**
+	 * Create an engine that runs scripts on a worker leased from the pool
+	 * that the JVM's contexts share
+	 * 
+	 * @throws InterruptedException
+	 * @throws IllegalStateException if Python has not been started, or if
+	 *         no thread could be leased from the pool in time
+	 * @deprecated Get engines from the CPython script language, which
+	 *             starts Python, or use
+	 *             {@link #CPythonScriptEngine(CPythonEnginePool)}.
+	 */
+	@Deprecated
 	public CPythonScriptEngine() throws InterruptedException {
-		engineRequestQueue.put(new Message(EngineCommands.NEW_ENGINE, Arrays.asList((Object)requestQueue, (Object)responseQueue)));
-		engineResponseQueue.take();
+		this(sharedPool());
+	}
+
+	private static CPythonEnginePool sharedPool() {
+		final CPythonEnginePool pool = CPythonRuntime.getPool();
+		if (pool == null) {
+			throw new IllegalStateException("Python has not been started by the CPython script language");
+		}
+		return pool;
+	}
+
+	/**
+	 * Create an engine that runs scripts on a worker leased from a pool
+	 * 
+	 * @param pool the pool of Python engine threads
+	 * @throws InterruptedException
+	 * @throws IllegalStateException if no thread could be leased from the
+	 *         pool in time (see {@link CPythonEnginePool})
+	 */
+	public CPythonScriptEngine(final CPythonEnginePool pool) throws InterruptedException {
+		this.pool = pool;
+		worker = pool.lease();
 		engineScopeBindings = new SimpleBindings();
+		try {
+			submit(new Message(EngineCommands.SET_OUTPUT, Collections.singletonList((Object)new CPythonOutput(this))));
+		} catch (ScriptException e) {
+			// Not reached: the engine has its worker
+		}
+	}
+
+	/**
+	 * @return the latency histograms of this engine's requests. They are
+	 *         empty if the {@code scijava.cpython.statistics} system
+	 *         property is false.
+	 */
+	public CPythonStatistics getStatistics() {
+		return statistics;
+	}
+
+	/**
+	 * Profile the engine's scripts and function calls from now on
+	 * 
+	 * @param mode how to profile them or null to stop profiling
+	 * @see #getLastProfile()
+	 */
+	public void setProfileMode(final CPythonProfile.Mode mode) {
+		profileMode = mode;
+	}
+
+	/**
+	 * @return how the engine's scripts are profiled or null if they aren't
+	 */
+	public CPythonProfile.Mode getProfileMode() {
+		return profileMode;
+	}
+
+	/**
+	 * @return the profile of the last script or function call that was
+	 *         profiled, or null if there hasn't been one
+	 */
+	public CPythonProfile getLastProfile() {
+		return lastProfile;
+	}
+
+	/**
+	 * Clear the Python namespace that the engine's scripts share. The next
+	 * script starts with only the bindings.
+	 * 
+	 * @throws ScriptException
+	 */
+	public void reset() throws ScriptException {
+		eval(new Message(EngineCommands.RESET, Collections.emptyList()));
+	}
+
+	/**
+	 * Count the Java references that the Python side holds, e.g. to check
+	 * that they stay flat over a long run. The counts are:
+	 * <ul>
+	 * <li>{@code java_objects}: the global references held by Python
+	 * objects, for all engines</li>
+	 * <li>{@code cached_classes} and {@code class_infos}: the classes whose
+	 * handles and reflection metadata are cached</li>
+	 * <li>{@code object_refs}: the objects held for {@link PyObjectRef}s, for
+	 * all engines</li>
+	 * <li>{@code dead_objects}: the global references of freed Python
+	 * objects that are waiting to be deleted</li>
+	 * <li>{@code exported_buffers}: the numpy arrays shared with direct
+	 * buffers that have not been garbage collected</li>
+	 * <li>{@code local_frames}: the JNI local reference frames in use, one
+	 * per request being handled, including this one</li>
+	 * <li>{@code local_frames_pushed}: the frames used so far</li>
+	 * <li>{@code open_refs}: this engine's open {@link PyObjectRef}s</li>
+	 * </ul>
+	 * Counting the global references walks all of the Python objects, so
+	 * this is for diagnostics, not for every script.
+	 * 
+	 * @return the counts by name
+	 * @throws ScriptException
+	 */
+	public Map<String, Long> getReferenceCounts() throws ScriptException {
+		final Map<?, ?> counts = (Map<?, ?>) eval(new Message(EngineCommands.REFERENCE_COUNTS, Collections.emptyList()));
+		final Map<String, Long> result = new TreeMap<String, Long>();
+		for (final Map.Entry<?, ?> entry : counts.entrySet()) {
+			result.put(entry.getKey().toString(), ((Number) entry.getValue()).longValue());
+		}
+		result.put("open_refs", (long) refs.size());
+		return result;
+	}
+
+	/**
+	 * Return this engine's Python thread to the pool. The engine can't be
+	 * used afterwards. The engine's namespace is cleared, the objects
+	 * held by its open {@link PyObjectRef}s are released and its scripts'
+	 * output no longer goes to its context's writers.
+	 */
+	public synchronized void close() {
+		if (worker != null) {
+			if (!refs.isEmpty()) {
+				final List<PyObjectRef> open = new ArrayList<PyObjectRef>(refs);
+				refs.removeAll(open);
+				for (final PyObjectRef ref : open) {
+					ref.invalidate();
+				}
+				try {
+					eval(new Message(EngineCommands.RELEASE_REFS, new ArrayList<Object>(open)));
+				} catch (ScriptException e) {
+					// The worker is going back to the pool regardless
+				}
+			}
+			try {
+				reset();
+				eval(new Message(EngineCommands.SET_OUTPUT, Collections.emptyList()));
+			} catch (ScriptException e) {
+				// As above
+			}
+			pool.release(worker);
+			worker = null;
+		}
 	}
 	/**
 	 * Tell the Python side that the service is finished
+	 * 
 	 * @throws InterruptedException
+	 * @deprecated The service thread is shared by all of the JVM's contexts
+	 *             and keeps running; {@link CPythonScriptLanguage#release()}
+	 *             gives back a context's use of it.
 	 */
+	@Deprecated
 	static void closeService() throws InterruptedException {
 		engineRequestQueue.put(new Message(EngineCommands.CLOSE_SERVICE, Collections.emptyList()));
 	}
+
+	/**
+	 * Tell the Python side to free what it keeps for engines, once there
+	 * are none
+	 * @throws InterruptedException
+	 */
+	static void trimService() throws InterruptedException {
+		synchronized (engineRequestQueue) {
+			engineRequestQueue.put(new Message(EngineCommands.TRIM, Collections.emptyList()));
+			engineResponseQueue.take();
+		}
+	}
 	@Override
 	public Object eval(String script) throws ScriptException {
-		// TODO: Populate context with current input bindings
 		final Message request = new Message(EngineCommands.EVALUATE, Arrays.asList((Object)script, (Object)engineScopeBindings));
 		return eval(request);
 	}
 	/**
+	 * Evaluate a script without waiting for the result
+	 * 
+	 * Several evaluations can be in flight at once. They run in the order
+	 * they were submitted. If the engine already has the maximum number
+	 * in flight (see {@link CPythonEnginePool}), this waits until one
+	 * completes.
+	 * 
+	 * @param script the script to evaluate
+	 * @return a future that is completed with the value of the script's
+	 *         trailing expression or with the ScriptException it raised.
+	 *         The engine scope bindings are updated before the future
+	 *         completes.
+	 * @throws ScriptException if the engine is closed or interrupted
+	 */
+	public CompletableFuture<Object> evalAsync(final String script) throws ScriptException {
+		return evalAsync(script, getBindings(ScriptContext.ENGINE_SCOPE));
+	}
+
+	/**
+	 * Evaluate a script with the given bindings without waiting for the
+	 * result
+	 * 
+	 * @param script the script to evaluate
+	 * @param bindings the bindings used to populate the script's local
+	 *                 context. They are updated before the future completes.
+	 * @return a future, as for {@link #evalAsync(String)}
+	 * @throws ScriptException if the engine is closed or interrupted
+	 */
+	public CompletableFuture<Object> evalAsync(final String script, final Bindings bindings) throws ScriptException {
+		return submit(new Message(EngineCommands.EVALUATE, Arrays.asList((Object)script, (Object)bindings)));
+	}
+
+	/**
+	 * Evaluate a script, keeping its result on the Python side
+	 * 
+	 * @param script the script to evaluate
+	 * @return a handle to the value of the script's trailing expression,
+	 *         which should be closed when no longer needed
+	 * @throws ScriptException
+	 */
+	public PyObjectRef evalRef(final String script) throws ScriptException {
+		return evalRef(script, getBindings(ScriptContext.ENGINE_SCOPE));
+	}
+
+	/**
+	 * Evaluate a script with the given bindings, keeping its result on the
+	 * Python side
+	 * 
+	 * @param script the script to evaluate
+	 * @param bindings the bindings used to populate the script's local context
+	 * @return a handle, as for {@link #evalRef(String)}
+	 * @throws ScriptException
+	 */
+	public PyObjectRef evalRef(final String script, final Bindings bindings) throws ScriptException {
+		return adopt((PyObjectRef) eval(new Message(EngineCommands.EVALUATE_REF,
+			Arrays.asList((Object)script, (Object)bindings))));
+	}
+
+	/**
+	 * Evaluate a script whose result is a Python callable, e.g. a function
+	 * or a lambda, keeping the callable on the Python side
+	 * 
+	 * @param script the script to evaluate
+	 * @return a handle to the callable, which should be closed when no
+	 *         longer needed
+	 * @throws ScriptException if the script fails or its result is not
+	 *         callable
+	 */
+	public PyFunction evalFunction(final String script) throws ScriptException {
+		final PyObjectRef ref = evalRef(script);
+		if (ref instanceof PyFunction) return (PyFunction) ref;
+		ref.close();
+		throw new ScriptException("The script's result, a " + ref.getTypeName() + ", is not callable");
+	}
+
+	/**
+	 * Call the function held by a PyFunction
+	 * <p>
+	 * On the engine's own Python thread, i.e. from Java code that a script
+	 * called, the engine is busy with that script and can't take requests,
+	 * so the function is called directly instead.
+	 * </p>
+	 * 
+	 * @see PyFunction#call(Object...)
+	 * @see PyFunction#apply(double[])
+	 */
+	Object call(final PyFunction function, final boolean batch, final Object... args) throws ScriptException {
+		final List<Object> payload = new ArrayList<Object>(args.length + 2);
+		payload.add(function);
+		payload.add(batch);
+		payload.addAll(Arrays.asList(args));
+		final Message request = new Message(EngineCommands.CALL, payload);
+		request.engine = this;
+		final CPythonEngineWorker worker = this.worker;
+		if (worker != null && worker.isCurrentThread()) {
+			final Object[] response = new Object[1];
+			CPythonStartup.call(request, response);
+			return getResult(request, (Message) response[0]);
+		}
+		return eval(request);
+	}
+
+	/**
+	 * Get the object held by a PyObjectRef or an item of it
+	 * 
+	 * @see PyObjectRef#get(String)
+	 * @see PyObjectRef#getRef(String)
+	 */
+	Object getRef(final PyObjectRef ref, final String index, final boolean asRef) throws ScriptException {
+		final Object result = eval(new Message(EngineCommands.GET_REF,
+			Arrays.asList((Object)ref, (Object)index, (Object)asRef)));
+		return asRef ? adopt((PyObjectRef) result) : result;
+	}
+
+	/**
+	 * Release the objects held by closed PyObjectRefs
+	 */
+	void releaseRefs(final List<PyObjectRef> closed) {
+		if (!refs.removeAll(closed)) return;
+		try {
+			eval(new Message(EngineCommands.RELEASE_REFS, new ArrayList<Object>(closed)));
+		} catch (ScriptException e) {
+			// The objects are released when the engine is closed
+		}
+	}
+
+	/**
+	 * Make the engine the owner of a PyObjectRef, which it closes when it
+	 * is closed. The Python side calls this for exported functions.
+	 */
+	PyObjectRef adopt(final PyObjectRef ref) {
+		ref.adopt(this);
+		refs.add(ref);
+		return ref;
+	}
+
+	/**
+	 * Send a request to the Python side and wait for its response
+	 * 
 	 * @param request
 	 * @return
 	 * @throws ScriptException
 	 */
-	private Object eval(final Message request) throws ScriptException {
+	Object eval(final Message request) throws ScriptException {
 		try {
-			requestQueue.put(request);
-			Message result = responseQueue.take();
-			if (result.command == EngineCommands.EXCEPTION) {
-				if (result.payload.size() == 1) {
-					Object oMessage = result.payload.get(0);
-					if (oMessage instanceof String) {
-						throw new ScriptException((String)oMessage);
-					} else if (oMessage instanceof Exception) {
-						throw new ScriptException((Exception)oMessage);
-					}
-				}
-				throw new ScriptException("Exception thrown but unknown format");
+			return submit(request).get();
+		} catch (ExecutionException e) {
+			if (e.getCause() instanceof ScriptException) {
+				throw (ScriptException)e.getCause();
 			}
-			// TODO: Populate bindings with the context from the request's map
-			return result.payload.get(0);
+			throw new ScriptException(e);
+		} catch (InterruptedException e) {
+			throw new ScriptException("Operation interrupted");
+		}
+	}
+
+	/**
+	 * Send a request to the Python side
+	 * 
+	 * If the request carries bindings, the changes the script made to its
+	 * local context are copied back into them when the response arrives.
+	 * 
+	 * @param request
+	 * @return a future that is completed with the result from the response
+	 *         or with a ScriptException
+	 * @throws ScriptException
+	 */
+	private CompletableFuture<Object> submit(final Message request) throws ScriptException {
+		final CPythonEngineWorker worker = this.worker;
+		if (worker == null) {
+			throw new ScriptException("The engine is closed");
+		}
+		final CompletableFuture<Message> response;
+		if (CPythonStatistics.ENABLED) {
+			request.sent = System.nanoTime();
+		}
+		if (PROFILED_COMMANDS.contains(request.command)) {
+			request.profileMode = profileMode;
+		}
+		request.engine = this;
+		try {
+			response = worker.submit(request);
 		} catch (InterruptedException e) {
 			throw new ScriptException("Operation interrupted");
 		}
+		final CompletableFuture<Object> future = new CompletableFuture<Object>();
+		response.whenComplete((result, t) -> {
+			if (request.sent != 0) {
+				statistics.record(CPythonStatistics.Stage.ROUND_TRIP, System.nanoTime() - request.sent);
+				if (result != null && result.timings != null) {
+					statistics.record(result.timings);
+				}
+			}
+			if (result != null && result.profile != null) {
+				lastProfile = result.profile;
+			}
+			try {
+				if (t != null) {
+					throw new ScriptException(t.getMessage());
+				}
+				future.complete(getResult(request, result));
+			} catch (ScriptException e) {
+				future.completeExceptionally(e);
+			}
+		});
+		return future;
+	}
+
+	private static Object getResult(final Message request, final Message result) throws ScriptException {
+		if (result.command == EngineCommands.EXCEPTION) {
+			if (result.payload.size() == 1) {
+				Object oMessage = result.payload.get(0);
+				if (oMessage instanceof String) {
+					throw new ScriptException((String)oMessage);
+				} else if (oMessage instanceof ScriptException) {
+					// Made by the Python side with the script's file name and line
+					final ScriptException e = (ScriptException)oMessage;
+					e.fillInStackTrace();
+					throw e;
+				} else if (oMessage instanceof Exception) {
+					throw new ScriptException((Exception)oMessage);
+				}
+			}
+			throw new ScriptException("Exception thrown but unknown format");
+		}
+		if ((result.command == EngineCommands.EVALUATE_RESULT || result.command == EngineCommands.EXECUTION) &&
+			result.payload.size() == 3) {
+			update((Bindings)request.payload.get(1), result.payload.get(1), result.payload.get(2));
+		}
+		return result.payload.get(0);
 	}
 
 	@Override
 	public Object eval(Reader reader) throws ScriptException {
+		return eval(read(reader));
+	}
+
+	/**
+	 * Compile a script on the Python side.
+	 * 
+	 * The compiled code stays with the engine, so evaluating the returned
+	 * script only sends its ID and the bindings.
+	 */
+	@Override
+	public CompiledScript compile(String script) throws ScriptException {
+		final Message request = new Message(EngineCommands.COMPILE, Arrays.asList((Object)script, get(ScriptEngine.FILENAME)));
+		return new CPythonCompiledScript(this, (String)eval(request));
+	}
+
+	@Override
+	public CompiledScript compile(Reader reader) throws ScriptException {
+		return compile(read(reader));
+	}
+
+	/**
+	 * Evaluate a script compiled by {@link #compile(String)}
+	 * 
+	 * @param id the ID of the compiled script
+	 * @param bindings the bindings used to populate the script's local context
+	 * @return the value of the script's trailing expression
+	 * @throws ScriptException
+	 */
+	Object evalCompiled(final String id, final Bindings bindings) throws ScriptException {
+		final Message request = new Message(EngineCommands.EVALUATE_COMPILED, Arrays.asList((Object)id, (Object)bindings));
+		return eval(request);
+	}
+
+	/**
+	 * Apply the changes a script made to its local context
+	 * 
+	 * @param bindings the bindings that populated the script's context
+	 * @param values a map of the names that the script created or rebound
+	 *               to their new values
+	 * @param removed a list of the names that the script deleted
+	 */
+	@SuppressWarnings("unchecked")
+	private static void update(final Bindings bindings, final Object values, final Object removed) {
+		bindings.putAll((Map<String, Object>)values);
+		for (final Object name : (List<Object>)removed) {
+			bindings.remove(name);
+		}
+	}
+
+	/**
+	 * Called by the Python side to tell whether a binding still has the
+	 * value that it converted, in which case it need not be converted again
+	 */
+	static boolean isBound(final Map<?, ?> bindings, final Object name, final Object value) {
+		return bindings.get(name) == value;
+	}
+
+	/**
+	 * Evaluate a script once for each of a list of inputs
+	 * 
+	 * The script is compiled once and the whole batch takes one round trip
+	 * to the Python side. Each evaluation's local context is populated from
+	 * its input only and nothing is written back to the inputs.
+	 * 
+	 * @param script the script to evaluate
+	 * @param inputs the bindings for each evaluation
+	 * @return the value of the script's trailing expression for each input.
+	 *         If an evaluation raised an exception, its result is a
+	 *         {@link ScriptException} and the rest of the batch is still
+	 *         evaluated.
+	 * @throws ScriptException if the script could not be compiled
+	 */
+	public List<Object> evalBatch(final String script, final List<? extends Map<String, ?>> inputs) throws ScriptException {
+		return evalBatch(script, (Object)inputs);
+	}
+
+	/**
+	 * Evaluate a script once for each row of a table of inputs
+	 * 
+	 * The table is passed by column: each binding name maps to a
+	 * {@code List} or primitive array with one value per evaluation. Primitive
+	 * arrays are converted to numpy in one step.
+	 * 
+	 * @param script the script to evaluate
+	 * @param columns the values of each binding, one per evaluation. All of
+	 *                the columns must have the same length.
+	 * @return the results, as for {@link #evalBatch(String, List)}
+	 * @throws ScriptException if the script could not be compiled
+	 */
+	public List<Object> evalBatch(final String script, final Map<String, ?> columns) throws ScriptException {
+		return evalBatch(script, (Object)columns);
+	}
+
+	@SuppressWarnings("unchecked")
+	private List<Object> evalBatch(final String script, final Object inputs) throws ScriptException {
+		final Message request = new Message(EngineCommands.EVALUATE_BATCH, Arrays.asList((Object)script, inputs, get(ScriptEngine.FILENAME)));
+		return (List<Object>)eval(request);
+	}
+
+	private static String read(final Reader reader) throws ScriptException {
 		StringBuilder buf = new StringBuilder();
 		char [] cbuf = new char [65536];
 		while (true) {
@@ -194,15 +842,39 @@ public class CPythonScriptEngine extends AbstractScriptEngine {
 				throw new ScriptException(e);
 			}
 		}
-		return eval(buf.toString());
+		return buf.toString();
 	}
 
-	/* (non-Javadoc)
-	 * @see java.lang.Object#finalize()
+	/**
+	 * Give the worker of an engine that was not closed back to the pool.
+	 * <p>
+	 * This runs on the finalizer thread, so unlike {@link #close()} it
+	 * doesn't wait for the Python side: the requests that clean up after
+	 * the engine are queued ahead of the next engine's, and their
+	 * responses are dropped. They don't refer to the engine, which is
+	 * not brought back to life.
+	 * </p>
 	 */
 	@Override
 	protected void finalize() throws Throwable {
-		requestQueue.put(new Message(EngineCommands.CLOSE_ENGINE, Collections.emptyList()));
-		super.finalize();
+		try {
+			final CPythonEngineWorker worker = this.worker;
+			if (worker != null) {
+				this.worker = null;
+				final List<Object> open = new ArrayList<Object>(refs);
+				refs.clear();
+				for (final Object ref : open) {
+					((PyObjectRef) ref).invalidate();
+				}
+				if (!open.isEmpty()) {
+					worker.post(new Message(EngineCommands.RELEASE_REFS, open));
+				}
+				worker.post(new Message(EngineCommands.RESET, Collections.emptyList()));
+				worker.post(new Message(EngineCommands.SET_OUTPUT, Collections.emptyList()));
+				pool.release(worker);
+			}
+		} finally {
+			super.finalize();
+		}
 	}
 }
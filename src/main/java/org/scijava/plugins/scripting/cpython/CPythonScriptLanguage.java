@@ -32,9 +32,7 @@
 package org.scijava.plugins.scripting.cpython;
 
 import java.io.IOException;
-import java.io.InputStream;
-import java.io.InputStreamReader;
-import java.io.Reader;
+import java.util.Map;
 
 import javax.script.ScriptEngine;
 
@@ -52,38 +50,18 @@ import org.scijava.script.ScriptLanguage;
  */
 @Plugin(type = ScriptLanguage.class)
 public class CPythonScriptLanguage extends AbstractScriptLanguage {
-	private static final String PYTHON_SCRIPT = "scripting-cpython.py";
 	@Parameter
 	LogService logService;
 	
 	boolean initialized=false;
 	
+	private CPythonEnginePool pool;
+	
 	@Override
 	public ScriptEngine getScriptEngine() {
-		synchronized(this) {
-			if (! initialized) {
-				final InputStream is = this.getClass().getClassLoader().getResourceAsStream(PYTHON_SCRIPT);
-				final Reader rdr = new InputStreamReader(is);
-				final StringBuffer sbScript = new StringBuffer();
-				final char [] buffer = new char[65536];
-				while (true) {
-					try {
-						final int nBytes = rdr.read(buffer);
-						if (nBytes <= 0) break;
-						sbScript.append(buffer, 0, nBytes);
-					} catch (IOException e) {
-						logService.warn(String.format(
-								"Unexpected read failure in CPython script language for %s resource: %s",
-								PYTHON_SCRIPT, e.getMessage()));
-						return null;
-					}
-				}
-				CPythonStartup.initializePythonThread(sbScript.toString());
-				initialized=true;
-			}
-		}
+		if (! initializePython()) return null;
 		try {
-			CPythonScriptEngine engine =  new CPythonScriptEngine();
+			CPythonScriptEngine engine =  new CPythonScriptEngine(pool);
 			getContext().inject(engine);
 			return engine;
 			
@@ -93,6 +71,63 @@ public class CPythonScriptLanguage extends AbstractScriptLanguage {
 		}
 	}
 
+	/**
+	 * Start Python and the engine pool, if they are not started yet, and
+	 * wait for the pool's first engine thread. {@link CPythonService} can
+	 * do this in the background when the context is created, so that the
+	 * first script doesn't wait for Python to start.
+	 * <p>
+	 * Python and the pool are shared by all contexts (see
+	 * {@link CPythonRuntime}), so if another context has started them,
+	 * this only takes a reference, which {@link #release()} gives back.
+	 * </p>
+	 * 
+	 * @return false if the Python side could not be started
+	 */
+	public synchronized boolean initializePython() {
+		if (! initialized) {
+			try {
+				pool = CPythonRuntime.acquire(logService);
+			} catch (IOException e) {
+				logService.warn(String.format(
+						"Unexpected read failure in CPython script language for %s resource: %s",
+						CPythonBootstrap.PYTHON_SCRIPT, e.getMessage()));
+				return false;
+			}
+			initialized=true;
+		}
+		return true;
+	}
+
+	/**
+	 * Give back this language's reference to the shared Python runtime.
+	 * When no context uses it any more, its engine threads are stopped and
+	 * the Python side frees its caches. Python itself keeps running, so a
+	 * later {@link #initializePython()} is quick.
+	 */
+	public synchronized void release() {
+		if (! initialized) return;
+		initialized=false;
+		pool = null;
+		CPythonRuntime.release();
+	}
+
+	/**
+	 * @return the time, in nanoseconds, that each phase of starting Python
+	 *         took, or null if Python has not been started
+	 */
+	public Map<CPythonBootstrap.Phase, Long> getStartupTimings() {
+		return CPythonRuntime.getStartupTimings();
+	}
+
+	/**
+	 * @return the pool of Python threads that run this language's engines,
+	 *         or null if no engine has been created yet
+	 */
+	public synchronized CPythonEnginePool getEnginePool() {
+		return pool;
+	}
+
 	/* (non-Javadoc)
 	 * @see imagej.script.AbstractScriptLanguage#getEngineName()
 	 */
@@ -114,7 +149,7 @@ public class CPythonScriptLanguage extends AbstractScriptLanguage {
 	 */
 	@Override
 	protected void finalize() throws Throwable {
-		CPythonScriptEngine.closeService();
+		release();
 		super.finalize();
 	}
 
@@ -30,6 +30,9 @@
  */
 package org.scijava.plugins.scripting.cpython;
 
+import java.nio.Buffer;
+import java.nio.ByteBuffer;
+
 public class CPythonStartup {
 
 	static {
@@ -42,4 +45,61 @@ public class CPythonStartup {
 	 * @param pythonCode the Python code to execute
 	 */
 	public native static void initializePythonThread(final String pythonCode);
+
+	/**
+	 * Starts the Python interpreter, if it is not running yet, and lets go
+	 * of the GIL so that other threads can run Python.
+	 */
+	native static void initializePython();
+
+	/**
+	 * Gets the version of the Python that the library is linked to. This
+	 * works before Python is started.
+	 */
+	native static String getPythonVersion();
+
+	/**
+	 * Compiles Python code to a module's code object.
+	 * 
+	 * @param pythonCode the Python code to compile
+	 * @param fileName the file name for the code's tracebacks
+	 * @return the code object, serialized with marshal
+	 */
+	native static byte[] compile(final String pythonCode, final String fileName);
+
+	/**
+	 * Runs compiled Python code as the {@code __main__} module.
+	 * 
+	 * @param compiled code compiled by {@link #compile(String, String)}
+	 * @return false if the code was not compiled by this version of Python,
+	 *         in which case it was not run
+	 */
+	native static boolean runCompiled(final byte[] compiled);
+
+	/**
+	 * Gets the memory address of a direct buffer.
+	 * 
+	 * @param buffer a direct buffer
+	 * @return the address of the buffer's memory or 0 if it is not direct
+	 */
+	native static long getDirectBufferAddress(final Buffer buffer);
+
+	/**
+	 * Makes a direct buffer for memory allocated elsewhere.
+	 * 
+	 * @param address the address of the memory
+	 * @param capacity the size of the memory in bytes
+	 * @return a direct buffer that reads and writes the memory
+	 */
+	native static ByteBuffer newDirectByteBuffer(final long address, final long capacity);
+
+	/**
+	 * Handles an engine request on the current thread, which must be a
+	 * Python engine thread that is running Java code, rather than through
+	 * the engine's queue.
+	 * 
+	 * @param request the request
+	 * @param response an array whose first element is set to the response
+	 */
+	native static void call(final CPythonScriptEngine.Message request, final Object[] response);
 }
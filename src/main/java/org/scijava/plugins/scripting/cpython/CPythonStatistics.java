@@ -0,0 +1,200 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.Arrays;
+
+/**
+ * Latency histograms for the stages of an engine's requests.
+ * <p>
+ * The Python side times each request's stages and sends the durations
+ * with the response; the Java side adds the round trip. Each stage has a
+ * histogram of power-of-two nanosecond buckets: bucket {@code i} counts
+ * durations of at least {@code 2^(i-1)} and less than {@code 2^i}
+ * nanoseconds. Recording a duration is a few array updates.
+ * </p>
+ * <p>
+ * Setting the {@code scijava.cpython.statistics} system property to
+ * {@code false} turns the timing off on both sides.
+ * </p>
+ */
+public class CPythonStatistics {
+
+	/** Whether requests are timed */
+	static final boolean ENABLED =
+		!"false".equalsIgnoreCase(System.getProperty("scijava.cpython.statistics"));
+
+	/**
+	 * The stages of a request, in the order of the durations sent by the
+	 * Python side
+	 */
+	public static enum Stage {
+		/** From sending the request to the Python side taking it */
+		QUEUE_WAIT,
+		/** Reading the command and payload of the request */
+		TAKE,
+		/** Converting the bindings to the script's locals */
+		CONTEXT,
+		/** Parsing and compiling the script, or finding it in the cache */
+		COMPILE,
+		/** Running the script */
+		EXEC,
+		/** Converting the result and changed locals for Java */
+		MARSHAL,
+		/** Putting the response on the queue, reported with the next response */
+		PUT,
+		/**
+		 * Waiting for the GIL after taking the request, part of QUEUE_WAIT.
+		 * Long waits mean that the engine threads contend for the GIL.
+		 */
+		GIL_WAIT,
+		/** From sending the request to receiving the response, in Java */
+		ROUND_TRIP
+	}
+
+	private static final int N_BUCKETS = 64;
+
+	private final long[][] buckets = new long[Stage.values().length][N_BUCKETS];
+	private final long[] counts = new long[Stage.values().length];
+	private final long[] totals = new long[Stage.values().length];
+	private final long[] maxima = new long[Stage.values().length];
+	private long start = System.nanoTime();
+
+	/**
+	 * Record the duration of a stage
+	 * 
+	 * @param stage the stage
+	 * @param nanos the duration in nanoseconds
+	 */
+	public synchronized void record(final Stage stage, final long nanos) {
+		final int i = stage.ordinal();
+		buckets[i][Math.min(64 - Long.numberOfLeadingZeros(nanos), N_BUCKETS - 1)]++;
+		counts[i]++;
+		totals[i] += nanos;
+		maxima[i] = Math.max(maxima[i], nanos);
+	}
+
+	/**
+	 * Record the stage durations sent by the Python side
+	 * 
+	 * @param timings the durations in nanoseconds, in {@link Stage} order.
+	 *                Stages with no duration are not recorded.
+	 */
+	synchronized void record(final long[] timings) {
+		for (int i = 0; i < timings.length && i < Stage.ROUND_TRIP.ordinal(); i++) {
+			if (timings[i] > 0) record(Stage.values()[i], timings[i]);
+		}
+	}
+
+	/**
+	 * @return the number of durations recorded for a stage
+	 */
+	public synchronized long getCount(final Stage stage) {
+		return counts[stage.ordinal()];
+	}
+
+	/**
+	 * @return the mean duration of a stage in nanoseconds
+	 */
+	public synchronized double getMean(final Stage stage) {
+		final int i = stage.ordinal();
+		return counts[i] == 0 ? 0 : (double) totals[i] / counts[i];
+	}
+
+	/**
+	 * @return the longest duration of a stage in nanoseconds
+	 */
+	public synchronized long getMax(final Stage stage) {
+		return maxima[stage.ordinal()];
+	}
+
+	/**
+	 * Estimate a percentile of a stage's durations
+	 * 
+	 * @param stage the stage
+	 * @param percentile the percentile, from 0 to 100
+	 * @return the upper bound in nanoseconds of the histogram bucket that
+	 *         holds the percentile
+	 */
+	public synchronized long getPercentile(final Stage stage, final double percentile) {
+		final int i = stage.ordinal();
+		final double target = counts[i] * percentile / 100;
+		long seen = 0;
+		for (int bucket = 0; bucket < N_BUCKETS; bucket++) {
+			seen += buckets[i][bucket];
+			if (seen > 0 && seen >= target) {
+				return Math.min(maxima[i], bucket == 0 ? 0 : (1L << bucket) - 1);
+			}
+		}
+		return maxima[i];
+	}
+
+	/**
+	 * @return a copy of the histogram buckets of a stage
+	 */
+	public synchronized long[] getHistogram(final Stage stage) {
+		return buckets[stage.ordinal()].clone();
+	}
+
+	/**
+	 * @return the number of round trips per second since the statistics
+	 *         were created or reset
+	 */
+	public synchronized double getThroughput() {
+		final long elapsed = System.nanoTime() - start;
+		return elapsed == 0 ? 0 : counts[Stage.ROUND_TRIP.ordinal()] * 1e9 / elapsed;
+	}
+
+	/**
+	 * Forget all durations recorded so far
+	 */
+	public synchronized void reset() {
+		for (final long[] b : buckets) {
+			Arrays.fill(b, 0);
+		}
+		Arrays.fill(counts, 0);
+		Arrays.fill(totals, 0);
+		Arrays.fill(maxima, 0);
+		start = System.nanoTime();
+	}
+
+	@Override
+	public synchronized String toString() {
+		final StringBuilder sb = new StringBuilder();
+		sb.append(String.format("%-10s %10s %12s %12s %12s%n", "stage", "count", "mean (us)", "p99 (us)", "max (us)"));
+		for (final Stage stage : Stage.values()) {
+			sb.append(String.format("%-10s %10d %12.1f %12.1f %12.1f%n", stage, getCount(stage), getMean(stage) / 1e3,
+				getPercentile(stage, 99) / 1e3, getMax(stage) / 1e3));
+		}
+		sb.append(String.format("throughput: %.1f requests/s%n", getThroughput()));
+		return sb.toString();
+	}
+}
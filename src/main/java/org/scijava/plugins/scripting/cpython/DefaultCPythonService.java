@@ -0,0 +1,94 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.concurrent.Future;
+
+import org.scijava.plugin.Parameter;
+import org.scijava.plugin.Plugin;
+import org.scijava.script.ScriptLanguage;
+import org.scijava.script.ScriptService;
+import org.scijava.service.AbstractService;
+import org.scijava.service.Service;
+import org.scijava.thread.ThreadService;
+
+/**
+ * Default implementation of {@link CPythonService}.
+ */
+@Plugin(type = Service.class)
+public class DefaultCPythonService extends AbstractService implements CPythonService {
+
+	@Parameter
+	private ScriptService scriptService;
+
+	@Parameter
+	private ThreadService threadService;
+
+	private Future<?> preinitialization;
+
+	@Override
+	public void initialize() {
+		if (Boolean.getBoolean("scijava.cpython.preinit")) {
+			preinitialize();
+		}
+	}
+
+	@Override
+	public CPythonScriptLanguage getLanguage() {
+		for (final ScriptLanguage language : scriptService.getLanguages()) {
+			if (language instanceof CPythonScriptLanguage) {
+				return (CPythonScriptLanguage) language;
+			}
+		}
+		return null;
+	}
+
+	@Override
+	public synchronized Future<?> preinitialize() {
+		if (preinitialization == null) {
+			final CPythonScriptLanguage language = getLanguage();
+			if (language == null) return null;
+			preinitialization = threadService.run(new Runnable() {
+				@Override
+				public void run() {
+					language.initializePython();
+				}
+			});
+		}
+		return preinitialization;
+	}
+
+	@Override
+	public void dispose() {
+		final CPythonScriptLanguage language = getLanguage();
+		if (language != null) language.release();
+	}
+}
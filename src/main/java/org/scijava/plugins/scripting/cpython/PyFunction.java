@@ -0,0 +1,172 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.nio.DoubleBuffer;
+import java.util.function.DoubleUnaryOperator;
+import java.util.function.Function;
+
+import javax.script.ScriptException;
+
+/**
+ * A handle to a Python callable that Java can call.
+ * <p>
+ * A script makes one with {@code export_function(f)} and
+ * {@link CPythonScriptEngine#evalFunction(String)} returns one for a
+ * script whose result is callable. The function runs on the thread of
+ * the engine that made it, with the engine's namespace, so calls from
+ * several Java threads take turns. A call made on the engine's own
+ * thread, for instance by a Java method that a script passed the
+ * function to, runs directly instead of through the engine's queue.
+ * </p>
+ * <p>
+ * Each call of {@link #applyAsDouble(double)} is a round trip between
+ * Java and Python. {@link #apply(double[])} and
+ * {@link #apply(DoubleBuffer)} instead call the function once with a
+ * whole block of values as a numpy array and write its output over the
+ * values, so that per-pixel work can be done a row or a tile at a time.
+ * </p>
+ * <p>
+ * The {@link Function}, {@link DoubleUnaryOperator} and {@link Runnable}
+ * methods can't throw a {@link ScriptException}, so they throw a
+ * {@link RuntimeException} whose cause is the ScriptException. As for
+ * any {@link PyObjectRef}, the Python function is kept until the handle
+ * is closed.
+ * </p>
+ */
+public class PyFunction extends PyObjectRef implements Function<Object, Object>, DoubleUnaryOperator, Runnable {
+
+	/**
+	 * Made by the Python side
+	 */
+	PyFunction(final long handle, final String typeName) {
+		super(handle, typeName, null, null);
+	}
+
+	/**
+	 * Call the function
+	 * 
+	 * @param args the arguments, converted as bindings are
+	 * @return the function's result, converted as a script's result is
+	 * @throws ScriptException if the function raises an exception
+	 */
+	public Object call(final Object... args) throws ScriptException {
+		return owner().call(this, false, args);
+	}
+
+	/**
+	 * Call the function with one argument
+	 * 
+	 * @see #call(Object...)
+	 */
+	@Override
+	public Object apply(final Object arg) {
+		try {
+			return call(new Object[] { arg });
+		} catch (final ScriptException e) {
+			throw new RuntimeException(e);
+		}
+	}
+
+	/**
+	 * Call the function with a number, which must return a number
+	 */
+	@Override
+	public double applyAsDouble(final double operand) {
+		final Object result = apply(operand);
+		if (!(result instanceof Number)) {
+			throw new RuntimeException(new ScriptException(
+				"The Python function returned " + result + ", not a number"));
+		}
+		return ((Number) result).doubleValue();
+	}
+
+	/**
+	 * Call the function without arguments, ignoring its result
+	 */
+	@Override
+	public void run() {
+		try {
+			call(new Object[0]);
+		} catch (final ScriptException e) {
+			throw new RuntimeException(e);
+		}
+	}
+
+	/**
+	 * Call the function once with all of the values as a 1-d float64
+	 * numpy array, replacing the values with its output.
+	 * <p>
+	 * The function may return an array of the same length or a scalar,
+	 * or modify its argument in place and return None. The values are
+	 * copied to Python and the output back.
+	 * </p>
+	 * 
+	 * @param values the function's input, overwritten with its output
+	 * @return the values
+	 * @throws ScriptException if the function raises an exception
+	 */
+	public double[] apply(final double[] values) throws ScriptException {
+		final double[] output = (double[]) owner().call(this, true, values);
+		System.arraycopy(output, 0, values, 0, values.length);
+		return values;
+	}
+
+	/**
+	 * Call the function once with the buffer's remaining values as a
+	 * 1-d float64 numpy array, replacing the values with its output,
+	 * as for {@link #apply(double[])}.
+	 * <p>
+	 * A direct buffer is shared with Python, so nothing is copied. The
+	 * buffer's position and limit are not changed.
+	 * </p>
+	 * 
+	 * @param values the function's input, overwritten with its output
+	 * @return the values
+	 * @throws ScriptException if the function raises an exception
+	 */
+	public DoubleBuffer apply(final DoubleBuffer values) throws ScriptException {
+		if (values.isDirect()) {
+			owner().call(this, true, values.slice());
+		} else {
+			final double[] copy = new double[values.remaining()];
+			values.duplicate().get(copy);
+			apply(copy);
+			values.duplicate().put(copy);
+		}
+		return values;
+	}
+
+	@Override
+	public String toString() {
+		return "PyFunction[" + getHandle() + ", " + getTypeName() + "]";
+	}
+}
@@ -0,0 +1,205 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.Arrays;
+import java.util.concurrent.atomic.AtomicInteger;
+
+import javax.script.ScriptException;
+
+/**
+ * A handle to a Python object that stays on the Python side.
+ * <p>
+ * {@link CPythonScriptEngine#evalRef(String)} returns the result of a
+ * script as a handle instead of converting it, which is the way to get
+ * at results that are large, such as big numpy arrays, or that have no
+ * Java equivalent, such as dictionaries of arrays or pandas data frames.
+ * The handle tells the object's type and, for arrays, its shape and
+ * dtype. The object, or an item or slice of it, is converted only when
+ * asked for with {@link #get(String)}. A handle in the bindings of a
+ * later script stands for the Python object itself.
+ * </p>
+ * <p>
+ * The handle is reference counted: {@link #retain()} adds a reference
+ * and {@link #close()} removes one. The Python object is released when
+ * the last reference is closed or when the engine that made the handle
+ * is closed, whichever comes first.
+ * </p>
+ */
+public class PyObjectRef implements AutoCloseable {
+
+	private final long handle;
+	private final String typeName;
+	private final long[] shape;
+	private final String dtype;
+	private final AtomicInteger references = new AtomicInteger(1);
+	private volatile CPythonScriptEngine engine;
+
+	/**
+	 * Made by the Python side
+	 */
+	PyObjectRef(final long handle, final String typeName, final long[] shape, final String dtype) {
+		this.handle = handle;
+		this.typeName = typeName;
+		this.shape = shape;
+		this.dtype = dtype;
+	}
+
+	/**
+	 * @return the number that identifies the object on the Python side
+	 */
+	public long getHandle() {
+		return handle;
+	}
+
+	/**
+	 * @return the name of the object's Python type, e.g. "numpy.ndarray"
+	 */
+	public String getTypeName() {
+		return typeName;
+	}
+
+	/**
+	 * @return the object's shape, if it has one, e.g. for a numpy array or
+	 *         a pandas data frame, otherwise null
+	 */
+	public long[] getShape() {
+		return shape == null ? null : shape.clone();
+	}
+
+	/**
+	 * @return the name of the object's dtype, e.g. "float64", if it has
+	 *         one, otherwise null
+	 */
+	public String getDType() {
+		return dtype;
+	}
+
+	/**
+	 * Get the object, converted as a script's result is
+	 * 
+	 * @return the converted object
+	 * @throws ScriptException
+	 */
+	public Object get() throws ScriptException {
+		return get(null);
+	}
+
+	/**
+	 * Get an item or slice of the object, converted as a script's result
+	 * is. numpy arrays become primitive Java arrays or direct buffers.
+	 * 
+	 * @param index a Python index expression, e.g. {@code "0, 10:20"} for
+	 *              {@code o[0, 10:20]}, or null for the whole object
+	 * @return the converted item or slice
+	 * @throws ScriptException if the index is not valid for the object
+	 */
+	public Object get(final String index) throws ScriptException {
+		return owner().getRef(this, index, false);
+	}
+
+	/**
+	 * Get an item or slice of the object as a new handle, without
+	 * converting it
+	 * 
+	 * @param index a Python index expression, as for {@link #get(String)}
+	 * @return the new handle, which must be closed separately
+	 * @throws ScriptException if the index is not valid for the object
+	 */
+	public PyObjectRef getRef(final String index) throws ScriptException {
+		return (PyObjectRef) owner().getRef(this, index, true);
+	}
+
+	/**
+	 * Add a reference to the handle, to be closed separately
+	 * 
+	 * @return this handle
+	 * @throws IllegalStateException if the handle is closed
+	 */
+	public PyObjectRef retain() {
+		while (true) {
+			final int n = references.get();
+			if (n <= 0) {
+				throw new IllegalStateException("The PyObjectRef is closed");
+			}
+			if (references.compareAndSet(n, n + 1)) return this;
+		}
+	}
+
+	/**
+	 * @return true if the Python object has been released
+	 */
+	public boolean isClosed() {
+		return references.get() <= 0;
+	}
+
+	/**
+	 * Remove a reference, releasing the Python object if it was the last
+	 */
+	@Override
+	public void close() {
+		if (references.decrementAndGet() != 0) return;
+		final CPythonScriptEngine engine = this.engine;
+		if (engine != null) engine.releaseRefs(Arrays.asList(this));
+	}
+
+	/**
+	 * Give the handle to the engine that made it
+	 */
+	void adopt(final CPythonScriptEngine engine) {
+		this.engine = engine;
+	}
+
+	/**
+	 * Mark the handle closed without telling the Python side, because the
+	 * object has been released along with the engine's other handles
+	 */
+	void invalidate() {
+		references.set(0);
+		engine = null;
+	}
+
+	CPythonScriptEngine owner() throws ScriptException {
+		final CPythonScriptEngine engine = this.engine;
+		if (engine == null || isClosed()) {
+			throw new ScriptException("The PyObjectRef is closed");
+		}
+		return engine;
+	}
+
+	@Override
+	public String toString() {
+		final StringBuilder sb = new StringBuilder("PyObjectRef[").append(handle).append(", ").append(typeName);
+		if (shape != null) sb.append(", shape=").append(Arrays.toString(shape));
+		if (dtype != null) sb.append(", dtype=").append(dtype);
+		return sb.append(']').toString();
+	}
+}
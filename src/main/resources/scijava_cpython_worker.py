@@ -0,0 +1,143 @@
+'''scijava_cpython_worker.py - Run scripts in a worker process
+
+scripting-cpython is licensed under the BSD license.  See the
+accompanying file LICENSE for details.
+
+ Copyright (C) 2009 - 2014 Board of Regents of the University of
+ Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ Institute of Molecular Cell Biology and Genetics.
+ All rights reserved.
+
+A worker process of the scripting-cpython process pool runs this module
+as its main script. It takes requests from its stdin and writes the
+responses to its stdout, both pickled (see ProcessWorker in
+scripting-cpython.py). When the process pool is in use, the Python in
+the JVM loads the module too, to share arrays with the workers.
+
+The worker is started with the buffer threshold and the shared memory
+directory as its arguments.
+'''
+
+import marshal
+import os
+import sys
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+class Locals(dict):
+    '''A script's locals, recording the names that the script changes'''
+    def __init__(self):
+        dict.__init__(self)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        self.changed.add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.changed.add(key)
+        dict.__delitem__(self, key)
+
+def share_array(a, shm_dir):
+    '''Copy an array to a file in shared memory
+
+    returns the file's path, the array's dtype and shape.
+    '''
+    import numpy as np
+    fd, path = tempfile.mkstemp(prefix="scijava-cpython-", dir=shm_dir)
+    os.close(fd)
+    m = np.memmap(path, a.dtype, "w+", shape=a.shape)
+    m[...] = a
+    m.flush()
+    del m
+    return path, a.dtype.str, a.shape
+
+def script_line_number(tb, filename):
+    '''Return the line in the script where an exception was raised
+
+    :param tb: the exception's traceback
+    :param filename: the script's file name
+
+    returns -1 if the traceback doesn't pass through the script. The
+    engine threads have their own copy, in scripting-cpython.py.
+    '''
+    line_number = -1
+    while tb is not None:
+        if tb.tb_frame.f_code.co_filename == filename:
+            line_number = tb.tb_lineno
+        tb = tb.tb_next
+    return line_number
+
+def put(values, arrays, name, value, threshold, shm_dir):
+    '''Add a value to a response, pickled or in shared memory'''
+    import numpy as np
+    if (isinstance(value, np.ndarray) and not value.dtype.hasobject and
+        value.nbytes >= threshold):
+        arrays[name] = share_array(value, shm_dir)
+        return
+    try:
+        values[name] = pickle.dumps(value, 2)
+    except Exception:
+        pass
+
+def run(code, values, arrays, threshold, shm_dir):
+    '''Run a script with the locals of a request
+
+    returns the values and arrays of the script's result, under None,
+    and of the locals that it changed, and the names that it deleted.
+    '''
+    import numpy as np
+    context = Locals()
+    for name, data in values.items():
+        dict.__setitem__(context, name, pickle.loads(data))
+    for name, (path, dtype, shape) in arrays.items():
+        dict.__setitem__(
+            context, name, np.memmap(path, dtype, "r+", shape=shape))
+    exec_code, eval_code = code
+    g = __builtins__.__dict__
+    exec(exec_code, g, context)
+    result = None if eval_code is None else eval(eval_code, g, context)
+    values, arrays = {}, {}
+    put(values, arrays, None, result, threshold, shm_dir)
+    deleted = []
+    for name in context.changed:
+        if name in context:
+            put(values, arrays, name, context[name], threshold, shm_dir)
+        else:
+            deleted.append(name)
+    return values, arrays, deleted
+
+def main(threshold, shm_dir):
+    '''Serve requests until stdin is closed'''
+    if sys.version_info[0] >= 3:
+        infile, outfile = sys.stdin.buffer, sys.stdout.buffer
+    else:
+        infile, outfile = sys.stdin, sys.stdout
+    sys.stdout = sys.stderr
+    codes = {}
+    pickle.dump(tuple(sys.version_info[:2]), outfile, 2)
+    outfile.flush()
+    while True:
+        try:
+            token, code, forget, values, arrays = pickle.load(infile)
+        except EOFError:
+            break
+        for t in forget:
+            codes.pop(t, None)
+        if code is not None:
+            codes[token] = marshal.loads(code)
+        try:
+            response = ("ok", ) + run(
+                codes[token], values, arrays, threshold, shm_dir)
+        except Exception:
+            e = sys.exc_info()[1]
+            response = ("error", "%r" % e, script_line_number(
+                sys.exc_info()[2], codes[token][0].co_filename))
+        pickle.dump(response, outfile, 2)
+        outfile.flush()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]), sys.argv[2])
@@ -10,213 +10,1932 @@ accompanying file LICENSE for details.
 
 '''
 
-import ast
-import inspect
-import javabridge as J
+import collections
+import gc
+import hashlib
+import itertools
 import threading
 import logging
-import numpy as np
+import marshal
+import numbers
+import os
+import subprocess
 import sys
+import tempfile
+import time
+import types
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 logger = logging.getLogger(__name__)
 
+class LazyModule(object):
+    '''A module that is imported when one of its attributes is first used
+
+    This script runs on the thread that starts Python, so the heavy
+    modules are left for the engine threads to import. The first use
+    puts the module in this script's globals in place of the LazyModule,
+    so later uses go straight to the module.
+    '''
+    def __init__(self, name, alias):
+        self.name = name
+        self.alias = alias
+
+    def __getattr__(self, attr):
+        __import__(self.name)
+        module = sys.modules[self.name]
+        globals()[self.alias] = module
+        return getattr(module, attr)
+
+ast = LazyModule("ast", "ast")
+inspect = LazyModule("inspect", "inspect")
+J = LazyModule("javabridge", "J")
+np = LazyModule("numpy", "np")
+
+try:
+    import _scijava_cpython as native
+except ImportError:
+    # Python was not started by CPythonStartup.initializePython()
+    native = None
+
+LOCAL_FRAME_CAPACITY = 64
+
+class LocalFrame(object):
+    '''A JNI local reference frame around the handling of a request
+
+    The engine threads never return to Java, so a local reference that
+    the bridge doesn't delete would live as long as the thread. Popping
+    the frame deletes them all. The objects that the bridge keeps are
+    global references (JB_Objects), which the frame doesn't touch, so no
+    local reference may be kept beyond the request.
+    '''
+    def __enter__(self):
+        if native is not None:
+            native.push_local_frame(LOCAL_FRAME_CAPACITY)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if native is not None:
+            native.pop_local_frame()
+
+local_frame = LocalFrame()
+
+def reap_dead_objects():
+    '''Delete the global references of JB_Objects freed on other threads
+
+    A JB_Object that is freed on a thread not attached to Java can't
+    delete its reference, so javabridge queues it for its monitor thread,
+    which doesn't run when Java starts Python. The engine threads delete
+    the queued references after each request instead.
+    '''
+    J._javabridge.reap()
+
+native_requests = native is not None and native.request_channel_ready()
+
+def take_request(q_request):
+    '''Take an engine thread's next request, waiting if need be
+
+    The thread waits in native code without the GIL and takes the GIL
+    only once a request comes, rather than waiting in the bridge.
+
+    returns the request and the nanoseconds that it took to get the GIL
+    back after the request came, or 0 if that isn't known.
+    '''
+    if not native_requests:
+        return messenger.take(q_request), 0
+    #
+    # The request is a local reference, good for the current frame
+    #
+    capsule, gil_wait = native.take_request()
+    return J.get_env().make_jb_object(capsule), gil_wait
+
+MESSAGE_CLASS = "org/scijava/plugins/scripting/cpython/CPythonScriptEngine$Message"
+COMMANDS_CLASS = \
+    "org/scijava/plugins/scripting/cpython/CPythonScriptEngine$EngineCommands"
+
+jclasses = {}
+
+def jclass(name):
+    '''Return the JNI handle for a class, looking it up the first time
+    
+    The handles are global references, so one cache serves all threads.
+    The plugin's own classes are already in the cache: see
+    resolve_classes.
+    
+    :param name: the class name in JNI form, e.g. "java/util/ArrayList"
+    '''
+    klass = jclasses.get(name)
+    if klass is None:
+        env = J.get_env()
+        klass = env.find_class(name)
+        check_exception(env)
+        if klass is None:
+            raise ValueError("Could not find class %s" % name)
+        jclasses[name] = klass
+    return klass
+
+def resolve_classes(names):
+    '''Look classes up with the class loader of the plugin
+
+    FindClass() uses the class loader of the Java code that called into
+    native code. Python started the engine threads, so there it uses the
+    system class loader, which doesn't see the plugin's classes if the
+    plugin has a class loader of its own. This script is run by a call
+    from the plugin to CPythonStartup.runCompiled(), so its classes are
+    looked up here, on that call's thread, and kept in jclasses.
+
+    :param names: the class names in JNI form
+    '''
+    capsule = None if native is None else native.script_env()
+    if capsule is None:
+        return
+    J.jni_enter(capsule)
+    try:
+        env = J.get_env()
+        for name in names:
+            klass = env.find_class(name)
+            if klass is None:
+                env.exception_clear()
+                logger.warn("Could not find class %s", name)
+            else:
+                jclasses[name] = klass
+    finally:
+        J.jni_exit()
+
+def check_exception(env):
+    '''Raise a JavaException if the last JNI call threw one'''
+    x = env.exception_occurred()
+    if x is not None:
+        raise J.JavaException(x)
+
+class JMethodID(object):
+    '''A method ID that is looked up once and called from any thread
+    
+    One instance can be shared by all of the engine threads.
+    
+    >>> add = JMethodID("java/util/List", "add", "(Ljava/lang/Object;)Z")
+    >>> add(a_list, an_object)
+    True
+    '''
+    def __init__(self, class_name, name, sig, static=False):
+        self.class_name = class_name
+        self.name = name
+        self.sig = sig
+        self.static = static
+        self.method_id = None
+        
+    def get(self, env):
+        '''Look up the method ID, if need be
+        
+        :param env: the current thread's JNI environment
+        '''
+        if self.method_id is None:
+            klass = jclass(self.class_name)
+            if self.static:
+                method_id = env.get_static_method_id(klass, self.name, self.sig)
+            else:
+                method_id = env.get_method_id(klass, self.name, self.sig)
+            check_exception(env)
+            if method_id is None:
+                raise ValueError("Could not find method %s.%s%s" %
+                                 (self.class_name, self.name, self.sig))
+            self.method_id = method_id
+        return self.method_id
+    
+    def __call__(self, o, *args):
+        '''Call the method on an object (or the class if static)
+        
+        :param o: the target object, ignored for static methods
+        :param *args: the arguments, already converted for JNI
+        '''
+        env = J.get_env()
+        method_id = self.get(env)
+        if self.static:
+            result = env.call_static_method(
+                jclass(self.class_name), method_id, *args)
+        else:
+            result = env.call_method(o, method_id, *args)
+        check_exception(env)
+        return result
+    
+    def new(self, *args):
+        '''Call this method as a constructor'''
+        env = J.get_env()
+        result = env.new_object(
+            jclass(self.class_name), self.get(env), *args)
+        check_exception(env)
+        return result
+
+def to_java(o):
+    '''Convert a Python object for storage in a Java collection'''
+    if o is None or isinstance(o, J.JB_Object):
+        return o
+    if isinstance(o, JWrapper):
+        return o.o
+    return J.get_nice_arg(o, "Ljava/lang/Object;")
+
+class Messenger(object):
+    '''The engine queue protocol, using JNI directly
+    
+    Messages are taken and put, inspected and built through cached
+    method and field IDs instead of round trips through the JavaScript
+    interpreter. Commands are identified by their ordinal so that a
+    request can be dispatched through a table.
+    '''
+    take_method = JMethodID(
+        "java/util/concurrent/BlockingQueue", "take", "()Ljava/lang/Object;")
+    put_method = JMethodID(
+        "java/util/concurrent/BlockingQueue", "put", "(Ljava/lang/Object;)V")
+    to_array_method = JMethodID(
+        "java/util/List", "toArray", "()[Ljava/lang/Object;")
+    ordinal_method = JMethodID("java/lang/Enum", "ordinal", "()I")
+    name_method = JMethodID("java/lang/Enum", "name", "()Ljava/lang/String;")
+    new_array_list = JMethodID("java/util/ArrayList", "<init>", "()V")
+    add_method = JMethodID("java/util/ArrayList", "add", "(Ljava/lang/Object;)Z")
+    new_message = JMethodID(
+        MESSAGE_CLASS, "<init>", "(L%s;Ljava/util/List;)V" % COMMANDS_CLASS)
+    new_runtime_exception = JMethodID(
+        "java/lang/RuntimeException", "<init>", "(Ljava/lang/String;)V")
+    new_script_exception = JMethodID(
+        "javax/script/ScriptException", "<init>", 
+        "(Ljava/lang/String;Ljava/lang/String;I)V")
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.command_field = None
+        self.payload_field = None
+        self.id_field = None
+        self.sent_field = None
+        self.timings_field = None
+        self.profile_mode_field = None
+        self.profile_field = None
+        self.engine_field = None
+        self.commands = None
+        self.ordinals = None
+        
+    def bind(self):
+        '''Look up the Message fields and EngineCommands constants'''
+        with self.lock:
+            if self.commands is not None:
+                return
+            env = J.get_env()
+            klass = jclass(MESSAGE_CLASS)
+            command_field = env.get_field_id(
+                klass, "command", "L%s;" % COMMANDS_CLASS)
+            payload_field = env.get_field_id(
+                klass, "payload", "Ljava/util/List;")
+            id_field = env.get_field_id(klass, "id", "J")
+            sent_field = env.get_field_id(klass, "sent", "J")
+            timings_field = env.get_field_id(klass, "timings", "[J")
+            profile_mode_field = env.get_field_id(
+                klass, "profileMode", "L%s$Mode;" % PROFILE_CLASS)
+            profile_field = env.get_field_id(
+                klass, "profile", "L%s;" % PROFILE_CLASS)
+            engine_field = env.get_field_id(
+                klass, "engine", "L%s;" % ENGINE_CLASS)
+            check_exception(env)
+            values = JMethodID(COMMANDS_CLASS, "values", 
+                               "()[L%s;" % COMMANDS_CLASS, static=True)
+            commands = env.get_object_array_elements(values(None))
+            self.ordinals = dict([
+                (env.get_string_utf(self.name_method(command)), i)
+                for i, command in enumerate(commands)])
+            self.command_field = command_field
+            self.payload_field = payload_field
+            self.id_field = id_field
+            self.sent_field = sent_field
+            self.timings_field = timings_field
+            self.profile_mode_field = profile_mode_field
+            self.profile_field = profile_field
+            self.engine_field = engine_field
+            self.commands = commands
+            
+    def take(self, queue):
+        '''Take the next message from a queue, waiting if need be'''
+        return self.take_method(queue)
+    
+    def put(self, queue, msg):
+        '''Put a message on a queue, waiting if need be'''
+        self.put_method(queue, msg)
+        
+    def reply(self, queue, request, response):
+        '''Put the response to a request on a queue
+        
+        The response gets the request's ID so that the Java side can
+        match them up.
+        '''
+        env = J.get_env()
+        env.set_long_field(response, self.id_field,
+                           env.get_long_field(request, self.id_field))
+        self.put(queue, response)
+        
+    def ordinal(self, msg):
+        '''Return the ordinal of a message's command'''
+        if self.commands is None:
+            self.bind()
+        env = J.get_env()
+        return self.ordinal_method(
+            env.get_object_field(msg, self.command_field))
+    
+    def payload(self, msg):
+        '''Return a message's payload as a list of Java objects'''
+        env = J.get_env()
+        jpayload = env.get_object_field(msg, self.payload_field)
+        return env.get_object_array_elements(self.to_array_method(jpayload))
+
+    def engine(self, msg):
+        '''Return the CPythonScriptEngine that sent a request or None'''
+        return J.get_env().get_object_field(msg, self.engine_field)
+    
+    def dispatch_table(self, handlers):
+        '''Make a table of command handlers indexed by ordinal
+        
+        :param handlers: a dictionary of command name to handler
+        
+        returns a list with one element per command, None for commands
+        that have no handler.
+        '''
+        table = [None] * len(self.commands)
+        for name, handler in handlers.items():
+            table[self.ordinals[name]] = handler
+        return table
+    
+    def command_name(self, ordinal):
+        '''Return the name of the command with the given ordinal'''
+        for name, value in self.ordinals.items():
+            if value == ordinal:
+                return name
+        return str(ordinal)
+        
+    def message(self, command, *payload):
+        '''Make a new message
+        
+        :param command: the name of the message's command, e.g. "EXECUTION"
+        :param *payload: the contents of the payload. Python objects are
+                         converted to their Java equivalents.
+        '''
+        jpayload = self.new_array_list.new()
+        for o in payload:
+            self.add_method(jpayload, to_java(o))
+        return self.new_message.new(
+            self.commands[self.ordinals[command]], jpayload)
+    
+    def exception(self, message, filename=None, line_number=None):
+        '''Make an EXCEPTION message
+        
+        :param message: the text of the exception
+        :param filename: if defined, the name of the script that raised
+                         the exception, reported in a ScriptException
+        :param line_number: the line number in the script
+        '''
+        if filename is None:
+            exception = self.new_runtime_exception.new(
+                J.get_env().new_string_utf(message))
+        else:
+            exception = self.script_exception(message, filename, line_number)
+        return self.message("EXCEPTION", exception)
+    
+    def script_exception(self, message, filename, line_number):
+        '''Make a javax.script.ScriptException'''
+        env = J.get_env()
+        return self.new_script_exception.new(
+            env.new_string_utf(message), env.new_string_utf(filename),
+            line_number)
+    
+messenger = Messenger()
+
+STOP = object()
+'''Command handler that stops the thread'''
+
+#
+# Statistics
+#
+# Each engine thread times the stages of every request and keeps a
+# histogram of each stage's durations. The durations are also sent with
+# the response so that the Java side can keep its own histograms (see
+# CPythonStatistics). Setting the "scijava.cpython.statistics" system
+# property to false turns the timing off. The GIL wait is the part of the
+# queue wait between the request coming and the engine thread getting the
+# GIL to handle it, which grows when many engine threads contend for it.
+#
+STAGES = ("queue_wait", "take", "context", "compile", "exec", "marshal", "put",
+          "gil_wait")
+QUEUE_WAIT, TAKE, CONTEXT, COMPILE, EXEC, MARSHAL, PUT, GIL_WAIT = \
+    range(len(STAGES))
+
+clock = getattr(time, "perf_counter", time.time)
+nano_time_method = JMethodID("java/lang/System", "nanoTime", "()J", static=True)
+
+class LatencyHistogram(object):
+    '''A histogram of durations in power-of-two nanosecond buckets
+
+    Bucket i counts the durations of at least 2 ** (i - 1) and less than
+    2 ** i nanoseconds.
+    '''
+    N_BUCKETS = 64
+
+    def __init__(self):
+        self.buckets = [0] * self.N_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, nanos):
+        self.buckets[min(int(nanos).bit_length(), self.N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += nanos
+        if nanos > self.max:
+            self.max = nanos
+
+    def summary(self):
+        '''Return the count, mean, maximum and buckets as a dictionary'''
+        return dict(count=self.count, max=self.max, buckets=list(self.buckets),
+                    mean=float(self.total) / self.count if self.count else 0.0)
+
+class StageTimer(object):
+    '''Times the stages of an engine thread's requests
+
+    The time since the last mark is charged to the stage being marked,
+    so a stage that is marked several times, e.g. once per item of a
+    batch, adds up. The put of a response is only known after the
+    response is sent, so it goes with the next response.
+    '''
+    timers = {}
+    local = threading.local()
+
+    def __init__(self):
+        self.histograms = [LatencyHistogram() for stage in STAGES]
+        self.durations = [0] * len(STAGES)
+        self.last = None
+
+    @classmethod
+    def start_thread(cls):
+        '''Make the timer for the current engine thread
+
+        returns a timer that does nothing if statistics are off.
+        '''
+        if get_system_property(
+            "scijava.cpython.statistics", "true").lower() == "false":
+            timer = NullStageTimer()
+        else:
+            timer = cls()
+            cls.timers[threading.current_thread().name] = timer
+        cls.local.timer = timer
+        return timer
+
+    def stop_thread(self):
+        self.timers.pop(threading.current_thread().name, None)
+
+    def start(self, msg, gil_wait=0):
+        '''Start timing a request, charging its wait in the queue
+
+        :param gil_wait: the nanoseconds that it took to get the GIL once
+                         the request came
+        '''
+        self.last = clock()
+        sent = J.get_env().get_long_field(msg, messenger.sent_field)
+        if sent != 0:
+            self.durations[QUEUE_WAIT] = nano_time_method(None) - sent
+        self.durations[GIL_WAIT] = gil_wait
+
+    def mark(self, stage):
+        '''Charge the time since the last mark to a stage'''
+        now = clock()
+        self.durations[stage] += int((now - self.last) * 1e9)
+        self.last = now
+
+    def finish(self, response):
+        '''Record the request's timings and attach them to the response'''
+        env = J.get_env()
+        for histogram, nanos in zip(self.histograms, self.durations):
+            if nanos > 0:
+                histogram.record(nanos)
+        env.set_object_field(
+            response, messenger.timings_field,
+            env.make_long_array(np.array(self.durations, np.int64)))
+        self.durations = [0] * len(STAGES)
+
+    def summary(self):
+        return dict([(stage, histogram.summary())
+                     for stage, histogram in zip(STAGES, self.histograms)])
+
+class NullStageTimer(object):
+    '''The timer of an engine thread when statistics are off'''
+    def start(self, msg, gil_wait=0):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def finish(self, response):
+        pass
+
+    def stop_thread(self):
+        pass
+
+def mark(stage):
+    '''Charge the time since the last mark to a stage of the current request'''
+    StageTimer.local.timer.mark(stage)
+
+def get_statistics():
+    '''Return the latency histograms of the engine threads
+
+    returns a dictionary of engine thread name to a dictionary of stage
+    name to the stage's histogram summary.
+    '''
+    return dict([(name, timer.summary())
+                 for name, timer in list(StageTimer.timers.items())])
+
+#
+# Profiling
+#
+# A request whose profileMode is set is profiled while its handler runs
+# (see CPythonProfile), either with cProfile or by a thread that samples
+# the engine thread's stack. Both count the time spent in calls to Java
+# apart from the time spent in Python: cProfile times the javabridge's C
+# functions, and a sample is in Java if its innermost frame is one that
+# calls Java, i.e. JMethodID.__call__, JMethodID.new or a frame of the
+# javabridge package. The engine thread lets go of the GIL while it is in
+# Java, so the sampler gets to run sooner then than while Python runs;
+# each sample is weighted by the time since the one before to make up
+# for it.
+#
+PROFILE_CLASS = "org/scijava/plugins/scripting/cpython/CPythonProfile"
+PROFILE_INTERVAL_PROPERTY = "scijava.cpython.profileInterval"
+PROFILE_LINES = 40
+'''The number of functions in a cProfile report'''
+JAVA_FRAME = "[java]"
+JAVA_CALL_CODES = frozenset([JMethodID.__dict__["__call__"].__code__,
+                             JMethodID.__dict__["new"].__code__])
+
+new_profile = JMethodID(
+    PROFILE_CLASS, "<init>", "(Ljava/lang/String;JJILjava/lang/String;)V")
+
+def start_profiler(msg):
+    '''Start profiling a request if its profileMode says to
+
+    Call from the engine loop: the sampled stacks start below its frame.
+    '''
+    env = J.get_env()
+    mode = env.get_object_field(msg, messenger.profile_mode_field)
+    if mode is None:
+        return NULL_PROFILER
+    if env.get_string_utf(messenger.name_method(mode)) == CProfiler.mode:
+        return CProfiler()
+    return SamplingProfiler(sys._getframe(1))
+
+class NullProfiler(object):
+    '''The profiler of a request that isn't profiled'''
+    def stop(self):
+        pass
+
+    def finish(self, response):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+class Profiler(object):
+    '''Profiles the handling of a request
+
+    Subclasses start profiling when made and return what they found
+    from results().
+    '''
+    mode = None
+    '''The name of the CPythonProfile.Mode'''
+
+    def __init__(self):
+        self.started = clock()
+        self.elapsed = 0
+
+    def stop(self):
+        self.elapsed = clock() - self.started
+
+    def results(self):
+        '''Return the seconds in Java, the number of samples and the report'''
+        raise NotImplementedError()
+
+    def finish(self, response):
+        '''Attach the profile to the response'''
+        env = J.get_env()
+        java, samples, report = self.results()
+        profile = new_profile.new(
+            env.new_string_utf(self.mode), int(self.elapsed * 1e9),
+            int(java * 1e9), samples, env.new_string(report))
+        env.set_object_field(response, messenger.profile_field, profile)
+
+class CProfiler(Profiler):
+    '''Profiles a request with cProfile'''
+    mode = "CPROFILE"
+
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+        Profiler.__init__(self)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        Profiler.stop(self)
+
+    def results(self):
+        import pstats
+        stream = StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        java = sum([total_time for (filename, line, name), (
+            calls, primitive_calls, total_time, cumulative_time, callers)
+                    in stats.stats.items()
+                    if filename == "~" and "_javabridge" in name])
+        stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+        return java, 0, stream.getvalue()
+
+class SamplingProfiler(Profiler):
+    '''Profiles a request by sampling the engine thread's stack'''
+    mode = "SAMPLE"
+
+    def __init__(self, base):
+        '''
+        :param base: the outermost frame of the engine thread to leave out
+        '''
+        Profiler.__init__(self)
+        self.base = base
+        self.ident = threading.current_thread().ident
+        self.stacks = collections.defaultdict(float)
+        self.samples = 0
+        self.java = 0.0
+        self.done = threading.Event()
+        interval = float(get_system_property(
+            PROFILE_INTERVAL_PROPERTY, "5")) / 1000
+        self.thread = threading.Thread(target=self.run, args=(interval, ),
+                                       name="Scripting-CPythonProfiler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self, interval):
+        last = clock()
+        while not self.done.wait(interval):
+            frame = sys._current_frames().get(self.ident)
+            now = clock()
+            if frame is not None and not self.done.is_set():
+                self.sample(frame, now - last)
+            frame = None
+            last = now
+
+    def sample(self, frame, weight):
+        '''Charge the time since the last sample to the frame's stack'''
+        in_java = (frame.f_code in JAVA_CALL_CODES or
+                   frame.f_globals.get("__name__", "").startswith("javabridge"))
+        names = []
+        while frame is not None and frame is not self.base:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        names.reverse()
+        if in_java:
+            names.append(JAVA_FRAME)
+            self.java += weight
+        self.stacks[";".join(names)] += weight
+        self.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.base = None
+        Profiler.stop(self)
+
+    def results(self):
+        report = "".join(["%s %d\n" % (stack, int(weight * 1e6))
+                          for stack, weight in sorted(self.stacks.items())])
+        return self.java, self.samples, report
+
 def engine_requester():
     J.attach()
+    q_request = J.run_script(
+        """importPackage(Packages.org.scijava.plugins.scripting.cpython);
+           CPythonScriptEngine.engineRequestQueue;""")
+    q_response = J.run_script(
+        """importPackage(Packages.org.scijava.plugins.scripting.cpython);
+           CPythonScriptEngine.engineResponseQueue;""")
+    handlers = None
     while True:
         try:
-            msg = J.run_script(
-            """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-               CPythonScriptEngine.engineRequestQueue.take();""")
-            if logger.level <= logging.INFO:
-                logger.info("Received engine request: %s",
-                            J.to_string(msg))
-            payload = J.get_collection_wrapper(
-                J.run_script("msg.payload", dict(msg=msg)))
-            if J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                msg.command==CPythonScriptEngine.EngineCommands.NEW_ENGINE;
-                """, dict(msg=msg)):
-                do_new_engine(payload)
-            elif J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                msg.command==CPythonScriptEngine.EngineCommands.CLOSE_SERVICE;
-                """, dict(msg=msg)):
-                logger.info("Exiting script service thread in response to "
-                            "termination request")
-                break
-            else:
-                J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                var exception = new java.lang.RuntimeException(
-                    java.lang.String.format('Unknown command: %s', msg.command.toString()));
-                var payload = new java.util.ArrayList();
-                payload.add(exception);
-                var response = new CPythonScriptEngine.Message(
-                    CPythonScriptEngine.EngineCommands.EXCEPTION, payload);
-                CPythonScriptEngine.engineResponseQueue.put(response);
-                """)
+            with local_frame:
+                msg = messenger.take(q_request)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Received engine request: %s",
+                                J.to_string(msg))
+                ordinal = messenger.ordinal(msg)
+                if handlers is None:
+                    handlers = messenger.dispatch_table(dict(
+                        NEW_ENGINE=do_new_engine,
+                        TRIM=do_trim,
+                        CLOSE_SERVICE=STOP))
+                handler = handlers[ordinal]
+                if handler is STOP:
+                    logger.info("Exiting script service thread in response "
+                                "to termination request")
+                    break
+                elif handler is None:
+                    response = messenger.exception(
+                        "Unknown command: %s" %
+                        messenger.command_name(ordinal))
+                else:
+                    response = handler(messenger.payload(msg))
+                messenger.put(q_response, response)
         except:
             # To do: how to handle failure, probably from .take()
             # Guessing that someone has managed to interrupt our thread
             logger.warn("Exiting script service thread", exc_info=True)
+        finally:
+            msg = response = None
     J.detach()
             
 def engine(q_request, q_response):
     logger.info("Starting script engine thread")
     J.attach()
+    try:
+        serve_engine(q_request, q_response)
+    except:
+        #
+        # The thread can't go on serving its queue. The Java side takes
+        # CLOSE_ENGINE to mean that the thread is gone and fails the
+        # requests in flight instead of letting them wait forever.
+        #
+        logger.error("Script engine thread failed", exc_info=True)
+        try:
+            messenger.put(q_response, messenger.message("CLOSE_ENGINE"))
+        except:
+            logger.warn("Could not tell Java that the engine thread failed",
+                        exc_info=True)
+    J.detach()
+
+def serve_engine(q_request, q_response):
+    '''Handle an engine's requests until it is closed'''
+    worker_serve_method(None, q_request)
+    handlers = None
+    timer = StageTimer.start_thread()
     while True:
         try:
-            msg = J.run_script(
-            """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-               q_request.take();""", dict(q_request=q_request))
-            if logger.level <= logging.INFO:
-                logger.info("Received engine request: %s",
-                            J.to_string(msg))
-            payload = J.get_collection_wrapper(
-                J.run_script("msg.payload", dict(msg=msg)))
-            if J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                msg.command==CPythonScriptEngine.EngineCommands.EXECUTE;
-                """, dict(msg=msg)):
-                response = do_execute(payload)
-            elif J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                msg.command==CPythonScriptEngine.EngineCommands.EVALUATE;
-                """, dict(msg=msg)):
-                response = do_evaluate(payload)
-            elif J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                msg.command==CPythonScriptEngine.EngineCommands.CLOSE_ENGINE;
-                """, dict(msg=msg)):
-                logger.info("Exiting script engine thread after close request")
-                break
-            else:
-                logger.warn(
-                    "Received unknown command: %s" %
-                    J.run_script("msg.command.toString()", dict(msg=msg)))
-                response = J.run_script(
-                """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-                var exception = new java.lang.RuntimeException(
-                    java.lang.String.format('Unknown command: %s', msg.command.toString()));
-                var payload = new java.util.ArrayList();
-                payload.add(exception);
-                new CPythonScriptEngine.Message(
-                    CPythonScriptEngine.EngineCommands.EXCEPTION, payload);
-                """, dict(msg=msg))
-            J.run_script("q_response.put(response);", 
-                         dict(q_response=q_response,
-                              response=response))
+            with local_frame:
+                msg, gil_wait = take_request(q_request)
+                timer.start(msg, gil_wait)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Received engine request: %s",
+                                J.to_string(msg))
+                ordinal = messenger.ordinal(msg)
+                if handlers is None:
+                    handlers = messenger.dispatch_table(dict(
+                        EXECUTE=do_execute,
+                        EVALUATE=do_evaluate,
+                        COMPILE=do_compile,
+                        EVALUATE_COMPILED=do_evaluate_compiled,
+                        EVALUATE_BATCH=do_evaluate_batch,
+                        EVALUATE_REF=do_evaluate_ref,
+                        GET_REF=do_get_ref,
+                        RELEASE_REFS=do_release_refs,
+                        RESET=do_reset,
+                        REFERENCE_COUNTS=do_reference_counts,
+                        SET_OUTPUT=do_set_output,
+                        CALL=do_call,
+                        CLOSE_ENGINE=STOP))
+                handler = handlers[ordinal]
+                if handler is STOP:
+                    logger.info(
+                        "Exiting script engine thread after close request")
+                    timer.stop_thread()
+                    messenger.reply(q_response, msg,
+                                    messenger.message("CLOSE_ENGINE"))
+                    break
+                elif handler is None:
+                    command_name = messenger.command_name(ordinal)
+                    logger.warn("Received unknown command: %s" % command_name)
+                    response = messenger.exception(
+                        "Unknown command: %s" % command_name)
+                else:
+                    payload = messenger.payload(msg)
+                    timer.mark(TAKE)
+                    profiler = start_profiler(msg)
+                    engine_local.engine = messenger.engine(msg)
+                    try:
+                        response = handler(payload)
+                    finally:
+                        engine_local.engine = None
+                        profiler.stop()
+                    profiler.finish(response)
+                    flush_output()
+                timer.finish(response)
+                messenger.reply(q_response, msg, response)
+                timer.mark(PUT)
         except:
             # To do: how to handle failure, probably from .take()
             # Guessing that someone has managed to interrupt our thread
             logger.warn("Exiting script engine thread", exc_info=True)
-    J.detach()
+        finally:
+            #
+            # Let go of the request's Java objects now, not when the next
+            # request comes, which may be much later.
+            #
+            msg = payload = response = None
+            reap_dead_objects()
     
+engine_numbers = itertools.count(1)
+'''Numbers the engine threads, whose names identify their statistics'''
+
 def do_new_engine(payload):
     '''Create a new engine thread
     
     payload: first member is request queue, second is response queue
     '''
     logger.info("Creating new engine")
-    thread = threading.Thread(target = engine, args=list(payload[:2]),
-                              name = "Scripting-CPythonEngine")
+    thread = threading.Thread(
+        target = engine, args=list(payload[:2]),
+        name = "Scripting-CPythonEngine-%d" % next(engine_numbers))
     thread.setDaemon(True)
     thread.start()
-    J.run_script(
-    """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-    var payload = new java.util.ArrayList();
-    var response = new CPythonScriptEngine.Message(
-        CPythonScriptEngine.EngineCommands.NEW_ENGINE_RESULT, payload);
-    CPythonScriptEngine.engineResponseQueue.put(response);
-    """)
-    
-def do_evaluate(payload):
+    return messenger.message("NEW_ENGINE_RESULT")
+
+def do_trim(payload):
+    '''Free what is kept for engines once none are left
+
+    Python is shared by all of the JVM's contexts and is never finalized
+    (see CPythonRuntime), so when the last context lets go, the compiled
+    scripts, class information and idle worker processes are dropped
+    instead.
+
+    payload: empty
+    '''
+    code_cache.clear()
+    class_info_cache.clear()
+    if process_pool:
+        process_pool.close_idle()
+    gc.collect()
+    reap_dead_objects()
+    release_collected_exports()
+    return messenger.message("EVALUATE_RESULT", None)
+    
+def do_evaluate(payload, as_ref=False):
     '''Evaluate a Python command
     
     payload: first member is Python command string, second is local context
+    as_ref: if True, the result is kept on the Python side and returned
+            as a PyObjectRef
     '''
     logger.info("Evaluating script")
-    filename = "scripting-cpython"
+    filename = DEFAULT_FILENAME
     try:
-        command = J.to_string(payload[0])
-        context = context_to_locals(payload[1])
+        command = J.get_env().get_string_utf(payload[0])
+        context = engine_locals(payload[1])
+        filename = context.get(FILENAME_KEY, DEFAULT_FILENAME)
+        mark(CONTEXT)
         logger.debug("Script:\n%s" % command)
-        #
-        # OK, the game plan is a little difficult here:
-        #
-        # use AST to parse (see https://docs.python.org/2.7/library/ast.html)
-        # The AST object's body is a list of statements.
-        # If the last body element is an ast.Expr, then
-        # we execute all of the statements except the last
-        # and then we wrap the last as an ast.Expression
-        # and evaluate it.
-        #
-        a = ast.parse(command)
-        if isinstance(a.body[-1], ast.Expr):
-            expr = a.body[-1]
-            del a.body[-1]
+        code = code_cache.get(command, filename, evaluate=True)
+        mark(COMPILE)
+        result = run_code(code, context)
+        mark(EXEC)
+        logger.debug("Script evaluated")
+        if as_ref:
+            result = make_object_ref(result)
+        response = messenger.message("EVALUATE_RESULT", result, *context.delta())
+        mark(MARSHAL)
+        return response
+    except:
+        logger.info("Exception caught during eval", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        
+        return messenger.exception("Python exception: %r" % e,
+                                   filename, error_line_number(e, e_tb, filename))
+
+def do_evaluate_ref(payload):
+    '''Evaluate a Python command, returning its result as a PyObjectRef
+
+    payload: as for do_evaluate
+    '''
+    return do_evaluate(payload, as_ref=True)
+
+def do_get_ref(payload):
+    '''Get an object held by a PyObjectRef or an item of it
+
+    payload: first member is the PyObjectRef, second is an index
+             expression, e.g. "0, 10:20", or null for the object itself,
+             third is a Boolean that is true to return the object or item
+             as a new PyObjectRef instead of converting it.
+    '''
+    try:
+        o = object_ref_to_python(payload[0])
+        if payload[1] is not None:
+            index = J.get_env().get_string_utf(payload[1])
+            o = eval("o[%s]" % index, {"o": o})
+        if convert_binding(payload[2]):
+            result = make_object_ref(o)
         else:
-            expr = a.parse("None").body[0]
-        
-        filename = context.get("javax.scripting.filename", 
-                               "scripting-cpython") 
-        code = compile(a, filename, mode="exec")
-        exec(code, __builtins__.__dict__, context)
-        code = compile(ast.Expression(expr.value), filename, mode="eval")
-        result = eval(code, __builtins__.__dict__, context)
+            result = local_to_java(o)
+            if result is NOT_CONVERTED:
+                result = o
+        return messenger.message("EVALUATE_RESULT", result)
+    except:
+        logger.info("Exception caught getting object", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e)
+
+def do_reset(payload):
+    '''Forget everything that the engine's scripts have left behind
+
+    payload: empty
+    '''
+    engine_local.namespace = None
+    return messenger.message("EVALUATE_RESULT", None)
+
+def do_reference_counts(payload):
+    '''Count the Java references that the bridge holds
+
+    payload: empty
+    '''
+    env = J.get_env()
+    counts = new_hash_map_method.new()
+    for key, value in get_reference_counts().items():
+        map_put_method(counts, env.new_string_utf(key), local_to_java(value))
+    return messenger.message("EVALUATE_RESULT", counts)
+
+def get_reference_counts():
+    '''Count the Java references that the bridge holds
+
+    returns a dictionary of
+    java_objects: the live JB_Objects, each holding a global reference
+    cached_classes: the class handles cached by jclass
+    class_infos: the classes reflected on for JWrapper
+    object_refs: the objects held for PyObjectRefs
+    dead_objects: the global references of freed JB_Objects that are
+                  waiting to be deleted (see reap_dead_objects)
+    exported_buffers: the numpy arrays shared with direct buffers that
+                      Java hasn't collected yet
+    local_frames: the local reference frames in use, one per request
+                  being handled, including the one asking
+    local_frames_pushed: the local reference frames used so far
+
+    All but the last should stay flat over a long run. Counting the
+    JB_Objects walks all of Python's objects, so this is for diagnostics,
+    not for every request.
+    '''
+    java_objects = len([o for o in gc.get_objects()
+                        if type(o) is J.JB_Object])
+    pushed, popped = (0, 0) if native is None else native.frame_counts()
+    return dict(java_objects=java_objects,
+                cached_classes=len(jclasses),
+                class_infos=len(class_info_cache),
+                object_refs=len(object_refs),
+                dead_objects=len(getattr(J._javabridge, "__dead_objects", ())),
+                exported_buffers=len(exported_arrays),
+                local_frames=pushed - popped,
+                local_frames_pushed=pushed)
+
+def do_release_refs(payload):
+    '''Release the objects held by PyObjectRefs
+
+    payload: the PyObjectRefs that Java has closed
+    '''
+    try:
+        for jref in payload:
+            object_refs.release(object_ref_handle_method(jref))
+        return messenger.message("EVALUATE_RESULT", None)
+    except:
+        logger.info("Exception caught releasing objects", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e)
+
+def do_compile(payload):
+    '''Compile a script for later evaluation by do_evaluate_compiled
+    
+    payload: first member is Python command string, second is the
+             script's file name or null.
+    '''
+    logger.info("Compiling script")
+    filename = DEFAULT_FILENAME
+    try:
+        env = J.get_env()
+        command = env.get_string_utf(payload[0])
+        if payload[1] is not None:
+            filename = J.to_string(payload[1])
+        mark(CONTEXT)
+        script_id = code_cache.pin(command, filename)
+        mark(COMPILE)
+        return messenger.message("COMPILE_RESULT", script_id)
+    except:
+        logger.info("Exception caught during compile", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e,
+                                   filename, error_line_number(e, e_tb, filename))
+    
+def do_evaluate_compiled(payload):
+    '''Evaluate a script compiled by do_compile
+    
+    payload: first member is the script ID returned by do_compile, 
+             second is local context
+    '''
+    logger.info("Evaluating compiled script")
+    filename = DEFAULT_FILENAME
+    try:
+        script_id = J.get_env().get_string_utf(payload[0])
+        context = engine_locals(payload[1])
+        mark(CONTEXT)
+        code = code_cache.get_pinned(script_id)
+        filename = code.exec_code.co_filename
+        mark(COMPILE)
+        result = run_code(code, context)
+        mark(EXEC)
         logger.debug("Script evaluated")
-        return J.run_script(
-            """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-            var payload = new java.util.ArrayList();
-            payload.add(result);
-            new CPythonScriptEngine.Message(
-                CPythonScriptEngine.EngineCommands.EVALUATE_RESULT, payload);
-            """, dict(result=result))
+        response = messenger.message("EVALUATE_RESULT", result, *context.delta())
+        mark(MARSHAL)
+        return response
     except:
         logger.info("Exception caught during eval", exc_info=True)
         e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e,
+                                   filename, error_line_number(e, e_tb, filename))
+
+def do_evaluate_batch(payload):
+    '''Evaluate a script once for each of a list of inputs
+    
+    payload: first member is Python command string, second is either a
+             list of maps, one per evaluation, or a map of column name
+             to a list or primitive array of values, third is the
+             script's file name or null.
+    
+    The script is compiled once. An exception raised by one evaluation
+    is returned as that evaluation's result and the batch goes on.
+    '''
+    logger.info("Evaluating script batch")
+    filename = DEFAULT_FILENAME
+    try:
+        env = J.get_env()
+        command = env.get_string_utf(payload[0])
+        if payload[2] is not None:
+            filename = J.to_string(payload[2])
+        code = code_cache.get(command, filename, evaluate=True)
+        mark(COMPILE)
+        inputs = payload[1]
+        if env.is_instance_of(inputs, jclass("java/util/Map")):
+            n_items, get_context = columns_to_locals(inputs)
+        else:
+            items = env.get_object_array_elements(
+                Messenger.to_array_method(inputs))
+            n_items, get_context = len(items), \
+                lambda i: context_to_locals(items[i])
+    except:
+        logger.info("Exception caught during batch eval", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e,
+                                   filename, error_line_number(e, e_tb, filename))
+    results = Messenger.new_array_list.new()
+    mark(CONTEXT)
+    for i in range(n_items):
+        try:
+            context = get_context(i)
+            mark(CONTEXT)
+            result = run_code(code, context)
+            mark(EXEC)
+            result = to_java(result)
+        except:
+            logger.debug("Exception caught in batch item %d", i, exc_info=True)
+            e_type, e, e_tb = sys.exc_info()
+            result = messenger.script_exception(
+                "Python exception: %r" % e, filename,
+                error_line_number(e, e_tb, filename))
+        Messenger.add_method(results, result)
+        mark(MARSHAL)
+    logger.debug("Script batch evaluated")
+    response = messenger.message("EVALUATE_BATCH_RESULT", results)
+    mark(MARSHAL)
+    return response
+
+def columns_to_locals(columns):
+    '''Prepare the local contexts of a batch from columns of inputs
+    
+    :param columns: a Java map of name to a java.util.List or a primitive
+                    array or direct buffer, all of the same length.
+    
+    Each column is converted once: arrays and buffers to numpy, lists
+    to a list of elements that are converted when their row is used.
+    
+    returns the number of rows and a function that makes the local
+    context for a row.
+    '''
+    env = J.get_env()
+    names = env.get_object_array_elements(
+        set_to_array_method(map_key_set_method(columns)))
+    converted = []
+    for name in names:
+        column = map_get_method(columns, name)
+        values = java_to_numpy(column)
+        if values is None:
+            values = env.get_object_array_elements(
+                Messenger.to_array_method(column))
+            convert = convert_binding
+        else:
+            convert = None
+        converted.append((env.get_string_utf(name), values, convert))
+    lengths = set([len(values) for name, values, convert in converted])
+    if len(lengths) > 1:
+        raise ValueError("All columns of a batch must have the same length")
+    n_rows = lengths.pop() if len(lengths) > 0 else 0
+    
+    def get_context(i):
+        d = dict(script_helpers())
+        for name, values, convert in converted:
+            d[name] = values[i] if convert is None else convert(values[i])
+        return d
+    return n_rows, get_context
+
+def error_line_number(e, tb, filename):
+    '''Return the line in the script of an error compiling or running it
+    
+    :param e: the exception
+    :param tb: the exception's traceback
+    :param filename: the script's file name
+    
+    returns -1 if the line isn't known.
+    '''
+    if isinstance(e, SyntaxError) and e.filename == filename:
+        return e.lineno or -1
+    if isinstance(e, RemoteScriptError):
+        return e.lineno
+    return script_line_number(tb, filename)
+
+def script_line_number(tb, filename):
+    '''Return the line in the script where an exception was raised
+
+    :param tb: the exception's traceback
+    :param filename: the script's file name
+
+    returns -1 if the traceback doesn't pass through the script. The
+    process pool's workers have their own copy.
+    '''
+    line_number = -1
+    while tb is not None:
+        if tb.tb_frame.f_code.co_filename == filename:
+            line_number = tb.tb_lineno
+        tb = tb.tb_next
+    return line_number
+
+def run_code(code, context):
+    '''Run compiled code
+    
+    :param code: the CompiledCode to run
+    :param context: the local context of the script
+    
+    returns the value of the script's trailing expression, if any.
+
+    If the process pool is enabled, the code runs in a worker process.
+    '''
+    pool = get_process_pool()
+    if pool is not None:
+        return pool.run(code, context)
+    if isinstance(context, EngineNamespace):
+        context.load_scopes(scope_names(code))
+        g = context
+    else:
+        g = __builtins__.__dict__
+    exec(code.exec_code, g, context)
+    if code.eval_code is None:
+        return None
+    return eval(code.eval_code, g, context)
+
+DYNAMIC_NAMES = frozenset(("eval", "exec", "execfile", "globals", "locals", "vars"))
+'''Names whose use means that code may look any global name up'''
+
+def scope_names(code):
+    '''Return the global names that the nested scopes of compiled code use
+    
+    :param code: a CompiledCode
+    
+    returns the names that the functions, classes, lambdas and, in
+    Python 3, comprehensions that the code defines look up, or None if
+    one of them may look names up dynamically, through eval, globals()
+    and the like.
+    '''
+    names = set()
+    stack = [c for c in code if c is not None]
+    while stack:
+        for const in stack.pop().co_consts:
+            if isinstance(const, types.CodeType):
+                if not DYNAMIC_NAMES.isdisjoint(const.co_names):
+                    return None
+                names.update(const.co_names)
+                stack.append(const)
+    return names
+
+DEFAULT_FILENAME = "scripting-cpython"
+# javax.script.ScriptEngine.FILENAME
+FILENAME_KEY = "javax.script.filename"
+
+CompiledCode = collections.namedtuple("CompiledCode", ("exec_code", "eval_code"))
+
+def compile_script(command, filename, evaluate):
+    '''Compile a script
+    
+    :param command: the text of the script
+    :param filename: the script's file name, used in tracebacks
+    :param evaluate: if True, split off a trailing expression so that
+                     the script's value can be returned.
+                     
+    returns a CompiledCode.
+    '''
+    if not evaluate:
+        return CompiledCode(compile(command, filename, mode="exec"), None)
+    #
+    # OK, the game plan is a little difficult here:
+    #
+    # use AST to parse (see https://docs.python.org/2.7/library/ast.html)
+    # The AST object's body is a list of statements.
+    # If the last body element is an ast.Expr, then
+    # we execute all of the statements except the last
+    # and then we wrap the last as an ast.Expression
+    # and evaluate it.
+    #
+    a = ast.parse(command, filename)
+    if len(a.body) > 0 and isinstance(a.body[-1], ast.Expr):
+        expr = a.body.pop()
+        eval_code = compile(ast.Expression(expr.value), filename, mode="eval")
+    else:
+        eval_code = None
+    return CompiledCode(compile(a, filename, mode="exec"), eval_code)
+
+class CodeCache(object):
+    '''A least-recently-used cache of compiled scripts
+    
+    Scripts are keyed by a hash of their file name and text. The cache
+    holds at most "maxsize" scripts (the "scijava.cpython.codeCacheSize"
+    system property, by default 256). Scripts compiled through
+    javax.script.Compilable are pinned: they are kept apart from the
+    LRU entries and are not evicted.
+    '''
+    DEFAULT_MAXSIZE = 256
+    
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+    @staticmethod
+    def make_key(command, filename):
+        '''Hash a script's text and file name'''
+        h = hashlib.sha1()
+        for part in (filename, command):
+            if isinstance(part, type(u"")):
+                part = part.encode("utf-8")
+            h.update(part)
+            h.update(b"\0")
+        return h.hexdigest()
+    
+    def get(self, command, filename, evaluate):
+        '''Get a compiled script, compiling it if it is not in the cache
         
-        return J.run_script(
-            """
-            importPackage(Packages.org.scijava.plugins.scripting.cpython);
-            var exception = new javax.script.ScriptException(
-                java.lang.String.format('Python exception: %s', e),
-                filename, line_number);
-            var payload = new java.util.ArrayList();
-            payload.add(exception);
-            new CPythonScriptEngine.Message(
-               CPythonScriptEngine.EngineCommands.EXCEPTION, payload);
-            """, dict(e=repr(e), filename = filename, 
-                      line_number = e_tb.tb_lineno))
+        :param command: the text of the script
+        :param filename: the script's file name
+        :param evaluate: True to compile for do_evaluate, False for do_execute
+        '''
+        key = (self.make_key(command, filename), evaluate)
+        with self.lock:
+            code = self.entries.pop(key, None)
+            if code is not None:
+                self.hits += 1
+                self.entries[key] = code
+                return code
+            self.misses += 1
+        code = compile_script(command, filename, evaluate)
+        with self.lock:
+            if self.maxsize is None:
+                self.maxsize = int(get_system_property(
+                    "scijava.cpython.codeCacheSize", self.DEFAULT_MAXSIZE))
+            self.entries[key] = code
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return code
+    
+    def pin(self, command, filename):
+        '''Compile a script for evaluation and keep it
+        
+        returns the script's ID, to be used with get_pinned().
+        '''
+        script_id = self.make_key(command, filename)
+        with self.lock:
+            if script_id in self.pinned:
+                self.hits += 1
+                return script_id
+            self.misses += 1
+        code = compile_script(command, filename, True)
+        with self.lock:
+            self.pinned[script_id] = code
+        return script_id
+    
+    def get_pinned(self, script_id):
+        '''Get a script compiled by pin()'''
+        with self.lock:
+            code = self.pinned.get(script_id)
+        if code is None:
+            raise KeyError("No compiled script with ID %s" % script_id)
+        return code
+    
+    def clear(self):
+        '''Forget all scripts, pinned or not'''
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+    
+    def cache_info(self):
+        '''Return the cache's hit and miss counts and sizes'''
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, 
+                        maxsize=self.maxsize, size=len(self.entries),
+                        pinned=len(self.pinned))
+    
+code_cache = CodeCache()
+
+def get_system_property(name, default=None):
+    '''Return the value of a Java system property or the default'''
+    value = J.static_call(
+        "java/lang/System", "getProperty", 
+        "(Ljava/lang/String;)Ljava/lang/String;", name)
+    return default if value is None else value
 
 def context_to_locals(context):
     '''convert the local context as a Java map to a dictionary of locals'''
-    d = { "JWrapper": JWrapper,
-          "importClass": importClass }
-    m = J.get_map_wrapper(context)
-    for k in m:
-        key = J.to_string(k)
-        o = m[k]
-        if isinstance(o, J.JB_Object):
-            if J.is_instance_of(o, "java/lang/String"):
-                d[key] = J.to_string(o)
+    return LazyBindings(context)
+
+is_assignable_from_method = JMethodID(
+    "java/lang/Class", "isAssignableFrom", "(Ljava/lang/Class;)Z")
+map_get_method = JMethodID(
+    "java/util/Map", "get", "(Ljava/lang/Object;)Ljava/lang/Object;")
+map_put_method = JMethodID(
+    "java/util/Map", "put", 
+    "(Ljava/lang/Object;Ljava/lang/Object;)Ljava/lang/Object;")
+new_hash_map_method = JMethodID("java/util/HashMap", "<init>", "()V")
+map_key_set_method = JMethodID(
+    "java/util/Map", "keySet", "()Ljava/util/Set;")
+set_to_array_method = JMethodID(
+    "java/util/Set", "toArray", "()[Ljava/lang/Object;")
+
+class LazyBindings(dict):
+    '''The script's locals, converted from the bindings on first use
+    
+    Only the names of the bindings are read up front. A binding is
+    fetched from the Java map and converted when the script first looks
+    it up, then kept in the dictionary. Names that aren't bindings fall
+    through to the builtins without a trip to Java.
+    '''
+    def __init__(self, bindings):
+        dict.__init__(self)
+        env = J.get_env()
+        self.bindings = bindings
+        self.changed = set()
+        self.pending = set([
+            env.get_string_utf(key) for key in env.get_object_array_elements(
+                set_to_array_method(map_key_set_method(bindings)))])
+        for key, value in script_helpers():
+            if key not in self.pending:
+                dict.__setitem__(self, key, value)
+        
+    def __missing__(self, key):
+        if key not in self.pending:
+            raise KeyError(key)
+        self.pending.discard(key)
+        env = J.get_env()
+        value = convert_binding(
+            map_get_method(self.bindings, env.new_string_utf(key)))
+        dict.__setitem__(self, key, value)
+        return value
+    
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.pending
+    
+    def __setitem__(self, key, value):
+        self.pending.discard(key)
+        self.changed.add(key)
+        dict.__setitem__(self, key, value)
+        
+    def __delitem__(self, key):
+        if key in self.pending:
+            self.pending.discard(key)
+        else:
+            dict.__delitem__(self, key)
+        self.changed.add(key)
+            
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def names(self):
+        '''Return the names of all locals, converted or not'''
+        return set(dict.keys(self)) | self.pending
+        
+    def delta(self):
+        '''Convert the names the script created, rebound or deleted
+        
+        returns a java.util.Map of the new values and a java.util.List
+        of the deleted names. Values with no Java equivalent, such as
+        modules and functions, are left out.
+        '''
+        env = J.get_env()
+        values = new_hash_map_method.new()
+        removed = Messenger.new_array_list.new()
+        for key in self.changed:
+            jkey = env.new_string_utf(key)
+            if not dict.__contains__(self, key):
+                Messenger.add_method(removed, jkey)
                 continue
-            for class_name, method, signature in (
-                ("java/lang/Boolean", "booleanValue", "()Z"),
-                ("java/lang/Byte", "byteValue", "()B"),
-                ("java/lang/Integer",  "intValue", "()I"),
-                ("java/lang/Long", "longValue", "()L"),
-                ("java/lang/Float", "floatValue", "()F"),
-                ("java/lang/Double", "doubleValue", "()D")):
-                if J.is_instance_of(o, class_name):
-                    d[key] = J.call(o, method, signature)
-                    break
+            value = local_to_java(dict.__getitem__(self, key))
+            if value is not NOT_CONVERTED:
+                map_put_method(values, jkey, value)
+        return values, removed
+
+def script_helpers():
+    '''Return the names and values that scripts get unless bindings hide them'''
+    return (("JWrapper", JWrapper),
+            ("importClass", importClass),
+            ("to_numpy", to_numpy),
+            ("ImgArray", ImgArray),
+            ("export_function", export_function))
+
+ENGINE_CLASS = "org/scijava/plugins/scripting/cpython/CPythonScriptEngine"
+is_bound_method = JMethodID(
+    ENGINE_CLASS, "isBound",
+    "(Ljava/util/Map;Ljava/lang/Object;Ljava/lang/Object;)Z", static=True)
+
+NO_SOURCE = object()
+'''The source of a name that did not come from a binding'''
+
+class EngineNamespace(LazyBindings):
+    '''The namespace that an engine's scripts share
+
+    Scripts run with the namespace as both globals and locals, so what
+    one script imports, defines or loads is there for the engine's later
+    scripts, as ENGINE_SCOPE bindings are. Before each script, the
+    namespace is refreshed from the bindings: a binding is converted
+    again only if its Java value is not the one that was converted or
+    written back for it last time, and the names of bindings that have
+    been removed are deleted.
+    '''
+    def __init__(self):
+        dict.__init__(self)
+        self.bindings = None
+        self.changed = set()
+        self.pending = set()
+        self.bound = set()
+        self.sources = {}
+        self.scope_names = set()
+        dict.__setitem__(self, "__builtins__", sys.modules[
+            "builtins" if sys.version_info[0] >= 3 else "__builtin__"])
+        for key, value in script_helpers():
+            dict.__setitem__(self, key, value)
+
+    def refresh(self, bindings):
+        '''Prepare the namespace for a script run with the given bindings'''
+        env = J.get_env()
+        jkeys = env.get_object_array_elements(
+            set_to_array_method(map_key_set_method(bindings)))
+        keys = [env.get_string_utf(jkey) for jkey in jkeys]
+        bound = set(keys)
+        for key in list(self.sources.keys()):
+            if key not in bound:
+                #
+                # The binding was removed on the Java side
+                #
+                del self.sources[key]
+                dict.pop(self, key, None)
+        for key in self.bound - bound:
+            self.pending.discard(key)
+        for key, jkey in zip(keys, jkeys):
+            source = self.sources.get(key, NO_SOURCE)
+            if source is NO_SOURCE:
+                #
+                # A new binding, one not used yet or one that hides a
+                # name that a script made: it wins, as it is newer.
+                #
+                dict.pop(self, key, None)
+                self.pending.add(key)
+            elif not is_bound_method(None, bindings, jkey, source):
+                del self.sources[key]
+                dict.pop(self, key, None)
+                self.pending.add(key)
+        for key, value in script_helpers():
+            if key not in bound and not dict.__contains__(self, key):
+                dict.__setitem__(self, key, value)
+        self.bindings = bindings
+        self.bound = bound
+        self.changed = set()
+
+    def load_scopes(self, names):
+        '''Convert the pending bindings that nested scopes may use
+
+        Functions, classes, lambdas and comprehensions look names up in
+        the namespace directly, skipping __missing__, so the bindings
+        that they use must be converted before a script runs. The names
+        are kept, as the functions of earlier scripts still use them.
+
+        :param names: the names from scope_names(), or None to convert
+                      all of the bindings from now on
+        '''
+        if names is None:
+            self.scope_names = None
+        elif self.scope_names is not None:
+            self.scope_names.update(names)
+        if self.scope_names is None:
+            keys = list(self.pending)
+        else:
+            keys = list(self.pending.intersection(self.scope_names))
+        for key in keys:
+            self[key]
+
+    def __missing__(self, key):
+        if key not in self.pending:
+            raise KeyError(key)
+        self.pending.discard(key)
+        source = map_get_method(self.bindings, J.get_env().new_string_utf(key))
+        value = convert_binding(source)
+        dict.__setitem__(self, key, value)
+        self.sources[key] = source
+        return value
+
+    def delta(self):
+        values, removed = LazyBindings.delta(self)
+        env = J.get_env()
+        for key in self.changed:
+            if not dict.__contains__(self, key):
+                self.sources.pop(key, None)
+                self.bound.discard(key)
+                continue
+            jkey = env.new_string_utf(key)
+            value = map_get_method(values, jkey)
+            if value is not None:
+                #
+                # The Java side will bind the value that was written back
+                #
+                self.sources[key] = value
+                self.bound.add(key)
+            elif key in self.bound:
+                #
+                # No Java equivalent, so the binding keeps its old value
+                # and the name keeps the script's value.
+                #
+                self.sources[key] = map_get_method(self.bindings, jkey)
+        return values, removed
+
+engine_local = threading.local()
+
+def engine_locals(bindings):
+    '''Return the current engine's namespace, refreshed from its bindings'''
+    namespace = getattr(engine_local, "namespace", None)
+    if namespace is None:
+        namespace = engine_local.namespace = EngineNamespace()
+    namespace.refresh(bindings)
+    return namespace
+
+def convert_binding(o):
+    '''Convert the value of a binding for use in a script
+    
+    Strings and boxed primitives become their Python equivalents,
+    primitive arrays and direct buffers become numpy arrays, and other
+    objects are wrapped.
+    '''
+    if not isinstance(o, J.JB_Object):
+        return o
+    klass = get_class_method(o)
+    name = J.get_env().get_string_utf(get_name_method(klass))
+    converter = binding_converters.get(name)
+    if converter is None:
+        converter = binding_converters[name] = \
+            make_binding_converter(klass, name)
+    return converter(o)
+
+def make_binding_converter(klass, name):
+    '''Choose the conversion for bindings of a class
+    
+    :param klass: the binding's java.lang.Class
+    :param name: the class's name
+    
+    The choice depends only on the class's name: the classes that get
+    special treatment all come from the bootstrap class loader.
+    '''
+    csig = sig_for_name(name)
+    if csig in PRIMITIVE_ARRAY_TYPES:
+        return PRIMITIVE_ARRAY_TYPES[csig].to_numpy
+    for buffer_type in BUFFER_TYPES:
+        if is_assignable_from_method(
+            jclass(buffer_type.class_name).as_class_object(), klass):
+            return lambda o: buffer_to_numpy(o, buffer_type) \
+                   if buffer_is_direct_method(o) else JWrapper(o)
+    return JWrapper
+
+NOT_CONVERTED = object()
+'''Returned by local_to_java for values that have no Java equivalent'''
+
+def local_to_java(value):
+    '''Convert one of a script's local variables for the bindings
+    
+    Strings, numbers and Java objects are converted as for method
+    arguments. numpy arrays go through the array bridge, flattened:
+    small ones are copied into a primitive Java array and large ones
+    (see get_buffer_threshold) are shared as a direct buffer.
+    
+    returns NOT_CONVERTED if the value has no Java equivalent.
+    '''
+    if value is None or isinstance(value, J.JB_Object):
+        return value
+    elif isinstance(value, JWrapper):
+        return value.o
+    elif isinstance(value, np.generic):
+        value = value.item()
+    elif isinstance(value, np.ndarray):
+        return array_to_java(value)
+    if isinstance(value, (numbers.Integral, float, bytes, type(u""))):
+        return J.get_nice_arg(value, "Ljava/lang/Object;")
+    return NOT_CONVERTED
+
+def array_to_java(a):
+    '''Convert a numpy array to a primitive Java array or a direct buffer
+    
+    returns NOT_CONVERTED if neither has the array's dtype.
+    '''
+    array_type = get_primitive_array_type(a.dtype.newbyteorder("="))
+    if array_type is not None and a.nbytes < get_buffer_threshold():
+        return array_type.to_java(a)
+    for buffer_type in BUFFER_TYPES:
+        if buffer_type.dtype == a.dtype.newbyteorder("="):
+            return numpy_to_buffer(a, buffer_type)
+    if array_type is not None:
+        return array_type.to_java(a)
+    return NOT_CONVERTED
+
+buffer_threshold = None
+
+def get_buffer_threshold():
+    '''The size in bytes from which arrays are shared, not copied
+    
+    Set by the "scijava.cpython.bufferThreshold" system property, by
+    default 1 MB.
+    '''
+    global buffer_threshold
+    if buffer_threshold is None:
+        buffer_threshold = int(get_system_property(
+            "scijava.cpython.bufferThreshold", 1 << 20))
+    return buffer_threshold
+
+binding_converters = {
+    "java.lang.String": lambda o: J.get_env().get_string_utf(o) }
+'''Converters for bindings, keyed by class name'''
+
+for class_name, method, signature in (
+    ("java/lang/Boolean", "booleanValue", "()Z"),
+    ("java/lang/Byte", "byteValue", "()B"),
+    ("java/lang/Integer",  "intValue", "()I"),
+    ("java/lang/Long", "longValue", "()J"),
+    ("java/lang/Float", "floatValue", "()F"),
+    ("java/lang/Double", "doubleValue", "()D")):
+    binding_converters[class_name.replace("/", ".")] = \
+        JMethodID(class_name, method, signature)
+del class_name, method, signature
+
+# java.lang.reflect.Modifier.STATIC
+STATIC = 8
+
+get_class_method = JMethodID(
+    "java/lang/Object", "getClass", "()Ljava/lang/Class;")
+get_name_method = JMethodID(
+    "java/lang/Class", "getName", "()Ljava/lang/String;")
+identity_hash_code_method = JMethodID(
+    "java/lang/System", "identityHashCode", "(Ljava/lang/Object;)I",
+    static=True)
+
+class_info_cache = {}
+class_info_lock = threading.RLock()
+
+def get_class_info(klass):
+    '''Get the reflection metadata for a class, computing it the first time
+    
+    :param klass: a java.lang.Class
+    
+    Classes are identified by name and identity hash code so that
+    same-named classes from different class loaders are kept apart.
+    '''
+    name = J.get_env().get_string_utf(get_name_method(klass))
+    key = (name, identity_hash_code_method(None, klass))
+    info = class_info_cache.get(key)
+    if info is None:
+        with class_info_lock:
+            info = class_info_cache.get(key)
+            if info is None:
+                info = class_info_cache[key] = JavaClassInfo(klass, name)
+    return info
+
+class JavaClassInfo(object):
+    '''The methods and fields of a Java class
+    
+    The tables are built once per class and shared by every JWrapper of
+    an instance of the class and by the class's JClassWrapper.
+    '''
+    def __init__(self, klass, name):
+        '''Reflect on a class
+        
+        :param klass: a java.lang.Class
+        :param name: the class's name
+        '''
+        env = J.get_env()
+        self.klass = klass
+        self.class_wrapper = J.get_class_wrapper(klass, True)
+        self.name = name
+        self.cname = self.name.replace(".", "/")
+        self.methods = {}
+        self.static_methods = {}
+        self.method_docs = {}
+        self.static_method_docs = {}
+        for jmethod in env.get_object_array_elements(
+            self.class_wrapper.getMethods()):
+            name = J.call(jmethod, "getName", "()Ljava/lang/String;")
+            if (J.call(jmethod, "getModifiers", "()I") & STATIC) == STATIC:
+                methods, docs = self.static_methods, self.static_method_docs
+            else:
+                methods, docs = self.methods, self.method_docs
+            methods.setdefault(name, []).append(jmethod)
+            docs.setdefault(name, []).append(J.to_string(jmethod))
+        self.fields = {}
+        self.static_fields = {}
+        for jfield in env.get_object_array_elements(
+            self.class_wrapper.getFields()):
+            if (J.call(jfield, "getModifiers", "()I") & STATIC) == STATIC:
+                fields = self.static_fields
             else:
-                d[key] = JWrapper(o)
+                fields = self.fields
+            name = J.call(jfield, "getName", "()Ljava/lang/String;")
+            fields[name] = sig(
+                J.call(jfield, "getType", "()Ljava/lang/Class;"))
+        self.constructors = None
+        self.overloads = {}
+        self.static_overloads = {}
+        self.call_cache = {}
+        self.static_call_cache = {}
+        self.constructor_call_cache = {}
+        self.proxy_type = None
+        self.class_wrapper_type = None
+        self.class_wrapper_instance = None
+        
+    def get_overloads(self, name, static=False):
+        '''Return the overloads of a method, preparing them the first time
+        
+        :param name: the method's name
+        :param static: True for static methods, False for instance methods
+        '''
+        overloads = self.static_overloads if static else self.overloads
+        result = overloads.get(name)
+        if result is None:
+            methods = self.static_methods if static else self.methods
+            result = overloads[name] = [
+                Overload(jmethod, static) for jmethod in methods[name]]
+        return result
+    
+    def get_constructors(self):
+        '''Return the class's constructors, preparing them the first time'''
+        if self.constructors is None:
+            env = J.get_env()
+            self.constructors = [
+                Overload(jconstructor, constructor=True)
+                for jconstructor in env.get_object_array_elements(
+                    self.class_wrapper.getConstructors())]
+        return self.constructors
+    
+class Overload(object):
+    '''A method or constructor, prepared for calling through JNI
+    
+    The parameter types, JNI signature and method ID are looked up once.
+    '''
+    def __init__(self, jmethod, static=False, constructor=False):
+        '''Prepare a reflected method or constructor
+        
+        :param jmethod: a java.lang.reflect.Method or Constructor
+        :param static: True if the method is static
+        :param constructor: True if jmethod is a constructor
+        '''
+        env = J.get_env()
+        self.params = env.get_object_array_elements(J.call(
+            jmethod, "getParameterTypes", "()[Ljava/lang/Class;"))
+        self.is_var_args = J.call(jmethod, "isVarArgs", "()Z")
+        if constructor:
+            rsig = "V"
         else:
-            d[key] = o
-            
-    return d
+            rsig = sig(J.call(
+                jmethod, "getReturnType", "()Ljava/lang/Class;"))
+        self.sig = "(%s)%s" % ("".join(map(sig, self.params)), rsig)
+        self.method_id = env.from_reflected_method(jmethod, self.sig, static)
+        check_exception(env)
+        self.result_converter = get_result_converter(rsig)
+        
+    def match(self, args):
+        '''Find out how to cast arguments for a call to this overload
+        
+        :param args: the arguments to the call
+        
+        returns a tuple of per-argument casters (see get_caster). Raises
+        TypeError if the arguments don't fit the parameters.
+        '''
+        nparams = len(self.params)
+        if self.is_var_args:
+            if len(args) < nparams - 1:
+                raise TypeError("Too few arguments")
+        elif len(args) != nparams:
+            raise TypeError("Wrong number of arguments")
+        return tuple([get_caster(o, klass) for o, klass in 
+                      zip(self.pack(args), self.params)])
+    
+    def pack(self, args):
+        '''Gather the trailing arguments of a varargs call into a list'''
+        if self.is_var_args:
+            pm1 = len(self.params) - 1
+            return list(args[:pm1]) + [list(args[pm1:])]
+        return args
+    
+    def cast(self, args, casters):
+        '''Cast the arguments to a call using the casters from match()'''
+        return [o if caster is None else caster(o)
+                for o, caster in zip(self.pack(args), casters)]
+    
+def resolve(cache, overloads, name, args):
+    '''Find the overload to call for the given arguments
+    
+    :param cache: a dictionary of previous resolutions, keyed by the method
+                  name and the types of the arguments
+    :param overloads: the Overloads of the method
+    :param name: the method name
+    :param args: the arguments to the call
+    
+    returns the Overload and a list of the cast arguments
+    '''
+    key = get_call_key(name, args)
+    entry = None if key is None else cache.get(key)
+    if entry is None:
+        for overload in overloads:
+            try:
+                entry = (overload, overload.match(args))
+                break
+            except Exception:
+                continue
+        else:
+            raise TypeError("No matching method found for %s" % name)
+        if key is not None:
+            cache[key] = entry
+    overload, casters = entry
+    return overload, overload.cast(args, casters)
 
+def get_call_key(name, args):
+    '''Make a call cache key from a method name and the argument types
+    
+    returns None if an argument's type is not enough to know how it will
+    be cast.
+    '''
+    key = [name]
+    for o in args:
+        k = get_arg_key(o)
+        if k is None:
+            return None
+        key.append(k)
+    return tuple(key)
+
+def get_arg_key(o):
+    '''The part of a call cache key for one argument'''
+    t = type(o)
+    if t is J.JB_Object:
+        return java_class_name(o)
+    if isinstance(o, JWrapper):
+        # the proxy type is specific to the Java class
+        return t
+    if isinstance(o, np.ndarray):
+        return (t, o.dtype.str)
+    if t in (list, tuple):
+        if len(o) == 0:
+            return (t, )
+        k = get_arg_key(o[0])
+        return None if k is None else (t, k)
+    if o is None or np.isscalar(o):
+        return t
+    if isinstance(getattr(o, "o", None), J.JB_Object):
+        return (t, java_class_name(o.o))
+    return None
+
+def java_class_name(o):
+    '''The name of a Java object's class'''
+    return J.get_env().get_string_utf(get_name_method(get_class_method(o)))
+    
 class JWrapper(object):
     '''A class that wraps a Java object
     
@@ -226,63 +1945,73 @@ class JWrapper(object):
     >>> a.add("World")
     >>> a.size()
     2
+    
+    JWrapper(o) returns an instance of a proxy type that is generated
+    once per Java class. The proxy type holds the class's methods, so
+    an instance only holds the wrapped object and any attributes that a
+    script sets on it.
     '''
+    __slots__ = ("o", "__dict__")
+    __info = None
+    
+    def __new__(cls, o):
+        '''Create a wrapper of the proxy type for the object's class'''
+        if cls is JWrapper:
+            info = get_class_info(get_class_method(o))
+            cls = info.proxy_type
+            if cls is None:
+                cls = JWrapper.__make_proxy_type(info)
+        return object.__new__(cls)
+    
     def __init__(self, o):
         '''Initialize the JWrapper with a Java object
         
         :param o: a Java object (class = JB_Object)
         '''
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        self.o = o
-        self.class_wrapper = J.get_class_wrapper(o)
-        env = J.get_env()
-        methods = env.get_object_array_elements(self.class_wrapper.getMethods())
-        self.methods = {}
-        for jmethod in methods:
-            if (J.call(jmethod, "getModifiers", "()I") & STATIC) == STATIC:
-                continue
-            method = J.get_method_wrapper(jmethod)
-            name = method.getName()
-            if name not in self.methods:
-                self.methods[name] = []
-                fn = lambda naame=name: lambda *args: self.__call(naame, *args)
-                fn = fn()
-                fn.__doc__ = J.to_string(jmethod)
-                setattr(self, name, fn)
-            else:
-                fn = getattr(self, name)
-                fn.__doc__ = fn.__doc__ +"\n"+J.to_string(jmethod)
-            self.methods[name].append(method)
-        jfields = self.class_wrapper.getFields()
-        fields = env.get_object_array_elements(jfields)
+        object.__setattr__(self, "o", o)
+        
+    @staticmethod
+    def __make_proxy_type(info):
+        '''Make the proxy type for a Java class
+        
+        :param info: the JavaClassInfo for the class
+        '''
+        def make_method(name, doc):
+            def method(self, *args):
+                return self.__call(name, *args)
+            method.__name__ = str(name)
+            method.__doc__ = doc
+            return method
+        
+        with class_info_lock:
+            if info.proxy_type is None:
+                namespace = { "__slots__": (), "_JWrapper__info": info,
+                              "__doc__": "Wrapper of %s" % info.name }
+                base = collection_wrapper_base(info.klass)
+                for name, docs in info.method_docs.items():
+                    # The base's Python protocol methods, e.g. a map's
+                    # keys(), take precedence over Java methods of the
+                    # same name, e.g. Hashtable.keys()
+                    if not any(name in c.__dict__ for c in base.__mro__):
+                        namespace[name] = make_method(name, "\n".join(docs))
+                info.proxy_type = type(str(info.name), (base, ), namespace)
+            return info.proxy_type
         
     def __getattr__(self, name):
-        try:
-            jfield = self.klass.getField(name)
-        except:
-            raise AttributeError()
-    
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        if (J.call(jfield, "getModifiers", "()I") & STATIC) == STATIC:
-            raise AttributeError()
-        klass = J.call(jfield, "getType", "()Ljava/lang/Class;")
-        result = J.get_field(self.o, name, sig(klass))
+        fields = type(self).__info.fields
+        if name not in fields:
+            raise AttributeError(name)
+        result = J.get_field(self.o, name, fields[name])
         if isinstance(result, J.JB_Object):
             result = JWrapper(result)
         return result
     
     def __setattr__(self, name, value):
-        try:
-            jfield = self.klass.getField(name)
-        except:
+        fields = type(self).__info.fields
+        if name not in fields:
             object.__setattr__(self, name, value)
             return
-    
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        if (J.call(jfield, "getModifiers", "()I") & STATIC) == STATIC:
-            raise AttributeError()
-        klass = J.call(jfield, "getType", "()Ljava/lang/Class;")
-        result = J.set_field(self.o, name, sig(klass), value)
+        J.set_field(self.o, name, fields[name], value)
             
     def __call(self, method_name, *args):
         '''Call the appropriate overloaded method with the given name
@@ -290,40 +2019,24 @@ class JWrapper(object):
         :param method_name: the name of the method to call
         :param *args: the arguments to the method, which are used to
                       disambiguate between similarly named methods
+                      
+        The overload chosen for a set of argument types is remembered,
+        so subsequent calls with the same types go straight to JNI.
         '''
+        info = type(self).__info
+        overload, cargs = resolve(
+            info.call_cache, info.get_overloads(method_name),
+            method_name, args)
         env = J.get_env()
-        last_e = None
-        for method in self.methods[method_name]:
-            params = env.get_object_array_elements(method.getParameterTypes())
-            is_var_args = J.call(method.o, "isVarArgs", "()Z")
-            if len(args) < len(params) - (1 if is_var_args else 0):
-                continue
-            if len(args) > len(params) and not is_var_args:
-                continue
-            if is_var_args:
-                pm1 = len(params)-1
-                args1 = args[:pm1] + [args[pm1:]]
-            else:
-                args1 = args
-            try:
-                cargs = [cast(o, klass) for o, klass in zip(args1, params)]
-            except:
-                last_e = sys.exc_info()[1]
-                continue
-            rtype = J.call(method.o, "getReturnType", "()Ljava/lang/Class;")
-            args_sig = "".join(map(sig, params))
-            rsig = sig(rtype)
-            msig = "(%s)%s" % (args_sig, rsig)
-            result =  J.call(self.o, method_name, msig, *cargs)
-            if isinstance(result, J.JB_Object):
-                result = JWrapper(result)
-            return result
-        raise TypeError("No matching method found for %s" % method_name)
+        result = env.call_method(self.o, overload.method_id, *cargs)
+        check_exception(env)
+        if overload.result_converter is not None:
+            result = overload.result_converter(result)
+        return result
     
     def __repr__(self):
-        classname = J.call(J.call(self.o, "getClass", "()Ljava/lang/Class;"), 
-                           "getName", "()Ljava/lang/String;")
-        return "Instance of %s: %s" % (classname, J.to_string(self.o))
+        return "Instance of %s: %s" % (
+            type(self).__info.name, J.to_string(self.o))
     
     def __str__(self):
         return J.to_string(self.o)
@@ -334,60 +2047,68 @@ class JClassWrapper(object):
     >>> Integer = JClassWrapper("java.lang.Integer")
     >>> Integer.MAX_VALUE
     2147483647
+    
+    There is one JClassWrapper per Java class, an instance of a proxy
+    type that holds the class's static methods.
     '''
+    __slots__ = ("cname", "klass")
+    __info = None
+    
+    def __new__(cls, class_name):
+        '''Return the class wrapper for the named class'''
+        info = get_class_info(J.class_for_name(class_name))
+        with class_info_lock:
+            if info.class_wrapper_instance is None:
+                if info.class_wrapper_type is None:
+                    JClassWrapper.__make_proxy_type(info)
+                info.class_wrapper_instance = \
+                    object.__new__(info.class_wrapper_type)
+            return info.class_wrapper_instance
+        
     def __init__(self, class_name):
         '''Initialize to wrap a class name
         
-        :param class_name: name of class in dotted form, e.g. java.lang.Integer
+        :param class_name: name of class in dotted form, e.g. java.lang.Integer
+        '''
+        info = type(self).__info
+        object.__setattr__(self, "cname", info.cname)
+        object.__setattr__(self, "klass", info.class_wrapper)
+        
+    @staticmethod
+    def __make_proxy_type(info):
+        '''Make the class wrapper's proxy type for a Java class
+        
+        :param info: the JavaClassInfo for the class
         '''
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        self.cname = class_name.replace(".", "/")
-        self.klass = J.get_class_wrapper(J.class_for_name(class_name), True)
-        self.static_methods = {}
-        methods = env.get_object_array_elements(self.klass.getMethods())
-        self.methods = {}
-        for jmethod in methods:
-            if (J.call(jmethod, "getModifiers", "()I") & STATIC) != STATIC:
-                continue
-            method = J.get_method_wrapper(jmethod)
-            name = method.getName()
-            if name not in self.methods:
-                self.methods[name] = []
-                fn = lambda naame=name: lambda *args: self.__call_static(naame, *args)
-                fn = fn()
-                fn.__doc__ = J.to_string(jmethod)
-                setattr(self, name, fn)
-            else:
-                fn = getattr(self, name)
-                fn.__doc__ = fn.__doc__ +"\n"+J.to_string(jmethod)
-            self.methods[name].append(method)
+        def make_method(name, doc):
+            def method(self, *args):
+                return self.__call_static(name, *args)
+            method.__name__ = str(name)
+            method.__doc__ = doc
+            return method
+        
+        namespace = { "__slots__": (), "_JClassWrapper__info": info,
+                      "__doc__": "Wrapper of class %s" % info.name }
+        for name, docs in info.static_method_docs.items():
+            if name not in JClassWrapper.__slots__:
+                namespace[name] = make_method(name, "\n".join(docs))
+        info.class_wrapper_type = type(
+            str(info.name), (JClassWrapper, ), namespace)
         
     def __getattr__(self, name):
-        try:
-            jfield = self.klass.getField(name)
-        except:
-            raise AttributeError("Could not find field %s" % name)
-    
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        if (J.call(jfield, "getModifiers", "()I") & STATIC) != STATIC:
-            raise AttributeError("Field %s is not static" % name)
-        klass = J.call(jfield, "getType", "()Ljava/lang/Class;")
-        result = J.get_static_field(self.cname, name, sig(klass))
+        fields = type(self).__info.static_fields
+        if name not in fields:
+            raise AttributeError("Could not find static field %s" % name)
+        result = J.get_static_field(self.cname, name, fields[name])
         if isinstance(result, J.JB_Object):
             result = JWrapper(result)
         return result
     
     def __setattr__(self, name, value):
-        try:
-            jfield = self.klass.getField(name)
-        except:
+        fields = type(self).__info.static_fields
+        if name not in fields:
             return object.__setattr__(self, name, value)
-
-        STATIC = J.get_static_field("java/lang/reflect/Modifier", "STATIC", "I")
-        if (J.call(jfield, "getModifiers", "()I") & STATIC) != STATIC:
-            raise AttributeError()
-        klass = J.call(jfield, "getType", "()Ljava/lang/Class;")
-        result = J.set_static_field(self.cname, name, sig(klass), value)
+        J.set_static_field(self.cname, name, fields[name], value)
     
     def __call_static(self, method_name, *args):
         '''Call the appropriate overloaded method with the given name
@@ -396,64 +2117,32 @@ class JClassWrapper(object):
         :param *args: the arguments to the method, which are used to
                       disambiguate between similarly named methods
         '''
+        info = type(self).__info
+        overload, cargs = resolve(
+            info.static_call_cache, info.get_overloads(method_name, True),
+            method_name, args)
         env = J.get_env()
-        last_e = None
-        for method in self.methods[method_name]:
-            params = env.get_object_array_elements(method.getParameterTypes())
-            is_var_args = J.call(method.o, "isVarArgs", "()Z")
-            if len(args) < len(params) - (1 if is_var_args else 0):
-                continue
-            if len(args) > len(params) and not is_var_args:
-                continue
-            if is_var_args:
-                pm1 = len(params)-1
-                args1 = args[:pm1] + [args[pm1:]]
-            else:
-                args1 = args
-            try:
-                cargs = [cast(o, klass) for o, klass in zip(args1, params)]
-            except:
-                last_e = sys.exc_info()[1]
-                continue
-            rtype = J.call(method.o, "getReturnType", "()Ljava/lang/Class;")
-            args_sig = "".join(map(sig, params))
-            rsig = sig(rtype)
-            msig = "(%s)%s" % (args_sig, rsig)
-            result =  J.static_call(self.cname, method_name, msig, *cargs)
-            if isinstance(result, J.JB_Object):
-                result = JWrapper(result)
-            return result
-        raise TypeError("No matching method found for %s" % method_name)
+        result = env.call_static_method(
+            jclass(self.cname), overload.method_id, *cargs)
+        check_exception(env)
+        if overload.result_converter is not None:
+            result = overload.result_converter(result)
+        return result
 
     def __call__(self, *args):
         '''Constructors'''
+        info = type(self).__info
+        try:
+            overload, cargs = resolve(
+                info.constructor_call_cache, info.get_constructors(),
+                "<init>", args)
+        except TypeError:
+            raise TypeError("No matching constructor found")
         env = J.get_env()
-        jconstructors = self.klass.getConstructors()
-        for jconstructor in env.get_object_array_elements(jconstructors):
-            constructor = J.get_constructor_wrapper(jconstructor)
-            params = env.get_object_array_elements(
-                constructor.getParameterTypes())
-            is_var_args = J.call(constructor.o, "isVarArgs", "()Z")
-            if len(args) < len(params) - (1 if is_var_args else 0):
-                continue
-            if len(args) > len(params) and not is_var_args:
-                continue
-            if is_var_args:
-                pm1 = len(params)-1
-                args1 = args[:pm1] + [args[pm1:]]
-            else:
-                args1 = args
-            try:
-                cargs = [cast(o, klass) for o, klass in zip(args1, params)]
-            except:
-                last_e = sys.exc_info()[1]
-                continue
-            args_sig = "".join(map(sig, params))
-            msig = "(%s)V" % (args_sig)
-            result =  J.make_instance(self.cname, msig, *cargs)
-            result = JWrapper(result)
-            return result
-        raise TypeError("No matching constructor found")
+        result = env.new_object(
+            jclass(self.cname), overload.method_id, *cargs)
+        check_exception(env)
+        return JWrapper(result)
     
 def importClass(class_name, import_name = None):
     '''Import a wrapped class into the global context
@@ -469,31 +2158,29 @@ def importClass(class_name, import_name = None):
     frame = inspect.currentframe(1)
     frame.f_locals[import_name] = JClassWrapper(class_name)
 
+PRIMITIVE_SIGS = dict(void="V", int="I", byte="B", boolean="Z", long="J",
+                      float="F", double="D", char="C", short="S")
+
+primitive_sigs = frozenset(PRIMITIVE_SIGS.values())
+
+sig_cache = {}
+
 def sig(klass):
     '''Return the JNI signature for a class'''
-    name = J.call(klass, "getName", "()Ljava/lang/String;")
-    if not (J.call(klass, "isPrimitive", "()Z") or 
-            J.call(klass, "isArray", "()Z")):
-        name = "L%s;" % name
-    if name == 'void':
-        return "V"
-    if name == 'int':
-        return "I"
-    if name == 'byte':
-        return "B"
-    if name == 'boolean':
-        return "Z"
-    if name == 'long':
-        return "J"
-    if name == 'float':
-        return "F"
-    if name == 'double':
-        return "D"
-    if name == 'char':
-        return "C"
-    if name == 'short':
-        return "S"
-    return name.replace(".", "/")
+    return sig_for_name(J.get_env().get_string_utf(get_name_method(klass)))
+
+def sig_for_name(name):
+    '''Return the JNI signature for a class, given the class's name'''
+    result = sig_cache.get(name)
+    if result is None:
+        if name in PRIMITIVE_SIGS:
+            result = PRIMITIVE_SIGS[name]
+        elif name.startswith("["):
+            result = name.replace(".", "/")
+        else:
+            result = "L%s;" % name.replace(".", "/")
+        sig_cache[name] = result
+    return result
 
 def cast(o, klass):
     '''Cast the given object to the given class
@@ -503,8 +2190,21 @@ def cast(o, klass):
     
     raises a TypeError if the object can't be cast.
     '''
-    is_primitive = J.call(klass, "isPrimitive", "()Z")
+    caster = get_caster(o, klass)
+    return o if caster is None else caster(o)
+
+def get_caster(o, klass):
+    '''Find out how to cast an object to the given class
+    
+    :param o: either a Python object or Java object to be cast
+    :param klass: a java.lang.Class indicating the target class
+    
+    returns a function that casts o, which can be reused for other objects
+    with the same call cache key (see get_arg_key), or None if o can be
+    passed as-is. Raises a TypeError if the object can't be cast.
+    '''
     csig = sig(klass)
+    is_primitive = csig in primitive_sigs
     if o is None:
         if not is_primitive:
             return None
@@ -513,26 +2213,530 @@ def cast(o, klass):
         
     if isinstance(o, J.JB_Object):
         if J.call(klass, "isInstance", "(Ljava/lang/Object;)Z", o):
-            return o
-        classname = J.run_script("o.getClass().getCanonicalName()", dict(o=o))
-        klassname = J.run_script("klass.getCanonicalName()", dict(klass=klass))
-        raise TypeError("Object of class %s cannot be cast to %s",
-                        classname, klassname)
+            return None
+        raise TypeError("Object of class %s cannot be cast to %s" %
+                        (java_class_name(o), 
+                         J.get_env().get_string_utf(get_name_method(klass))))
     elif hasattr(o, "o"):
-        return cast(o.o, klass)
+        get_caster(o.o, klass)
+        return get_o
+    elif isinstance(o, np.ndarray) and csig in PRIMITIVE_ARRAY_TYPES:
+        return PRIMITIVE_ARRAY_TYPES[csig].to_java
+    elif isinstance(o, np.ndarray) and is_buffer_class(klass):
+        for buffer_type in BUFFER_TYPES:
+            if buffer_type.csig == csig:
+                return lambda o: numpy_to_buffer(o, buffer_type)
+        return numpy_to_buffer
     elif not np.isscalar(o):
         component_type = J.call(klass, "getComponentType", "()Ljava/lang/Class;")
         if component_type is None:
             raise TypeError("Argument must not be a sequence")
         if len(o) > 0:
             # Test if an element can be cast to the array type
-            cast(o[0], component_type)
-        return J.get_nice_arg(o, csig)
-    elif is_primitive or csig in ('Ljava/lang/String;', 'Ljava/lang/Object;'):
-        return J.get_nice_arg(o, csig)
+            get_caster(o[0], component_type)
+        return lambda o: J.get_nice_arg(o, csig)
+    elif is_primitive:
+        # JNI converts Python numbers to primitives
+        return None
+    elif csig == 'Ljava/lang/String;':
+        return to_jstring
+    elif csig == 'Ljava/lang/Object;':
+        return lambda o: J.get_nice_arg(o, csig)
     raise TypeError("Failed to convert argument to %s" % csig)
+
+def get_o(o):
+    '''Unwrap a wrapped Java object'''
+    return o.o
+
+def to_jstring(o):
+    '''Convert a Python string to a Java string'''
+    if isinstance(o, bytes) and not isinstance(o, type(u"")):
+        o = o.decode("utf-8")
+    return J.get_env().new_string_utf(o)
+
+#
+# The conversions are those that J.call() makes (see
+# javabridge.get_nice_result), which wraps Long results rather than
+# unboxing them, with the other objects wrapped as before.
+#
+unbox_methods = {
+    "Ljava/lang/Integer;": JMethodID("java/lang/Integer", "intValue", "()I"),
+    "Ljava/lang/Boolean;": JMethodID(
+        "java/lang/Boolean", "booleanValue", "()Z") }
+
+def get_result_converter(rsig):
+    '''Return a function that converts results of the given JNI type
+    
+    returns None for primitive types, which need no conversion.
+    '''
+    if rsig == 'Ljava/lang/String;':
+        return lambda result: None if result is None else \
+               J.get_env().get_string_utf(result)
+    elif rsig in unbox_methods:
+        unbox = unbox_methods[rsig]
+        return lambda result: None if result is None else unbox(result)
+    elif rsig == '[B':
+        return lambda result: None if result is None else \
+               J.get_env().get_byte_array_elements(result)
+    elif rsig == 'Ljava/lang/Object;':
+        return wrap_object_result
+    elif rsig[0] in 'L[':
+        return wrap_result
+    return None
+
+def wrap_result(result):
+    '''Wrap a Java object returned by a method'''
+    if isinstance(result, J.JB_Object):
+        return JWrapper(result)
+    return result
+
+def wrap_object_result(result):
+    '''Wrap a method's Object result, converting strings'''
+    if result is None:
+        return None
+    env = J.get_env()
+    if env.is_instance_of(result, jclass("java/lang/String")):
+        return env.get_string_utf(result)
+    return JWrapper(result)
+
+#
+# Java collections
+#
+# The wrappers of java.util.List, Map and Collection and of
+# java.lang.Iterable instances implement Python's sequence, mapping and
+# iteration protocols. Elements are fetched a chunk at a time, one JNI
+# call per chunk (see CPythonCollections), instead of one reflective
+# call per element. A chunk of boxed numbers comes over as a primitive
+# array and is read in one copy, and np.asarray() or to_numpy() of a
+# collection of boxed numbers is a numpy array of their type.
+#
+COLLECTIONS_CLASS = "org/scijava/plugins/scripting/cpython/CPythonCollections"
+CHUNK_SIZE = 8192
+
+collection_to_array_method = JMethodID(
+    COLLECTIONS_CLASS, "toArray", "(Ljava/util/Collection;)Ljava/lang/Object;",
+    static=True)
+list_slice_method = JMethodID(
+    COLLECTIONS_CLASS, "slice", "(Ljava/util/List;II)Ljava/lang/Object;",
+    static=True)
+iterator_next_method = JMethodID(
+    COLLECTIONS_CLASS, "next", "(Ljava/util/Iterator;I)Ljava/lang/Object;",
+    static=True)
+map_entries_method = JMethodID(
+    COLLECTIONS_CLASS, "entries", "(Ljava/util/Map;)[Ljava/lang/Object;",
+    static=True)
+iterable_iterator_method = JMethodID(
+    "java/lang/Iterable", "iterator", "()Ljava/util/Iterator;")
+collection_size_method = JMethodID("java/util/Collection", "size", "()I")
+collection_contains_method = JMethodID(
+    "java/util/Collection", "contains", "(Ljava/lang/Object;)Z")
+list_get_method = JMethodID("java/util/List", "get", "(I)Ljava/lang/Object;")
+list_set_method = JMethodID(
+    "java/util/List", "set", "(ILjava/lang/Object;)Ljava/lang/Object;")
+map_size_method = JMethodID("java/util/Map", "size", "()I")
+map_contains_key_method = JMethodID(
+    "java/util/Map", "containsKey", "(Ljava/lang/Object;)Z")
+map_remove_method = JMethodID(
+    "java/util/Map", "remove", "(Ljava/lang/Object;)Ljava/lang/Object;")
+
+def chunk_to_numpy(jchunk):
+    '''Return a chunk as a numpy array or None if it isn't a primitive array'''
+    array_type = PRIMITIVE_ARRAY_TYPES.get(
+        sig_for_name(java_class_name(jchunk)))
+    if array_type is None:
+        return None
+    return array_type.to_numpy(jchunk)
+
+def chunk_to_list(jchunk):
+    '''Convert a chunk of a collection to a list of Python values'''
+    a = chunk_to_numpy(jchunk)
+    if a is not None:
+        return a.tolist()
+    return [convert_binding(o)
+            for o in J.get_env().get_object_array_elements(jchunk)]
+
+def element_to_java(value):
+    '''Convert a value for storage in a Java collection'''
+    result = local_to_java(value)
+    if result is NOT_CONVERTED:
+        raise TypeError("%r has no Java equivalent" % (value, ))
+    return result
+
+class JIterableWrapper(JWrapper):
+    '''A wrapper of a java.lang.Iterable that Python can iterate'''
+    __slots__ = ()
+
+    def __iter__(self):
+        iterator = iterable_iterator_method(self.o)
+        while True:
+            chunk = chunk_to_list(iterator_next_method(
+                None, iterator, CHUNK_SIZE))
+            for element in chunk:
+                yield element
+            if len(chunk) < CHUNK_SIZE:
+                break
+
+class JCollectionWrapper(JIterableWrapper):
+    '''A wrapper of a java.util.Collection
+
+    np.asarray() of the wrapper copies the collection into an array.
+    '''
+    __slots__ = ()
+
+    def __len__(self):
+        return collection_size_method(self.o)
+
+    def __contains__(self, value):
+        return collection_contains_method(self.o, element_to_java(value))
+
+    def __array__(self, dtype=None, copy=None):
+        jchunk = collection_to_array_method(None, self.o)
+        a = chunk_to_numpy(jchunk)
+        if a is None:
+            a = np.array(chunk_to_list(jchunk))
+        return a if dtype is None else a.astype(dtype)
+
+class JListWrapper(JCollectionWrapper):
+    '''A wrapper of a java.util.List that is a Python sequence'''
+    __slots__ = ()
+
+    def __iter__(self):
+        n = len(self)
+        for start in range(0, n, CHUNK_SIZE):
+            for element in chunk_to_list(list_slice_method(
+                None, self.o, start, min(start + CHUNK_SIZE, n))):
+                yield element
+
+    def __getitem__(self, index):
+        n = len(self)
+        if isinstance(index, slice):
+            indices = range(*index.indices(n))
+            if len(indices) == 0:
+                return []
+            lo = min(indices[0], indices[-1])
+            chunk = chunk_to_list(list_slice_method(
+                None, self.o, lo, max(indices[0], indices[-1]) + 1))
+            return [chunk[i - lo] for i in indices]
+        if index < 0:
+            index += n
+        if index < 0 or index >= n:
+            raise IndexError("list index out of range")
+        return convert_binding(list_get_method(self.o, index))
+
+    def __setitem__(self, index, value):
+        n = len(self)
+        if index < 0:
+            index += n
+        if index < 0 or index >= n:
+            raise IndexError("list assignment index out of range")
+        list_set_method(self.o, index, element_to_java(value))
+
+class JMapWrapper(JWrapper):
+    '''A wrapper of a java.util.Map that is a Python mapping
+
+    keys() and items() fetch all of the keys, or keys and values, at once.
+    get() converts the value as indexing does and takes a default.
+    values() is the Java method, which returns a wrapped collection.
+    '''
+    __slots__ = ()
+
+    def __len__(self):
+        return map_size_method(self.o)
+
+    def __getitem__(self, key):
+        jkey = element_to_java(key)
+        value = map_get_method(self.o, jkey)
+        if value is None and not map_contains_key_method(self.o, jkey):
+            raise KeyError(key)
+        return convert_binding(value)
+
+    def get(self, key, default=None):
+        jkey = element_to_java(key)
+        value = map_get_method(self.o, jkey)
+        if value is None and not map_contains_key_method(self.o, jkey):
+            return default
+        return convert_binding(value)
+
+    def __setitem__(self, key, value):
+        map_put_method(self.o, element_to_java(key), element_to_java(value))
+
+    def __delitem__(self, key):
+        jkey = element_to_java(key)
+        if not map_contains_key_method(self.o, jkey):
+            raise KeyError(key)
+        map_remove_method(self.o, jkey)
+
+    def __contains__(self, key):
+        return map_contains_key_method(self.o, element_to_java(key))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return chunk_to_list(
+            collection_to_array_method(None, map_key_set_method(self.o)))
+
+    def items(self):
+        keys, values = J.get_env().get_object_array_elements(
+            map_entries_method(None, self.o))
+        return list(zip(chunk_to_list(keys), chunk_to_list(values)))
+
+COLLECTION_WRAPPERS = (
+    ("java/util/List", JListWrapper),
+    ("java/util/Map", JMapWrapper),
+    ("java/util/Collection", JCollectionWrapper),
+    ("java/lang/Iterable", JIterableWrapper))
+'''The wrapper base classes for collection interfaces, most specific first'''
+
+def collection_wrapper_base(klass):
+    '''Return the base class for the proxy type of a Java class'''
+    for class_name, base in COLLECTION_WRAPPERS:
+        if is_assignable_from_method(
+            jclass(class_name).as_class_object(), klass):
+            return base
+    return JWrapper
+
+#
+# The array bridge
+#
+# Direct java.nio buffers are shared with numpy without copying: a
+# buffer in the bindings becomes a numpy view of the buffer's memory and
+# a numpy array passed for a Buffer parameter is wrapped in a direct
+# buffer. Primitive Java arrays can't be shared, so they are copied in
+# one bulk JNI copy.
+#
+BUFFERS_CLASS = "org/scijava/plugins/scripting/cpython/CPythonBuffers"
+
+class PrimitiveArrayType(object):
+    '''A primitive Java array type and its numpy equivalent'''
+    def __init__(self, csig, dtype_name, suffix):
+        self.csig = csig
+        self.dtype_name = dtype_name
+        self.__dtype = None
+        self.get_elements = "get_%s_array_elements" % suffix
+        self.make_array = "make_%s_array" % suffix
         
+    def to_numpy(self, jarray):
+        '''Copy a Java array into a new numpy array'''
+        return getattr(J.get_env(), self.get_elements)(jarray)
+
+    @property
+    def dtype(self):
+        if self.__dtype is None:
+            self.__dtype = np.dtype(self.dtype_name)
+        return self.__dtype
+    
+    def to_java(self, a):
+        '''Copy a numpy array, flattened, into a new Java array'''
+        a = np.ascontiguousarray(np.ravel(a), self.dtype)
+        return getattr(J.get_env(), self.make_array)(a)
         
+PRIMITIVE_ARRAY_TYPES = dict([(t.csig, t) for t in (
+    PrimitiveArrayType("[Z", "bool", "boolean"),
+    PrimitiveArrayType("[B", "uint8", "byte"),
+    PrimitiveArrayType("[S", "int16", "short"),
+    PrimitiveArrayType("[I", "int32", "int"),
+    PrimitiveArrayType("[J", "int64", "long"),
+    PrimitiveArrayType("[F", "float32", "float"),
+    PrimitiveArrayType("[D", "float64", "double"))])
+
+primitive_array_types_by_dtype = None
+
+def get_primitive_array_type(dtype):
+    '''Return the PrimitiveArrayType for a native-order dtype or None'''
+    global primitive_array_types_by_dtype
+    if primitive_array_types_by_dtype is None:
+        by_dtype = dict([
+            (t.dtype, t) for t in PRIMITIVE_ARRAY_TYPES.values()])
+        by_dtype[np.dtype(np.int8)] = PRIMITIVE_ARRAY_TYPES["[B"]
+        primitive_array_types_by_dtype = by_dtype
+    return primitive_array_types_by_dtype.get(dtype)
+
+class BufferType(object):
+    '''A java.nio buffer type and its numpy equivalent'''
+    def __init__(self, name, dtype_name, view_method):
+        self.class_name = "java/nio/" + name
+        self.csig = "L%s;" % self.class_name
+        self.dtype_name = dtype_name
+        self.__dtype = None
+        self.order = JMethodID(self.class_name, "order", "()Ljava/nio/ByteOrder;")
+        if view_method is None:
+            self.view = None
+        else:
+            self.view = JMethodID("java/nio/ByteBuffer", view_method, 
+                                  "()%s" % self.csig)
+
+    @property
+    def dtype(self):
+        if self.__dtype is None:
+            self.__dtype = np.dtype(self.dtype_name)
+        return self.__dtype
+            
+BUFFER_TYPES = (
+    BufferType("ByteBuffer", "uint8", None),
+    BufferType("CharBuffer", "uint16", "asCharBuffer"),
+    BufferType("ShortBuffer", "int16", "asShortBuffer"),
+    BufferType("IntBuffer", "int32", "asIntBuffer"),
+    BufferType("LongBuffer", "int64", "asLongBuffer"),
+    BufferType("FloatBuffer", "float32", "asFloatBuffer"),
+    BufferType("DoubleBuffer", "float64", "asDoubleBuffer"))
+
+buffer_capacity_method = JMethodID("java/nio/Buffer", "capacity", "()I")
+buffer_is_direct_method = JMethodID("java/nio/Buffer", "isDirect", "()Z")
+buffer_is_read_only_method = JMethodID("java/nio/Buffer", "isReadOnly", "()Z")
+buffer_address_method = JMethodID(
+    BUFFERS_CLASS, "address", "(Ljava/nio/Buffer;)J", static=True)
+buffer_wrap_method = JMethodID(
+    BUFFERS_CLASS, "wrap", "(JJJ)Ljava/nio/ByteBuffer;", static=True)
+buffer_collected_method = JMethodID(
+    BUFFERS_CLASS, "collected", "()[J", static=True)
+allocate_direct_method = JMethodID(
+    "java/nio/ByteBuffer", "allocateDirect", "(I)Ljava/nio/ByteBuffer;",
+    static=True)
+byte_order_name_method = JMethodID(
+    "java/nio/ByteOrder", "toString", "()Ljava/lang/String;")
+
+def get_buffer_type(jbuffer):
+    '''Return the BufferType of a java.nio buffer or None if not a buffer'''
+    env = J.get_env()
+    for buffer_type in BUFFER_TYPES:
+        if env.is_instance_of(jbuffer, jclass(buffer_type.class_name)):
+            return buffer_type
+    return None
+
+class DirectBufferView(object):
+    '''Exposes a direct buffer's memory through the numpy array interface
+    
+    The view holds a reference to the buffer, so the buffer stays alive
+    as long as any numpy array made from the view.
+    '''
+    def __init__(self, jbuffer, address, length, dtype, readonly):
+        self.jbuffer = jbuffer
+        self.__array_interface__ = dict(
+            shape=(length, ), typestr=dtype.str, data=(address, readonly),
+            version=3)
+
+def buffer_to_numpy(jbuffer, buffer_type=None):
+    '''Make a numpy array that shares memory with a direct java.nio buffer
+    
+    :param jbuffer: a direct buffer
+    :param buffer_type: the BufferType of the buffer, if known
+    
+    The array covers the buffer's capacity, so array indices match the
+    buffer's absolute indices.
+    '''
+    if buffer_type is None:
+        buffer_type = get_buffer_type(jbuffer)
+    if not buffer_is_direct_method(jbuffer):
+        raise TypeError("Only direct buffers can be shared with numpy")
+    dtype = buffer_type.dtype
+    if dtype.itemsize > 1:
+        order = J.get_env().get_string_utf(
+            byte_order_name_method(buffer_type.order(jbuffer)))
+        dtype = dtype.newbyteorder(
+            "<" if order == "LITTLE_ENDIAN" else ">")
+    length = buffer_capacity_method(jbuffer)
+    if length == 0:
+        return np.zeros(0, dtype)
+    address = buffer_address_method(None, jbuffer)
+    return np.asarray(DirectBufferView(
+        jbuffer, address, length, dtype, 
+        buffer_is_read_only_method(jbuffer)))
+
+exported_arrays = {}
+exported_arrays_lock = threading.Lock()
+export_tokens = itertools.count()
+
+def release_collected_exports():
+    '''Drop exported arrays whose Java buffers have been garbage collected'''
+    env = J.get_env()
+    tokens = env.get_long_array_elements(buffer_collected_method(None))
+    if len(tokens) > 0:
+        with exported_arrays_lock:
+            for token in tokens:
+                exported_arrays.pop(int(token), None)
+
+def numpy_to_buffer(a, buffer_type=None):
+    '''Make a direct java.nio buffer for a numpy array
+    
+    :param a: a numpy array
+    :param buffer_type: the BufferType to make. By default, the buffer
+                        type matching the array's dtype or a ByteBuffer.
+    
+    If the array is a view of a Java buffer, the buffer is returned.
+    Otherwise, if the array is C-contiguous in native byte order, the buffer
+    shares its memory, else the array is copied once. The array is kept
+    alive until the buffer is garbage collected.
+    '''
+    if buffer_type is None:
+        for buffer_type in BUFFER_TYPES:
+            if buffer_type.dtype == a.dtype:
+                break
+        else:
+            buffer_type = BUFFER_TYPES[0]
+    base = a
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if isinstance(base, DirectBufferView):
+        view = np.asarray(base)
+        if (a.flags.c_contiguous and a.nbytes == view.nbytes and
+            a.ctypes.data == view.ctypes.data and
+            view.dtype == buffer_type.dtype):
+            return base.jbuffer
+    if buffer_type.view is not None:
+        a = np.ascontiguousarray(a, buffer_type.dtype)
+    elif not a.flags.c_contiguous or not a.dtype.isnative:
+        a = np.ascontiguousarray(a, a.dtype.newbyteorder("="))
+    release_collected_exports()
+    if a.nbytes == 0:
+        jbuffer = allocate_direct_method(None, 0)
+    else:
+        token = next(export_tokens)
+        with exported_arrays_lock:
+            exported_arrays[token] = a
+        jbuffer = buffer_wrap_method(None, a.ctypes.data, a.nbytes, token)
+    if buffer_type.view is not None:
+        jbuffer = buffer_type.view(jbuffer)
+    return jbuffer
+
+def to_numpy(o):
+    '''Convert a Java array or direct buffer to a numpy array
+    
+    :param o: a primitive Java array, which is copied, a direct
+              java.nio buffer, which is shared, or a Java collection of
+              boxed numbers, which is copied.
+    '''
+    if isinstance(o, JCollectionWrapper):
+        return o.__array__()
+    if isinstance(o, JWrapper):
+        o = o.o
+    if not isinstance(o, J.JB_Object):
+        return np.asarray(o)
+    result = java_to_numpy(o)
+    if result is None:
+        raise TypeError("%s is not a primitive array or buffer" %
+                        java_class_name(o))
+    return result
+
+def java_to_numpy(o):
+    '''Convert a primitive Java array or a direct buffer to numpy
+    
+    returns None if the object is neither.
+    '''
+    buffer_type = get_buffer_type(o)
+    if buffer_type is not None:
+        if buffer_is_direct_method(o):
+            return buffer_to_numpy(o, buffer_type)
+        return None
+    array_type = PRIMITIVE_ARRAY_TYPES.get(sig_for_name(java_class_name(o)))
+    if array_type is not None:
+        return array_type.to_numpy(o)
+    return None
+
+def is_buffer_class(klass):
+    '''Return True if the class is java.nio.Buffer or a subclass'''
+    return is_assignable_from_method(
+        jclass("java/nio/Buffer").as_class_object(), klass)
 
 def do_execute(payload):
     '''Execute a Python command
@@ -540,31 +2744,852 @@ def do_execute(payload):
     payload: first member is Python command string, second is local context
     '''
     logger.info("Executing script")
+    filename = DEFAULT_FILENAME
     try:
-        command = J.to_string(payload[0])
-        context = context_to_locals(payload[1])
+        command = J.get_env().get_string_utf(payload[0])
+        context = engine_locals(payload[1])
         logger.debug("Script:\n%s" % command)
-        exec(command, __builtins__.__dict__, context)
+        filename = context.get(FILENAME_KEY, DEFAULT_FILENAME)
+        mark(CONTEXT)
+        code = code_cache.get(command, filename, evaluate=False)
+        mark(COMPILE)
+        run_code(code, context)
+        mark(EXEC)
         logger.debug("Script evaluated")
-        return J.run_script(
-            """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-            var payload = new java.util.ArrayList();
-            new CPythonScriptEngine.Message(
-                CPythonScriptEngine.EngineCommands.EXECUTION, payload);
-            """)
+        response = messenger.message("EXECUTION", None, *context.delta())
+        mark(MARSHAL)
+        return response
     except:
         logger.info("Exception caught during execute", exc_info=True)
-        return J.run_script(
-            """importPackage(Packages.org.scijava.plugins.scripting.cpython);
-            var exception = new java.lang.RuntimeException(
-            java.lang.String.format('Python exception: %s', e));
-                var payload = new java.util.ArrayList();
-                payload.add(exception);
-                new CPythonScriptEngine.Message(
-                    CPythonScriptEngine.EngineCommands.EXCEPTION, payload);
-                """, dict(e=repr(sys.exc_info()[1])))
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e,
+                                   filename, error_line_number(e, e_tb, filename))
+
+#
+# Script output
+#
+# sys.stdout and sys.stderr are replaced by EngineStreams, which send
+# what an engine thread's scripts print to the writers of the engine's
+# ScriptContext (see CPythonOutput) and all other output to the original
+# streams. Each engine thread buffers its output and writes it to Java
+# in chunks: when a buffer holds OUTPUT_BUFFER_PROPERTY characters, at
+# each newline if LINE_BUFFERED_PROPERTY is true and when the request is
+# done. The write is synchronous, so a slow writer holds up the script
+# that prints rather than letting the buffer grow.
+#
+OUTPUT_CLASS = "org/scijava/plugins/scripting/cpython/CPythonOutput"
+OUTPUT_BUFFER_PROPERTY = "scijava.cpython.outputBuffer"
+LINE_BUFFERED_PROPERTY = "scijava.cpython.lineBuffered"
+STDOUT, STDERR = 1, 2
+
+output_write_method = JMethodID(
+    OUTPUT_CLASS, "write", "(ILjava/lang/String;)V")
+output_streams_lock = threading.Lock()
+
+class OutputBuffer(object):
+    '''The buffered output of one of an engine's streams'''
+    def __init__(self, joutput, stream, size, line_buffered):
+        '''
+        :param joutput: the engine's CPythonOutput
+        :param stream: STDOUT or STDERR
+        :param size: the number of characters that fill the buffer
+        :param line_buffered: True to write the output at each newline
+        '''
+        self.joutput = joutput
+        self.stream = stream
+        self.size = size
+        self.line_buffered = line_buffered
+        self.chunks = []
+        self.length = 0
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "replace")
+        self.chunks.append(text)
+        self.length += len(text)
+        if self.length >= self.size or (self.line_buffered and "\n" in text):
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered output to Java'''
+        if self.length == 0:
+            return
+        text = u"".join(self.chunks)
+        self.chunks = []
+        self.length = 0
+        output_write_method(
+            self.joutput, self.stream, J.get_env().new_string(text))
+
+class EngineStream(object):
+    '''Stands in for sys.stdout or sys.stderr
+
+    Output on an engine thread that has a CPythonOutput goes to the
+    thread's OutputBuffer, other output to the original stream.
+    '''
+    def __init__(self, name, original):
+        self.name = name
+        self.original = original
+
+    def target(self):
+        output = getattr(engine_local, "output", None)
+        return self.original if output is None else output[self.name]
+
+    def write(self, text):
+        target = self.target()
+        if target is not None:
+            target.write(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        target = self.target()
+        if target is not None:
+            target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+def install_output_streams():
+    '''Replace sys.stdout and sys.stderr with EngineStreams, once'''
+    with output_streams_lock:
+        for name in ("stdout", "stderr"):
+            if not isinstance(getattr(sys, name), EngineStream):
+                setattr(sys, name, EngineStream(name, getattr(sys, name)))
+
+def flush_output():
+    '''Write the current engine thread's buffered output to Java'''
+    output = getattr(engine_local, "output", None)
+    if output is None:
+        return
+    for buffer in output.values():
+        try:
+            buffer.flush()
+        except:
+            logger.warn("Could not write script output", exc_info=True)
+
+def do_set_output(payload):
+    '''Send what the engine's scripts print to a CPythonOutput
+
+    payload: the CPythonOutput or nothing to send the output to the
+             process's streams again
+    '''
+    flush_output()
+    if len(payload) == 0:
+        engine_local.output = None
+    else:
+        install_output_streams()
+        size = int(get_system_property(OUTPUT_BUFFER_PROPERTY, "8192"))
+        line_buffered = get_system_property(
+            LINE_BUFFERED_PROPERTY, "false").lower() == "true"
+        engine_local.output = dict([
+            (name, OutputBuffer(payload[0], stream, size, line_buffered))
+            for name, stream in (("stdout", STDOUT), ("stderr", STDERR))])
+    return messenger.message("EVALUATE_RESULT", None)
+
+#
+# ImgLib2 images
+#
+# An ImgArray presents an ImgLib2 image, e.g. an ImgPlus or a Dataset, as
+# a numpy-compatible array of the image's own pixel type. Nothing is
+# read up front: an index reads just the block that it covers, an
+# assignment writes just that block and tiles() streams the image a tile
+# at a time, so images bigger than the Java heap can be processed.
+# Blocks are copied by CPythonImages into a reusable direct buffer that
+# shares memory with numpy.
+#
+IMAGES_CLASS = "org/scijava/plugins/scripting/cpython/CPythonImages"
+RAI_CLASS = "net/imglib2/RandomAccessibleInterval"
+TILE_BYTES = 16 * 1024 * 1024
+'''The default size of a tile and the size of an ImgArray's scratch buffer'''
+
+image_dtype_method = JMethodID(
+    IMAGES_CLASS, "dtype", "(L%s;)Ljava/lang/String;" % RAI_CLASS,
+    static=True)
+image_read_method = JMethodID(
+    IMAGES_CLASS, "read", "(L%s;[J[JLjava/nio/ByteBuffer;)V" % RAI_CLASS,
+    static=True)
+image_write_method = JMethodID(
+    IMAGES_CLASS, "write", "(L%s;[J[JLjava/nio/ByteBuffer;)V" % RAI_CLASS,
+    static=True)
+num_dimensions_method = JMethodID(
+    "net/imglib2/EuclideanSpace", "numDimensions", "()I")
+interval_min_method = JMethodID("net/imglib2/Interval", "min", "(I)J")
+interval_max_method = JMethodID("net/imglib2/Interval", "max", "(I)J")
+
+def default_tile_shape(shape, itemsize):
+    '''Return the shape of the largest C-order tile of at most TILE_BYTES'''
+    tile = [1] * len(shape)
+    budget = max(1, TILE_BYTES // itemsize)
+    for axis in reversed(range(len(shape))):
+        tile[axis] = max(1, min(shape[axis], budget))
+        if tile[axis] < shape[axis]:
+            break
+        budget //= tile[axis]
+    return tuple(tile)
+
+class ImgArray(object):
+    '''An ImgLib2 image as a lazily read numpy-compatible array
+
+    Axis i of the array is dimension i of the image, starting at the
+    image's minimum. The dtype is that of the pixel type, e.g. uint8 for
+    UnsignedByteType or float32 for FloatType, with int64 or float64 for
+    other integer or real types. Integers, slices and an ellipsis index
+    the image as they do a numpy array:
+
+        a = ImgArray(img)
+        a[0, 100:200, ::2]        # reads just that block
+        a[..., 0] = 1             # writes just that block
+        np.asarray(a)             # reads the whole image
+        for index, tile in a.tiles():
+            a[index] = process(tile)
+    '''
+    def __init__(self, img, tile_shape=None):
+        '''Make an array for an image
+
+        :param img: a net.imglib2.RandomAccessibleInterval
+        :param tile_shape: the default shape for tiles(). By default,
+                           tiles are C-order blocks of about 16 MB.
+        '''
+        if isinstance(img, JWrapper):
+            img = img.o
+        env = J.get_env()
+        if not env.is_instance_of(img, jclass(RAI_CLASS)):
+            raise TypeError("%s is not a RandomAccessibleInterval" %
+                            java_class_name(img))
+        self.o = img
+        ndim = num_dimensions_method(img)
+        self.origin = np.array([interval_min_method(img, d)
+                                for d in range(ndim)], np.int64)
+        self.shape = tuple([
+            int(interval_max_method(img, d) - self.origin[d]) + 1
+            for d in range(ndim)])
+        self.dtype = np.dtype(
+            env.get_string_utf(image_dtype_method(None, img)))
+        if tile_shape is None:
+            tile_shape = default_tile_shape(self.shape, self.dtype.itemsize)
+        elif len(tile_shape) != ndim:
+            raise ValueError("The image has %d dimensions" % ndim)
+        self.tile_shape = tuple(tile_shape)
+        self.__scratch = None
+        self.__jscratch = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "ImgArray(shape=%r, dtype=%s)" % (self.shape, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        a = self.read((0, ) * self.ndim, self.shape)
+        return a if dtype is None else a.astype(dtype)
+
+    def __getitem__(self, index):
+        start, shape, local = self.__select(index)
+        return self.read(start, shape)[local]
+
+    def __setitem__(self, index, value):
+        start, shape, local = self.__select(index)
+        if 0 in shape:
+            return
+        if all([l == 0 or abs(l.step) == 1 for l in local]):
+            block = np.empty(shape, self.dtype)
+        else:
+            block = self.read(start, shape)
+        block[local] = value
+        self.write(start, block)
+
+    def tiles(self, tile_shape=None):
+        '''Iterate over the image a tile at a time
+
+        :param tile_shape: the shape of the tiles, by default tile_shape
+
+        yields the index of each tile, a tuple of slices for writing the
+        tile back, and the tile as a numpy array. The tiles are in C
+        order and the last ones along an axis may be smaller.
+        '''
+        if tile_shape is None:
+            tile_shape = self.tile_shape
+        if 0 in self.shape:
+            return
+        for start in itertools.product(*[
+            range(0, n, t) for n, t in zip(self.shape, tile_shape)]):
+            shape = [min(t, n - s)
+                     for s, t, n in zip(start, tile_shape, self.shape)]
+            index = tuple([slice(s, s + n) for s, n in zip(start, shape)])
+            yield index, self.read(start, shape)
+
+    def read(self, start, shape):
+        '''Read a block of the image
+
+        :param start: the index of the block's first pixel
+        :param shape: the shape of the block
+        '''
+        nbytes = self.dtype.itemsize * int(np.prod(shape))
+        if nbytes == 0:
+            return np.empty(shape, self.dtype)
+        scratch, jscratch = self.__buffer(nbytes)
+        self.__transfer(image_read_method, start, shape, jscratch)
+        block = scratch[:nbytes].view(self.dtype).reshape(shape)
+        return block.copy() if scratch is self.__scratch else block
+
+    def write(self, start, block):
+        '''Write a block of the image
+
+        :param start: the index of the block's first pixel
+        :param block: an array of the block's pixels
+        '''
+        block = np.ascontiguousarray(block, self.dtype)
+        if block.size == 0:
+            return
+        scratch, jscratch = self.__buffer(block.nbytes)
+        scratch[:block.nbytes] = block.reshape(-1).view(np.uint8)
+        self.__transfer(image_write_method, start, block.shape, jscratch)
+
+    def __select(self, index):
+        '''Return the start and shape of the block that an index covers
+
+        The third value returned is the index of the result in the block.
+        '''
+        if not isinstance(index, tuple):
+            index = (index, )
+        ellipses = [i for i, item in enumerate(index) if item is Ellipsis]
+        if len(ellipses) > 1:
+            raise IndexError("An index can only have a single ellipsis")
+        n_missing = self.ndim - len(index) + len(ellipses)
+        if n_missing < 0:
+            raise IndexError("Too many indices for an image with %d dimensions"
+                             % self.ndim)
+        if ellipses:
+            index = (index[:ellipses[0]] + (slice(None), ) * n_missing +
+                     index[ellipses[0] + 1:])
+        else:
+            index += (slice(None), ) * n_missing
+        start, shape, local = [], [], []
+        for item, n in zip(index, self.shape):
+            if isinstance(item, slice):
+                first, stop, step = item.indices(n)
+                items = range(first, stop, step)
+                if len(items) == 0:
+                    start.append(0)
+                    shape.append(0)
+                    local.append(slice(None))
+                    continue
+                start.append(min(items[0], items[-1]))
+                shape.append(abs(items[-1] - items[0]) + 1)
+                local.append(slice(0 if step > 0 else shape[-1] - 1, None, step))
+            elif isinstance(item, numbers.Integral):
+                i = int(item) + n if item < 0 else int(item)
+                if i < 0 or i >= n:
+                    raise IndexError(
+                        "Index %d is out of bounds for an axis of size %d" %
+                        (item, n))
+                start.append(i)
+                shape.append(1)
+                local.append(0)
+            else:
+                raise TypeError(
+                    "ImgArray indices must be integers, slices or an "
+                    "ellipsis, not %s" % type(item).__name__)
+        return start, shape, tuple(local)
+
+    def __buffer(self, nbytes):
+        '''Return a scratch array of at least nbytes and its Java buffer
+
+        Blocks bigger than a tile get a buffer of their own.
+        '''
+        if self.__scratch is not None and len(self.__scratch) >= nbytes:
+            return self.__scratch, self.__jscratch
+        scratch_bytes = max(TILE_BYTES, self.dtype.itemsize *
+                            int(np.prod(self.tile_shape)))
+        scratch = np.empty(max(nbytes, scratch_bytes), np.uint8)
+        jscratch = numpy_to_buffer(scratch, BUFFER_TYPES[0])
+        if nbytes <= scratch_bytes:
+            self.__scratch, self.__jscratch = scratch, jscratch
+        return scratch, jscratch
+
+    def __transfer(self, method, start, shape, jscratch):
+        env = J.get_env()
+        if len(start) != self.ndim or len(shape) != self.ndim:
+            raise ValueError("The image has %d dimensions" % self.ndim)
+        low = self.origin + np.array(start, np.int64)
+        high = low + np.array(shape, np.int64) - 1
+        method(None, self.o, env.make_long_array(low),
+               env.make_long_array(high), jscratch)
+
+#
+# Object references
+#
+# A script's result can stay on the Python side, with Java holding a
+# PyObjectRef: an opaque handle that knows the object's type and, for
+# arrays, its shape and dtype. Java can get the object or items of it
+# on demand and pass the handle back in the bindings of later scripts,
+# where it stands for the object itself. The object is kept until Java
+# closes the handle.
+#
+OBJECT_REF_CLASS = "org/scijava/plugins/scripting/cpython/PyObjectRef"
+
+new_object_ref = JMethodID(
+    OBJECT_REF_CLASS, "<init>", "(JLjava/lang/String;[JLjava/lang/String;)V")
+object_ref_handle_method = JMethodID(OBJECT_REF_CLASS, "getHandle", "()J")
+
+class ObjectRefs(object):
+    '''The Python objects held by PyObjectRefs, by handle'''
+    def __init__(self):
+        self.objects = {}
+        self.handles = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, o):
+        '''Keep an object, returning its new handle'''
+        with self.lock:
+            handle = next(self.handles)
+            self.objects[handle] = o
+        return handle
+
+    def get(self, handle):
+        try:
+            return self.objects[handle]
+        except KeyError:
+            raise ValueError("PyObjectRef %d has been closed" % handle)
+
+    def release(self, handle):
+        with self.lock:
+            self.objects.pop(handle, None)
+
+    def __len__(self):
+        return len(self.objects)
+
+object_refs = ObjectRefs()
+
+def make_object_ref(o):
+    '''Keep a Python object and make a PyObjectRef for it
+
+    The handle of a callable is a PyFunction.
+    '''
+    env = J.get_env()
+    t = type(o)
+    if t.__module__ in ("builtins", "__builtin__"):
+        type_name = t.__name__
+    else:
+        type_name = "%s.%s" % (t.__module__, t.__name__)
+    shape = getattr(o, "shape", None)
+    if isinstance(shape, tuple):
+        shape = env.make_long_array(np.array(shape, np.int64))
+    else:
+        shape = None
+    if callable(o):
+        return new_function_ref.new(
+            object_refs.add(o), env.new_string_utf(type_name))
+    dtype = getattr(o, "dtype", None)
+    if dtype is not None:
+        dtype = env.new_string_utf(str(dtype))
+    return new_object_ref.new(
+        object_refs.add(o), env.new_string_utf(type_name), shape, dtype)
+
+def object_ref_to_python(jref):
+    '''Return the object held by a PyObjectRef'''
+    return object_refs.get(object_ref_handle_method(jref))
+
+binding_converters[OBJECT_REF_CLASS.replace("/", ".")] = object_ref_to_python
+
+#
+# Python functions
+#
+# A callable kept for Java is held by a PyFunction, a PyObjectRef that
+# implements Function, DoubleUnaryOperator and Runnable. Java calls it
+# with CALL requests, which the engine thread handles like scripts. Java
+# code that a script calls runs on the engine thread while the engine
+# waits for it, so the calls it makes can't be queued: they come through
+# _scijava_cpython to call_on_engine_thread instead. A batch call hands
+# the function a whole block of doubles as one numpy array, e.g. a row or
+# tile of an image, instead of making a call per value.
+#
+FUNCTION_CLASS = "org/scijava/plugins/scripting/cpython/PyFunction"
+WORKER_CLASS = "org/scijava/plugins/scripting/cpython/CPythonEngineWorker"
+
+new_function_ref = JMethodID(FUNCTION_CLASS, "<init>", "(JLjava/lang/String;)V")
+engine_adopt_method = JMethodID(
+    ENGINE_CLASS, "adopt", "(L%s;)L%s;" % (OBJECT_REF_CLASS, OBJECT_REF_CLASS))
+worker_serve_method = JMethodID(
+    WORKER_CLASS, "serve", "(Ljava/util/concurrent/BlockingQueue;)V",
+    static=True)
+
+binding_converters[FUNCTION_CLASS.replace("/", ".")] = object_ref_to_python
+
+def export_function(f):
+    '''Make a PyFunction through which Java can call a Python function
+
+    The function runs on this engine's thread, e.g.
+
+        op.setFunction(export_function(lambda a: np.sqrt(a)))
+
+    The PyFunction belongs to the engine, which releases the function
+    when it is closed, if Java hasn't closed the PyFunction before.
+    '''
+    if not callable(f):
+        raise TypeError("%r is not callable" % (f, ))
+    engine = getattr(engine_local, "engine", None)
+    if engine is None:
+        raise ValueError("Only an engine's scripts can export functions")
+    jfunction = make_object_ref(f)
+    engine_adopt_method(engine, jfunction)
+    return JWrapper(jfunction)
+
+def do_call(payload):
+    '''Call a function held by a PyFunction
+
+    payload: first member is the PyFunction, second is a Boolean that is
+             true for a batch call (see call_batch), the rest are the
+             function's arguments, converted as bindings are.
+    '''
+    try:
+        f = object_ref_to_python(payload[0])
+        if convert_binding(payload[1]):
+            result = call_batch(f, payload[2])
+        else:
+            result = f(*[convert_binding(arg) for arg in payload[2:]])
+            converted = local_to_java(result)
+            if converted is not NOT_CONVERTED:
+                result = converted
+        return messenger.message("EVALUATE_RESULT", result)
+    except:
+        logger.info("Exception caught calling a function", exc_info=True)
+        e_type, e, e_tb = sys.exc_info()
+        return messenger.exception("Python exception: %r" % e)
+
+def call_batch(f, jvalues):
+    '''Call a function once with a block of doubles, writing its output back
+
+    :param f: the function, which gets a 1-d float64 array and returns an
+              array of the same length or a scalar, or returns None
+              after changing its argument in place.
+    :param jvalues: a double[], which is copied, or a direct DoubleBuffer,
+                    which is shared.
+
+    returns the output as a new double[] or, for a buffer, None.
+    '''
+    copied = java_class_name(jvalues) == "[D"
+    if copied:
+        a = PRIMITIVE_ARRAY_TYPES["[D"].to_numpy(jvalues)
+    elif get_buffer_type(jvalues) is BUFFER_TYPES[-1]:
+        a = buffer_to_numpy(jvalues, BUFFER_TYPES[-1])
+    else:
+        raise TypeError("A batch call takes a double[] or a DoubleBuffer, "
+                        "not a %s" % java_class_name(jvalues))
+    output = f(a)
+    if output is not None and output is not a:
+        a[...] = output
+    if copied:
+        return PRIMITIVE_ARRAY_TYPES["[D"].to_java(a)
+    return None
+
+def call_on_engine_thread(request, response):
+    '''Handle a request made by Java code running on this engine thread
+
+    :param request: the CALL request, a jobject in a capsule
+    :param response: an Object[] in a capsule, whose first element is set
+                     to the response
+
+    Called by CPythonStartup.call() with the GIL.
+    '''
+    env = J.get_env()
+    request = env.make_jb_object(request)
+    response = env.make_jb_object(response)
+    env.set_object_array_element(
+        response, 0, do_call(messenger.payload(request)))
+
+if native is not None:
+    native.set_call_handler(call_on_engine_thread)
+
+#
+# The process pool
+#
+# If the "scijava.cpython.processes" system property is set to a number
+# of processes, scripts run in a pool of Python worker processes rather
+# than in the engine threads, so CPU-bound scripts on different engines
+# run in parallel instead of taking turns with the GIL.
+#
+# A worker is started with the Python executable given by the
+# "scijava.cpython.executable" system property, which must be the same
+# Python version as the one running in the JVM because compiled scripts
+# are sent to it with marshal. Requests and responses are pickled over
+# the worker's stdin and stdout. numpy arrays of at least
+# get_buffer_threshold() bytes are passed through files in shared memory
+# (/dev/shm where there is one) instead. The process pool is only
+# available on POSIX systems.
+#
+# A script in a worker doesn't run in the engine's persistent namespace:
+# it gets a copy of the names in the namespace that can be pickled, and
+# the names it sets or deletes are copied back. So bindings that can't be
+# pickled, such as Java objects, are not available to it, nor are the
+# modules and functions in the namespace, and the modules it imports and
+# the functions it defines are not kept for the engine's later scripts.
+#
+# The worker processes run the scijava_cpython_worker module, a resource
+# next to this script, which this process loads too for the helpers that
+# it shares with them.
+#
+WORKER_MODULE = "scijava_cpython_worker"
+BOOTSTRAP_CLASS = "org/scijava/plugins/scripting/cpython/CPythonBootstrap"
+read_resource_method = JMethodID(
+    BOOTSTRAP_CLASS, "readResource", "(Ljava/lang/String;)[B", static=True)
+worker_source = None
+worker_module_lock = threading.Lock()
+
+def get_worker_module():
+    '''Return the scijava_cpython_worker module, loading it the first time'''
+    global worker_source
+    with worker_module_lock:
+        module = sys.modules.get(WORKER_MODULE)
+        if module is None:
+            filename = WORKER_MODULE + ".py"
+            data = J.get_env().get_byte_array_elements(
+                read_resource_method(None, to_jstring(filename)))
+            source = bytes(bytearray(data)).decode("utf-8")
+            module = types.ModuleType(WORKER_MODULE)
+            module.__file__ = filename
+            exec(compile(source, filename, "exec"), module.__dict__)
+            sys.modules[WORKER_MODULE] = module
+            worker_source = source
+        return module
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class RemoteScriptError(Exception):
+    '''An exception raised by a script in a worker process'''
+    def __init__(self, description, lineno):
+        Exception.__init__(self, description)
+        self.description = description
+        self.lineno = lineno
+
+    def __repr__(self):
+        return self.description
+
+class ProcessWorker(object):
+    '''A Python worker process
+
+    The worker keeps the compiled scripts it has been sent, so a script
+    is sent to a worker once. The most recently used scripts are kept,
+    as many as the code cache holds.
+    '''
+    def __init__(self, executable):
+        get_worker_module()
+        self.process = subprocess.Popen(
+            [executable, "-c", worker_source,
+             str(get_buffer_threshold()), SHM_DIR],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.alive = True
+        self.codes = collections.OrderedDict()
+        self.tokens = itertools.count()
+        version = self.receive()
+        if tuple(version) != tuple(sys.version_info[:2]):
+            self.close()
+            raise RuntimeError(
+                "Worker process runs Python %d.%d, not %d.%d" %
+                (tuple(version) + tuple(sys.version_info[:2])))
+
+    def send(self, request):
+        try:
+            pickle.dump(request, self.process.stdin, 2)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.alive = False
+            raise RuntimeError("The worker process has stopped")
+
+    def receive(self):
+        try:
+            return pickle.load(self.process.stdout)
+        except EOFError:
+            self.alive = False
+            raise RuntimeError("The worker process has stopped")
+
+    def close(self):
+        '''Stop the worker, which exits once its stdin is closed'''
+        self.alive = False
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+    def run(self, code, context):
+        '''Run compiled code in the worker
+
+        :param code: the CompiledCode to run
+        :param context: the local context of the script. Changes that
+                        the script makes to its locals are applied to it.
+
+        returns the value of the script's trailing expression, if any.
+        '''
+        token = self.codes.pop(code, None)
+        forget = []
+        if token is None:
+            token = next(self.tokens)
+            data = marshal.dumps(tuple(code))
+            maxsize = code_cache.maxsize or CodeCache.DEFAULT_MAXSIZE
+            while len(self.codes) >= maxsize:
+                forget.append(self.codes.popitem(last=False)[1])
+        else:
+            data = None
+        self.codes[code] = token
+        values, arrays = {}, {}
+        try:
+            for name in context_names(context):
+                try:
+                    value = context[name]
+                except KeyError:
+                    continue
+                if isinstance(value, (type, types.FunctionType,
+                                      types.BuiltinFunctionType,
+                                      types.ModuleType)):
+                    continue
+                elif (isinstance(value, np.ndarray) and
+                      not value.dtype.hasobject and
+                      value.nbytes >= get_buffer_threshold()):
+                    arrays[name] = get_worker_module().share_array(
+                        value, SHM_DIR)
+                else:
+                    try:
+                        values[name] = pickle.dumps(value, 2)
+                    except Exception:
+                        logger.debug("Not sending %s to worker process", name)
+            self.send((token, data, forget, values, arrays))
+            response = self.receive()
+        finally:
+            for path, dtype, shape in arrays.values():
+                os.unlink(path)
+        if response[0] == "error":
+            raise RemoteScriptError(*response[1:])
+        values, arrays, deleted = response[1:]
+        result = None
+        for name, data in values.items():
+            value = pickle.loads(data)
+            if name is None:
+                result = value
+            else:
+                context[name] = value
+        for name, (path, dtype, shape) in arrays.items():
+            value = np.memmap(path, dtype, "r+", shape=shape)
+            os.unlink(path)
+            if name is None:
+                result = value
+            else:
+                context[name] = value
+        for name in deleted:
+            try:
+                del context[name]
+            except KeyError:
+                pass
+        return result
+
+def context_names(context):
+    '''Return the names of the locals in a script context'''
+    if isinstance(context, LazyBindings):
+        return context.names()
+    return list(context.keys())
+
+class ProcessPool(object):
+    '''A bounded pool of worker processes, started when first needed'''
+    def __init__(self, size, executable):
+        self.size = size
+        self.executable = executable
+        self.idle = queue.Queue()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def run(self, code, context):
+        '''Run compiled code in a worker, waiting for one if need be'''
+        worker = self.acquire()
+        try:
+            return worker.run(code, context)
+        finally:
+            self.release(worker)
+
+    def acquire(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    start = self.count < self.size
+                    if start:
+                        self.count += 1
+                if start:
+                    try:
+                        return ProcessWorker(self.executable)
+                    except:
+                        self.release(None)
+                        raise
+                worker = self.idle.get()
+            if worker is not None:
+                return worker
+
+    def release(self, worker):
+        if worker is not None and worker.alive:
+            self.idle.put(worker)
+            return
+        #
+        # The worker is gone. Reap its process and wake a waiting thread,
+        # if any, to start a new one.
+        #
+        if worker is not None:
+            worker.close()
+        with self.lock:
+            self.count -= 1
+        self.idle.put(None)
+
+    def close_idle(self):
+        '''Stop the workers that aren't running a script'''
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.close()
+                with self.lock:
+                    self.count -= 1
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    '''Return the ProcessPool or None if scripts run in-process'''
+    global process_pool
+    if process_pool is None:
+        with process_pool_lock:
+            if process_pool is None:
+                size = int(get_system_property("scijava.cpython.processes", 0))
+                if size > 0 and os.name != "posix":
+                    logger.warn("The process pool needs a POSIX system: "
+                                "running scripts in the engine threads")
+                    size = 0
+                if size > 0:
+                    default = sys.executable
+                    if "python" not in os.path.basename(default or ""):
+                        default = "python%d.%d" % sys.version_info[:2]
+                    process_pool = ProcessPool(size, get_system_property(
+                        "scijava.cpython.executable", default))
+                else:
+                    process_pool = False
+    return process_pool or None
 
 logger.info("Running scripting-cpython script")
+resolve_classes([
+    MESSAGE_CLASS, COMMANDS_CLASS, PROFILE_CLASS, ENGINE_CLASS,
+    COLLECTIONS_CLASS, BUFFERS_CLASS, OUTPUT_CLASS, IMAGES_CLASS,
+    OBJECT_REF_CLASS, FUNCTION_CLASS, WORKER_CLASS, BOOTSTRAP_CLASS,
+    RAI_CLASS, "net/imglib2/EuclideanSpace", "net/imglib2/Interval"])
 thread = threading.Thread(target=engine_requester, name="Scripting-CPython Engine Requester")
 thread.setDaemon(True)
 thread.start()
@@ -0,0 +1,75 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.io.File;
+
+import org.openjdk.jmh.results.format.ResultFormatType;
+import org.openjdk.jmh.runner.Runner;
+import org.openjdk.jmh.runner.options.Options;
+import org.openjdk.jmh.runner.options.OptionsBuilder;
+import org.scijava.Context;
+import org.scijava.script.ScriptService;
+
+/**
+ * Runs the JMH benchmarks of the Java side of the bridge and writes the
+ * results as JSON.
+ * <p>
+ * Run from the test classpath, e.g. {@code mvn test-compile exec:java
+ * -Dexec.mainClass=org.scijava.plugins.scripting.cpython.CPythonBenchmarks
+ * -Dexec.classpathScope=test}. The optional argument is the result file,
+ * by default {@code target/benchmarks/jmh-result.json}. The Python side
+ * has its own harness in {@code src/test/python/benchmarks.py}.
+ * </p>
+ */
+public class CPythonBenchmarks {
+
+	private static final String DEFAULT_RESULT = "target/benchmarks/jmh-result.json";
+
+	public static void main(final String[] args) throws Exception {
+		final File result = new File(args.length > 0 ? args[0] : DEFAULT_RESULT);
+		result.getAbsoluteFile().getParentFile().mkdirs();
+		final Options options = new OptionsBuilder()
+			.include(CPythonBenchmarks.class.getPackage().getName() + "\\..*Benchmark\\.")
+			.resultFormat(ResultFormatType.JSON)
+			.result(result.getPath())
+			.build();
+		new Runner(options).run();
+	}
+
+	/**
+	 * Make a CPython script engine for a benchmark
+	 */
+	static CPythonScriptEngine newEngine(final Context context) {
+		return (CPythonScriptEngine) context.service(ScriptService.class)
+			.getLanguageByName("CPython").getScriptEngine();
+	}
+}
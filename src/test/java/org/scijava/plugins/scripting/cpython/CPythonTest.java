@@ -30,12 +30,902 @@
  */
 package org.scijava.plugins.scripting.cpython;
 
+import static org.junit.Assert.assertArrayEquals;
+import static org.junit.Assert.assertEquals;
+import static org.junit.Assert.assertFalse;
+import static org.junit.Assert.assertNull;
+import static org.junit.Assert.assertSame;
+import static org.junit.Assert.assertTrue;
+import static org.junit.Assert.fail;
+
+import java.io.File;
+import java.io.StringWriter;
+import java.nio.ByteBuffer;
+import java.nio.ByteOrder;
+import java.nio.DoubleBuffer;
+import java.nio.IntBuffer;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.Collections;
+import java.util.HashMap;
+import java.util.HashSet;
+import java.util.Hashtable;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+import java.util.concurrent.CompletableFuture;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.TimeUnit;
+
+import javax.script.Bindings;
+import javax.script.CompiledScript;
+import javax.script.ScriptEngine;
+import javax.script.ScriptException;
+import javax.script.SimpleBindings;
+
+import net.imglib2.RandomAccess;
+import net.imglib2.img.Img;
+import net.imglib2.img.array.ArrayImgs;
+import net.imglib2.type.numeric.integer.UnsignedShortType;
+
+import org.junit.AfterClass;
+import org.junit.BeforeClass;
 import org.junit.Test;
+import org.scijava.Context;
+import org.scijava.log.LogService;
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.EngineCommands;
+import org.scijava.plugins.scripting.cpython.CPythonScriptEngine.Message;
+import org.scijava.script.ScriptService;
 
 public class CPythonTest {
 
+	private static Context context;
+
+	@BeforeClass
+	public static void setUp() {
+		context = new Context(ScriptService.class);
+	}
+
+	@AfterClass
+	public static void tearDown() {
+		context.dispose();
+	}
+
+	private static CPythonScriptEngine newEngine() {
+		return (CPythonScriptEngine) context.service(ScriptService.class)
+			.getLanguageByName("CPython").getScriptEngine();
+	}
+
 	@Test
 	public void initializeTest() {
 		CPythonStartup.initializePythonThread("print 'Hello, Lee!'");
 	}
+
+	@Test
+	public void testEvalCompiled() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			final CompiledScript script = engine.compile("x * 2");
+			final Bindings bindings = new SimpleBindings();
+			bindings.put("x", 21);
+			assertEquals(42, ((Number) script.eval(bindings)).intValue());
+			bindings.put("x", 2);
+			assertEquals(4, ((Number) script.eval(bindings)).intValue());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testCompiledScriptErrorLine() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.put(ScriptEngine.FILENAME, "compiled.py");
+			final CompiledScript script = engine.compile("a = 1\nraise ValueError('line 2')\n");
+			try {
+				script.eval(new SimpleBindings());
+				fail("The script should have raised ValueError");
+			} catch (final ScriptException e) {
+				assertEquals("compiled.py", e.getFileName());
+				assertEquals(2, e.getLineNumber());
+			}
+			// An EXECUTE request reports the same
+			final Bindings bindings = new SimpleBindings();
+			bindings.put(ScriptEngine.FILENAME, "executed.py");
+			try {
+				engine.eval(new Message(EngineCommands.EXECUTE,
+					Arrays.asList((Object) "a = 1\nb = 2\nraise ValueError('line 3')\n", bindings)));
+				fail("The script should have raised ValueError");
+			} catch (final ScriptException e) {
+				assertEquals("executed.py", e.getFileName());
+				assertEquals(3, e.getLineNumber());
+			}
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testSyntaxErrorLine() {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.put(ScriptEngine.FILENAME, "syntax.py");
+			engine.compile("a = 1\nb = )\n");
+			fail("The script should not compile");
+		} catch (final ScriptException e) {
+			assertEquals("syntax.py", e.getFileName());
+			assertEquals(2, e.getLineNumber());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testCodeCacheEviction() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// A cache of two scripts, apart from the engine's own
+			final String script =
+				"import __main__\n" +
+				"cache = __main__.CodeCache(2)\n" +
+				"script_id = cache.pin('0', 't')\n" +
+				"for command in ('1', '2', '1', '3', '1', '2'):\n" +
+				"    code = cache.get(command, 't', True)\n" +
+				"cache.get_pinned(script_id)\n" +
+				"info = cache.cache_info()\n" +
+				"'%(hits)d %(misses)d %(size)d %(pinned)d' % info\n";
+			// "2" is evicted by "3", as "1" was used after it
+			assertEquals("2 5 2 1", engine.eval(script));
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testLazyBindings() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			final Set<Object> fetched = new HashSet<Object>();
+			final Bindings bindings = new SimpleBindings() {
+				@Override
+				public Object get(final Object key) {
+					fetched.add(key);
+					return super.get(key);
+				}
+			};
+			bindings.put("used", 41);
+			bindings.put("unused", new Object());
+			final CompiledScript script = engine.compile("used + 1");
+			assertEquals(42, ((Number) script.eval(bindings)).intValue());
+			assertEquals(Collections.singleton("used"), fetched);
+			// A new value is converted again
+			bindings.put("used", 1);
+			assertEquals(2, ((Number) script.eval(bindings)).intValue());
+			assertEquals(Collections.singleton("used"), fetched);
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testLocalsWrittenBack() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			final Bindings bindings = new SimpleBindings();
+			bindings.put("a", 1);
+			bindings.put("b", 2);
+			engine.compile("a = a + 1\ndel b\nc = 'new'\n").eval(bindings);
+			assertEquals(2, ((Number) bindings.get("a")).intValue());
+			assertFalse(bindings.containsKey("b"));
+			assertEquals("new", bindings.get("c"));
+			// EXECUTE writes the changes back too and has no result
+			bindings.put("b", 2);
+			final Message request = new Message(EngineCommands.EXECUTE,
+				Arrays.asList((Object) "a = a * 10\ndel b\n", bindings));
+			assertNull(engine.eval(request));
+			assertEquals(20, ((Number) bindings.get("a")).intValue());
+			assertFalse(bindings.containsKey("b"));
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testEnginePool() throws InterruptedException {
+		// Start Python, which the pool's workers run on
+		newEngine().close();
+		final CPythonEnginePool pool = new CPythonEnginePool(2, 0, 100, TimeUnit.MILLISECONDS, 4, 100);
+		try {
+			final CPythonEngineWorker first = pool.lease();
+			final CPythonEngineWorker second = pool.lease();
+			assertEquals(2, pool.getLeasedCount());
+			try {
+				pool.lease();
+				fail("The pool should have no worker to lease");
+			} catch (final IllegalStateException e) {
+				// All are leased and none was returned in time
+			}
+			pool.release(first);
+			assertSame(first, pool.lease());
+			pool.release(first);
+			pool.release(second);
+			assertEquals(0, pool.getLeasedCount());
+			assertEquals(2, pool.getIdleCount());
+			// None are prewarmed, so all are stopped once idle too long
+			final long deadline = System.nanoTime() + TimeUnit.SECONDS.toNanos(10);
+			while (pool.getSize() > 0 && System.nanoTime() < deadline) {
+				Thread.sleep(10);
+			}
+			assertEquals(0, pool.getIdleCount());
+			assertEquals(0, pool.getSize());
+		} finally {
+			pool.close();
+		}
+	}
+
+	@Test
+	public void testEvalAsync() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.eval("order = []");
+			final List<CompletableFuture<Object>> futures = new ArrayList<CompletableFuture<Object>>();
+			for (int i = 0; i < 40; i++) {
+				// Every fifth script fails, which fails only its own future
+				futures.add(engine.evalAsync(
+					"order.append(" + i + ")\n" + (i % 5 == 4 ? "1 / 0" : i + " * 2") + "\n"));
+			}
+			final StringBuilder expected = new StringBuilder();
+			for (int i = 0; i < futures.size(); i++) {
+				if (i % 5 == 4) {
+					try {
+						futures.get(i).get();
+						fail("Script " + i + " should have raised ZeroDivisionError");
+					} catch (final ExecutionException e) {
+						assertTrue(e.getCause() instanceof ScriptException);
+					}
+				} else {
+					assertEquals(2 * i, ((Number) futures.get(i).get()).intValue());
+				}
+				expected.append(i == 0 ? "" : " ").append(i);
+			}
+			assertEquals(expected.toString(), engine.eval("' '.join(map(str, order))"));
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testStoppedWorkerFailsRequests() throws Exception {
+		newEngine().close();
+		final int depth = 4;
+		final CPythonEnginePool pool = new CPythonEnginePool(1, 0, 60, TimeUnit.SECONDS, depth);
+		try {
+			final CPythonEngineWorker worker = pool.lease();
+			worker.stop();
+			// More requests than the depth: each must give its permit back
+			for (int i = 0; i < 2 * depth; i++) {
+				final CompletableFuture<Message> future = worker.submit(new Message(
+					EngineCommands.EVALUATE, Arrays.asList((Object) "1", new SimpleBindings())));
+				try {
+					future.get();
+					fail("The stopped worker should not answer");
+				} catch (final ExecutionException e) {
+					assertTrue(e.getCause() instanceof IllegalStateException);
+				}
+			}
+			assertTrue(worker.isStopped());
+			assertEquals(0, worker.getInFlightCount());
+			pool.release(worker);
+			assertEquals(0, pool.getSize());
+		} finally {
+			pool.close();
+		}
+	}
+
+	@Test
+	public void testObjectRefs() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		final long objects;
+		final PyObjectRef item;
+		try {
+			final Map<String, Long> before = engine.getReferenceCounts();
+			objects = before.get("object_refs");
+			final PyObjectRef ref = engine.evalRef("{'a': [1, 2, 3], 'b': 'x'}");
+			assertEquals("dict", ref.getTypeName());
+			assertNull(ref.getShape());
+			assertEquals("x", ref.get("'b'"));
+			item = ref.getRef("'a'");
+			assertEquals("list", item.getTypeName());
+			Map<String, Long> counts = engine.getReferenceCounts();
+			assertEquals(objects + 2, (long) counts.get("object_refs"));
+			assertEquals(before.get("open_refs") + 2, (long) counts.get("open_refs"));
+
+			// A handle in the bindings stands for the Python object
+			final Bindings bindings = new SimpleBindings();
+			bindings.put("d", ref);
+			assertEquals(2, ((Number) engine.evalAsync("len(d)", bindings).get()).intValue());
+
+			// The object is kept until the last reference is closed
+			assertSame(ref, ref.retain());
+			ref.close();
+			assertFalse(ref.isClosed());
+			assertEquals(objects + 2, (long) engine.getReferenceCounts().get("object_refs"));
+			ref.close();
+			assertTrue(ref.isClosed());
+			counts = engine.getReferenceCounts();
+			assertEquals(objects + 1, (long) counts.get("object_refs"));
+			assertEquals(before.get("open_refs") + 1, (long) counts.get("open_refs"));
+			try {
+				ref.get();
+				fail("A closed PyObjectRef should not be usable");
+			} catch (final ScriptException e) {
+				// expected
+			}
+			try {
+				ref.retain();
+				fail("A closed PyObjectRef should not be retained");
+			} catch (final IllegalStateException e) {
+				// expected
+			}
+		} finally {
+			engine.close();
+		}
+		// Closing the engine releases the handles left open
+		assertTrue(item.isClosed());
+		final CPythonScriptEngine other = newEngine();
+		try {
+			assertEquals(objects, (long) other.getReferenceCounts().get("object_refs"));
+		} finally {
+			other.close();
+		}
+	}
+
+	@Test
+	public void testCollectionWrappers() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// Hashtable.keys() is a Java method, but the mapping's keys() wins
+			final Hashtable<String, Integer> table = new Hashtable<String, Integer>();
+			table.put("a", 1);
+			table.put("b", 2);
+			engine.put("table", table);
+			assertEquals("a,b", engine.eval("','.join(sorted(table.keys()))"));
+			assertEquals(Boolean.TRUE, engine.eval("sorted(table.items()) == [('a', 1), ('b', 2)]"));
+			assertEquals(Boolean.TRUE, engine.eval("'a' in table and 'c' not in table"));
+			assertEquals(4, ((Number) engine.eval("table['b'] + len(table)")).intValue());
+			// get() converts like indexing and falls back to its default
+			assertEquals(Boolean.TRUE, engine.eval("table.get('a') == 1 and table.get('z') is None"));
+			assertEquals(5, ((Number) engine.eval("table.get('z', 5)")).intValue());
+			assertEquals(3, ((Number) engine.eval("table.get('b', 0) + 1")).intValue());
+
+			// More elements than fit in one chunk
+			final Set<Integer> set = new HashSet<Integer>();
+			long sum = 0;
+			for (int i = 0; i < 20000; i++) {
+				set.add(i);
+				sum += i;
+			}
+			engine.put("s", set);
+			assertEquals(20000, ((Number) engine.eval("len(s)")).intValue());
+			assertEquals(sum, ((Number) engine.eval("sum(s)")).longValue());
+			assertEquals(Boolean.TRUE, engine.eval("len(set(s)) == len(s) and 19999 in s"));
+
+			engine.put("l", new ArrayList<Object>(Arrays.asList(1.5, "x", 3)));
+			assertEquals(Boolean.TRUE, engine.eval("list(l) == [1.5, 'x', 3] and l[1:] == ['x', 3]"));
+			engine.eval("l[2] = 4");
+			assertEquals(4, ((Number) engine.eval("l[-1]")).intValue());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testImgArrayBlocks() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			final Img<UnsignedShortType> img = ArrayImgs.unsignedShorts(6, 4);
+			final RandomAccess<UnsignedShortType> ra = img.randomAccess();
+			for (int x = 0; x < 6; x++) {
+				for (int y = 0; y < 4; y++) {
+					ra.setPosition(new long[] { x, y });
+					ra.get().set(10 * x + y);
+				}
+			}
+			engine.put("img", img);
+			assertEquals(Boolean.TRUE, engine.eval(
+				"import numpy as np\n" +
+				"a = ImgArray(img)\n" +
+				"block = a[1:4, 2:]\n" +
+				"ok = (a.shape == (6, 4) and a.dtype == np.uint16 and\n" +
+				"      block.tolist() == [[12, 13], [22, 23], [32, 33]] and\n" +
+				"      a[5, -1] == 53 and int(np.asarray(a).sum()) == 636)\n" +
+				"a[2:5, 0] = [7, 8, 9]\n" +
+				"a[0, ::3] = 100\n" +
+				"ok\n"));
+			final int[][] expected = { { 7, 2, 0 }, { 8, 3, 0 }, { 9, 4, 0 }, { 21, 2, 1 },
+				{ 100, 0, 0 }, { 1, 0, 1 }, { 100, 0, 3 }, { 53, 5, 3 } };
+			for (final int[] e : expected) {
+				ra.setPosition(new long[] { e[1], e[2] });
+				assertEquals(e[0], ra.get().get());
+			}
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testPyFunctionApply() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		final PyFunction square, add;
+		try {
+			square = engine.evalFunction("lambda a: a * a");
+			final double[] values = { 1, 2, 3 };
+			assertSame(values, square.apply(values));
+			assertArrayEquals(new double[] { 1, 4, 9 }, values, 0);
+			assertEquals(6.25, square.applyAsDouble(2.5), 0);
+
+			// A direct buffer is shared: only the remaining values change
+			final DoubleBuffer buffer = ByteBuffer.allocateDirect(32).order(ByteOrder.nativeOrder()).asDoubleBuffer();
+			buffer.put(new double[] { 1, 2, 3, 4 }).position(1);
+			square.apply(buffer);
+			assertEquals(1, buffer.position());
+			final double[] squared = new double[4];
+			((DoubleBuffer) buffer.duplicate().rewind()).get(squared);
+			assertArrayEquals(new double[] { 1, 4, 9, 16 }, squared, 0);
+
+			// A function that a script exports belongs to the engine
+			engine.eval("def add(a, b):\n    return a + b\n");
+			add = (PyFunction) engine.eval("export_function(add)");
+			assertEquals(5, ((Number) add.call(2, 3)).intValue());
+			assertEquals(2, (long) engine.getReferenceCounts().get("open_refs"));
+		} finally {
+			engine.close();
+		}
+		assertTrue(square.isClosed());
+		assertTrue(add.isClosed());
+	}
+
+	@Test
+	public void testUnclosedEnginesAreCollected() throws Exception {
+		newEngine().close();
+		final CPythonEnginePool pool = new CPythonEnginePool(2, 0, 60, TimeUnit.SECONDS, 4, 100);
+		try {
+			for (int i = 0; i < 3 * pool.getMaxSize(); i++) {
+				// The engines aren't closed, so their threads only come back
+				// to the pool when they are collected
+				final long deadline = System.nanoTime() + TimeUnit.SECONDS.toNanos(10);
+				while (pool.getLeasedCount() == pool.getMaxSize() && System.nanoTime() < deadline) {
+					System.gc();
+					System.runFinalization();
+					Thread.sleep(10);
+				}
+				final ScriptEngine engine = new CPythonScriptEngine(pool);
+				final StringWriter writer = new StringWriter();
+				engine.getContext().setWriter(writer);
+				assertTrue(engine.eval("print('engine %d' % " + i + ")\nexport_function(abs)") instanceof PyFunction);
+				assertEquals("engine " + i + "\n", writer.toString());
+			}
+		} finally {
+			pool.close();
+		}
+	}
+
+	@Test
+	public void testRuntimeSharedByContexts() throws Exception {
+		final int before = CPythonRuntime.getReferenceCount();
+		final Context first = new Context(CPythonService.class);
+		final Context second = new Context(CPythonService.class);
+		final CPythonScriptLanguage language = second.service(CPythonService.class).getLanguage();
+		try {
+			try {
+				final CPythonScriptLanguage other = first.service(CPythonService.class).getLanguage();
+				assertTrue(other.initializePython());
+				assertTrue(language.initializePython());
+				assertEquals(before + 2, CPythonRuntime.getReferenceCount());
+				assertSame(other.getEnginePool(), language.getEnginePool());
+
+				// One interpreter, but each engine has a namespace of its own
+				final ScriptEngine a = other.getScriptEngine();
+				final ScriptEngine b = language.getScriptEngine();
+				try {
+					a.eval("x = 1");
+					b.eval("x = 2");
+					assertEquals(1, ((Number) a.eval("x")).intValue());
+					assertEquals(2, ((Number) b.eval("x")).intValue());
+				} finally {
+					((CPythonScriptEngine) a).close();
+					((CPythonScriptEngine) b).close();
+				}
+			} finally {
+				first.dispose();
+			}
+			// The other context keeps the runtime and its pool
+			assertEquals(before + 1, CPythonRuntime.getReferenceCount());
+			final CPythonScriptEngine engine = (CPythonScriptEngine) language.getScriptEngine();
+			try {
+				assertEquals(2, ((Number) engine.eval("1 + 1")).intValue());
+			} finally {
+				engine.close();
+			}
+		} finally {
+			second.dispose();
+		}
+		assertEquals(before, CPythonRuntime.getReferenceCount());
+		assertNull(language.getEnginePool());
+	}
+
+	@Test
+	public void testWrapperTypes() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.put("a", new ArrayList<Object>());
+			engine.put("b", new ArrayList<Object>(Arrays.asList("x")));
+			engine.put("c", new HashSet<Object>());
+			// One proxy type per Java class
+			assertEquals(Boolean.TRUE, engine.eval("type(a) is type(b) and type(a) is not type(c)"));
+			// A script can still keep its own attributes on a wrapper
+			assertEquals("note", engine.eval("a.note = 'note'\na.note"));
+			assertEquals(Boolean.FALSE, engine.eval("hasattr(b, 'note')"));
+			assertEquals(1, ((Number) engine.eval("b.size()")).intValue());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testOverloadsFromOneCallSite() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.eval(
+				"importClass('java.lang.Math')\n" +
+				"importClass('java.lang.StringBuilder')\n" +
+				"importClass('java.util.ArrayList')\n");
+			// Each call site sees arguments of several types, so an overload
+			// cached for one set of types must not be used for another
+			assertEquals("1a2.57b[]", engine.eval(
+				"sb = StringBuilder()\n" +
+				"for v in (1, 'a', 2.5, 7, 'b', ArrayList()):\n" +
+				"    sb.append(v)\n" +
+				"sb.toString()\n"));
+			// remove(int) takes an index, remove(Object) an element
+			assertEquals(Boolean.TRUE, engine.eval(
+				"l = ArrayList()\n" +
+				"for v in ('a', 'b', 'c'):\n" +
+				"    l.add(v)\n" +
+				"removed = []\n" +
+				"for x in (0, 'c', 0):\n" +
+				"    removed.append(l.remove(x))\n" +
+				"removed == ['a', True, 'b'] and l.size() == 0\n"));
+			// Static overloads: max(int, int) and max(double, double)
+			assertEquals(Boolean.TRUE, engine.eval(
+				"maxes = []\n" +
+				"for x, y in ((1, 2), (1.5, 0.5), (3, 4)):\n" +
+				"    maxes.append(Math.max(x, y))\n" +
+				"maxes == [2, 1.5, 4] and isinstance(maxes[1], float)\n"));
+			try {
+				engine.eval("Math.max('a', 'b')");
+				fail("No overload of max takes strings");
+			} catch (final ScriptException e) {
+				// expected
+			}
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testPrimitiveArrayRoundTrip() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			engine.eval("import numpy as np");
+			final String reverse = "b = a[::-1].copy()\nstr(a.dtype)";
+			engine.put("a", new boolean[] { true, false, false });
+			assertEquals("bool", engine.eval(reverse));
+			assertTrue(Arrays.equals(new boolean[] { false, false, true }, (boolean[]) engine.get("b")));
+			// Java bytes are signed, numpy's uint8 isn't, but the bits survive
+			engine.put("a", new byte[] { -1, 0, 127 });
+			assertEquals("uint8", engine.eval(reverse));
+			assertArrayEquals(new byte[] { 127, 0, -1 }, (byte[]) engine.get("b"));
+			engine.put("a", new short[] { Short.MIN_VALUE, 0, Short.MAX_VALUE });
+			assertEquals("int16", engine.eval(reverse));
+			assertArrayEquals(new short[] { Short.MAX_VALUE, 0, Short.MIN_VALUE }, (short[]) engine.get("b"));
+			engine.put("a", new int[] { Integer.MIN_VALUE, 1, Integer.MAX_VALUE });
+			assertEquals("int32", engine.eval(reverse));
+			assertArrayEquals(new int[] { Integer.MAX_VALUE, 1, Integer.MIN_VALUE }, (int[]) engine.get("b"));
+			engine.put("a", new long[] { Long.MIN_VALUE, 1, Long.MAX_VALUE });
+			assertEquals("int64", engine.eval(reverse));
+			assertArrayEquals(new long[] { Long.MAX_VALUE, 1, Long.MIN_VALUE }, (long[]) engine.get("b"));
+			engine.put("a", new float[] { -1.5f, 0, Float.MAX_VALUE });
+			assertEquals("float32", engine.eval(reverse));
+			assertArrayEquals(new float[] { Float.MAX_VALUE, 0, -1.5f }, (float[]) engine.get("b"), 0);
+			engine.put("a", new double[] { -1.5, Double.NaN, Double.MAX_VALUE });
+			assertEquals("float64", engine.eval(reverse));
+			assertArrayEquals(new double[] { Double.MAX_VALUE, Double.NaN, -1.5 }, (double[]) engine.get("b"), 0);
+
+			// Arrays of more than one dimension are flattened in C order
+			engine.eval("m = np.arange(6, dtype=np.int32).reshape(2, 3).T");
+			assertArrayEquals(new int[] { 0, 3, 1, 4, 2, 5 }, (int[]) engine.get("m"));
+			// A dtype with no Java equivalent isn't written back
+			engine.eval("c = np.zeros(2, np.complex128)");
+			assertNull(engine.get("c"));
+			// Large arrays are shared as direct buffers
+			engine.eval("big = np.ones(300000)");
+			final DoubleBuffer big = (DoubleBuffer) engine.get("big");
+			assertTrue(big.isDirect());
+			assertEquals(300000, big.capacity());
+			assertEquals(1.0, big.get(299999), 0);
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testDirectBuffers() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// The buffer's byte order is respected, native or not
+			for (final ByteOrder order : new ByteOrder[] { ByteOrder.BIG_ENDIAN, ByteOrder.LITTLE_ENDIAN }) {
+				final IntBuffer buffer = ByteBuffer.allocateDirect(16).order(order).asIntBuffer();
+				buffer.put(0, 7).put(1, -2);
+				engine.put("buf", buffer);
+				assertEquals(Boolean.TRUE, engine.eval("buf.shape == (4, ) and buf.tolist() == [7, -2, 0, 0]"));
+				// Shared, not copied: writes show through on the Java side
+				engine.eval("buf[2] = 300");
+				assertEquals(300, buffer.get(2));
+			}
+			final ByteBuffer bytes = ByteBuffer.allocateDirect(4);
+			bytes.put(0, (byte) -1);
+			engine.put("ro", bytes.asReadOnlyBuffer());
+			assertEquals(Boolean.TRUE, engine.eval("ro.dtype.name == 'uint8' and ro[0] == 255 and not ro.flags.writeable"));
+			try {
+				engine.eval("ro[1] = 1");
+				fail("A read-only buffer should not be writable from Python");
+			} catch (final ScriptException e) {
+				// expected
+			}
+			assertEquals(0, bytes.get(1));
+			// A heap buffer can't be shared, so it stays a Java object
+			engine.put("heap", ByteBuffer.allocate(4));
+			assertEquals(Boolean.TRUE, engine.eval("not heap.isDirect() and heap.capacity() == 4"));
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	@SuppressWarnings("deprecation")
+	public void testSharedPoolConstructor() throws Exception {
+		// The static context's language has started Python and the pool
+		newEngine().close();
+		final CPythonScriptEngine engine = new CPythonScriptEngine();
+		try {
+			assertEquals(2, ((Number) engine.eval("1 + 1")).intValue());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testEvalBatch() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			final List<Map<String, Object>> inputs = new ArrayList<Map<String, Object>>();
+			for (final int x : new int[] { 1, 2, 0, 5 }) {
+				inputs.add(Collections.singletonMap("x", (Object) x));
+			}
+			// One evaluation fails, the others still run
+			final List<Object> results = engine.evalBatch("10 // x", inputs);
+			assertEquals(4, results.size());
+			assertEquals(10, ((Number) results.get(0)).intValue());
+			assertEquals(5, ((Number) results.get(1)).intValue());
+			assertTrue(results.get(2) instanceof ScriptException);
+			assertEquals(2, ((Number) results.get(3)).intValue());
+
+			// By column, with the same helpers as eval
+			final Map<String, Object> columns = new HashMap<String, Object>();
+			columns.put("x", new int[] { 1, 2, 3 });
+			columns.put("name", Arrays.asList("a", "b", "c"));
+			assertEquals(Arrays.asList("a", "bb", "ccc"), engine.evalBatch(
+				"name * int(x) if callable(ImgArray) and callable(export_function) else None", columns));
+
+			columns.put("y", Arrays.asList(1, 2));
+			try {
+				engine.evalBatch("x + y", columns);
+				fail("Columns of different lengths should be refused");
+			} catch (final ScriptException e) {
+				assertTrue(e.getMessage().contains("same length"));
+			}
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testStatisticsPerEngine() throws Exception {
+		final CPythonScriptEngine a = newEngine();
+		final CPythonScriptEngine b = newEngine();
+		try {
+			final String thread = "import threading\nthreading.current_thread().name";
+			final String nameA = (String) a.eval(thread);
+			final String nameB = (String) b.eval(thread);
+			assertFalse(nameA.equals(nameB));
+			a.put("na", nameA);
+			a.put("nb", nameB);
+			final String counts = "import __main__\n" +
+				"s = __main__.get_statistics()\n" +
+				"'%d %d' % (s[na]['exec']['count'], s[nb]['exec']['count'])";
+			final String[] before = ((String) a.eval(counts)).split(" ");
+			for (int i = 0; i < 5; i++) {
+				b.eval("1");
+			}
+			final String[] after = ((String) a.eval(counts)).split(" ");
+			// Each engine thread has its own histograms
+			assertEquals(Long.parseLong(before[0]) + 1, Long.parseLong(after[0]));
+			assertEquals(Long.parseLong(before[1]) + 5, Long.parseLong(after[1]));
+			// As does each engine on the Java side: SET_OUTPUT and its evals
+			assertEquals(4, a.getStatistics().getCount(CPythonStatistics.Stage.ROUND_TRIP));
+			assertEquals(7, b.getStatistics().getCount(CPythonStatistics.Stage.ROUND_TRIP));
+		} finally {
+			a.close();
+			b.close();
+		}
+	}
+
+	@Test
+	public void testBootstrapCache() throws Exception {
+		// Start Python and its engine script before running another __main__
+		final CPythonScriptEngine engine = newEngine();
+		final File dir = Files.createTempDirectory("scripting-cpython").toFile();
+		try {
+			final LogService log = context.service(LogService.class);
+			final byte[] script = "bootstrap_runs = globals().get('bootstrap_runs', 0) + 1\n"
+				.getBytes(StandardCharsets.UTF_8);
+			final String runs = "import __main__\n__main__.bootstrap_runs";
+			// The first start compiles the script and caches its bytecode
+			final CPythonBootstrap bootstrap = new CPythonBootstrap(log, dir.getPath());
+			bootstrap.run(script, "bootstrap.py");
+			assertEquals(1, ((Number) engine.eval(runs)).intValue());
+			assertTrue(bootstrap.getTimings().containsKey(CPythonBootstrap.Phase.LOAD_BYTECODE));
+			assertTrue(bootstrap.getTimings().containsKey(CPythonBootstrap.Phase.RUN_SCRIPT));
+			final File[] cached = dir.listFiles();
+			assertEquals(1, cached.length);
+			final byte[] compiled = Files.readAllBytes(cached[0].toPath());
+			// Later starts run the cached bytecode, not the source
+			Files.write(cached[0].toPath(),
+				CPythonStartup.compile("bootstrap_runs = 100\n", "bootstrap.py"));
+			new CPythonBootstrap(log, dir.getPath()).run(script, "bootstrap.py");
+			assertEquals(100, ((Number) engine.eval(runs)).intValue());
+			// Neither a truncated entry nor one that is not code is run...
+			final byte[] truncated = Arrays.copyOf(compiled, compiled.length / 2);
+			assertFalse(CPythonStartup.runCompiled(truncated));
+			assertFalse(CPythonStartup.runCompiled(new byte[] { 'i', 1, 0, 0, 0 }));
+			// ...so the script is compiled again and the entry replaced
+			Files.write(cached[0].toPath(), truncated);
+			new CPythonBootstrap(log, dir.getPath()).run(script, "bootstrap.py");
+			assertEquals(101, ((Number) engine.eval(runs)).intValue());
+			new CPythonBootstrap(log, dir.getPath()).run(script, "bootstrap.py");
+			assertEquals(102, ((Number) engine.eval(runs)).intValue());
+			assertEquals(1, dir.listFiles().length);
+		} finally {
+			engine.close();
+			for (final File file : dir.listFiles()) {
+				file.delete();
+			}
+			dir.delete();
+		}
+	}
+
+	@Test
+	public void testPersistentNamespace() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// What a script imports and assigns is there for the next one
+			engine.eval("import math\nr = 2");
+			assertEquals(4.0, ((Number) engine.eval("math.sqrt(r * 8)")).doubleValue(), 0);
+			// Comprehensions and functions see the bindings that they use...
+			engine.put("x", 3);
+			assertEquals(9, ((Number) engine.eval("sum([v * x for v in range(3)])")).intValue());
+			engine.put("y", 5);
+			engine.eval("def f():\n    return y * 2");
+			assertEquals(10, ((Number) engine.eval("f()")).intValue());
+			// ...including a function from an earlier script after a change
+			engine.put("y", 6);
+			assertEquals(12, ((Number) engine.eval("f()")).intValue());
+			// and one that looks names up dynamically
+			engine.put("w", 7);
+			engine.eval("g = lambda: globals()['w']");
+			engine.put("w", 8);
+			assertEquals(8, ((Number) engine.eval("g()")).intValue());
+			assertEquals(2, ((Number) engine.eval("r")).intValue());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testLocalFramesPopped() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// Only the frame of the request asking is in use
+			final Map<String, Long> before = engine.getReferenceCounts();
+			assertEquals(1, (long) before.get("local_frames"));
+			for (int i = 0; i < 100; i++) {
+				engine.put("i", i);
+				assertEquals("0," + i, engine.eval("','.join([str(j) for j in (0, i)])"));
+			}
+			try {
+				engine.eval("importClass('java.lang.Integer')\nInteger.parseInt('x')");
+				fail("The script should have raised an exception");
+			} catch (final ScriptException e) {
+				// expected
+			}
+			assertEquals(3, ((Number) engine.evalAsync("1 + 2", new SimpleBindings()).get()).intValue());
+			// Each request pushed a frame and popped it again, error or not
+			final Map<String, Long> after = engine.getReferenceCounts();
+			assertEquals(1, (long) after.get("local_frames"));
+			assertTrue(after.get("local_frames_pushed") >= before.get("local_frames_pushed") + 103);
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testProfiling() throws ScriptException {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			assertNull(engine.getLastProfile());
+			// 100 ms in Java, the rest in work()
+			final String script = "import __main__\n" +
+				"sleep = __main__.JMethodID('java/lang/Thread', 'sleep', '(J)V', static=True)\n" +
+				"def work(n):\n" +
+				"    return sum([i * i for i in range(n)])\n" +
+				"for k in range(5):\n" +
+				"    work(20000)\n" +
+				"    sleep(None, 20)\n";
+			for (final CPythonProfile.Mode mode : CPythonProfile.Mode.values()) {
+				engine.setProfileMode(mode);
+				engine.eval(script);
+				final CPythonProfile profile = engine.getLastProfile();
+				assertEquals(mode, profile.getMode());
+				assertTrue(profile.toString(), profile.getJavaNanos() >= 80000000L);
+				assertTrue(profile.toString(), profile.getPythonNanos() > 0);
+				assertTrue(profile.getReport(), profile.getReport().contains("work"));
+				if (mode == CPythonProfile.Mode.SAMPLE) {
+					assertTrue(profile.getSamples() > 0);
+					assertTrue(profile.getReport(), profile.getReport().contains("[java]"));
+				} else {
+					assertEquals(0, profile.getSamples());
+				}
+			}
+			// Requests that aren't profiled leave the last profile alone
+			final CPythonProfile last = engine.getLastProfile();
+			engine.setProfileMode(null);
+			engine.eval("1");
+			assertSame(last, engine.getLastProfile());
+		} finally {
+			engine.close();
+		}
+	}
+
+	@Test
+	public void testNativeRequestChannel() throws Exception {
+		final CPythonScriptEngine engine = newEngine();
+		try {
+			// The engine thread waits for its requests in native code...
+			assertEquals(Boolean.TRUE, engine.eval("import __main__\n__main__.native_requests"));
+			final long before = engine.getStatistics().getCount(CPythonStatistics.Stage.GIL_WAIT);
+			for (int i = 0; i < 10; i++) {
+				// ...so give it time to be waiting when the request comes
+				Thread.sleep(10);
+				engine.put("i", i);
+				assertEquals(2 * i, ((Number) engine.eval("i * 2")).intValue());
+			}
+			// and times how long it took to get the GIL back
+			assertTrue(engine.getStatistics().getCount(CPythonStatistics.Stage.GIL_WAIT) > before);
+		} finally {
+			engine.close();
+		}
+	}
 }
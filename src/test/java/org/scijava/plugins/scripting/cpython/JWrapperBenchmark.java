@@ -0,0 +1,101 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.util.concurrent.TimeUnit;
+
+import javax.script.ScriptException;
+
+import org.openjdk.jmh.annotations.Benchmark;
+import org.openjdk.jmh.annotations.BenchmarkMode;
+import org.openjdk.jmh.annotations.Fork;
+import org.openjdk.jmh.annotations.Measurement;
+import org.openjdk.jmh.annotations.Mode;
+import org.openjdk.jmh.annotations.OperationsPerInvocation;
+import org.openjdk.jmh.annotations.OutputTimeUnit;
+import org.openjdk.jmh.annotations.Scope;
+import org.openjdk.jmh.annotations.Setup;
+import org.openjdk.jmh.annotations.State;
+import org.openjdk.jmh.annotations.TearDown;
+import org.openjdk.jmh.annotations.Warmup;
+import org.scijava.Context;
+import org.scijava.script.ScriptService;
+
+/**
+ * Wrapping Java objects and calling overloaded methods from a script.
+ * Each script loops {@value #LOOPS} times so that the round trip of the
+ * eval is spread over the calls.
+ */
+@State(Scope.Benchmark)
+@BenchmarkMode(Mode.AverageTime)
+@OutputTimeUnit(TimeUnit.NANOSECONDS)
+@Warmup(iterations = 5, time = 1)
+@Measurement(iterations = 10, time = 1)
+@Fork(1)
+public class JWrapperBenchmark {
+
+	private static final int LOOPS = 1000;
+
+	private Context context;
+	private CPythonScriptEngine engine;
+
+	@Setup
+	public void setUp() {
+		context = new Context(ScriptService.class);
+		engine = CPythonBenchmarks.newEngine(context);
+		engine.put("sb", new StringBuilder());
+	}
+
+	@TearDown
+	public void tearDown() {
+		engine.close();
+		context.dispose();
+	}
+
+	@Benchmark
+	@OperationsPerInvocation(LOOPS)
+	public Object construct() throws ScriptException {
+		return engine.eval("for i in range(" + LOOPS + "): JWrapper(sb.o)");
+	}
+
+	@Benchmark
+	@OperationsPerInvocation(LOOPS)
+	public Object overloadedCall() throws ScriptException {
+		return engine.eval("for i in range(" + LOOPS + "): sb.append(i)\nsb.setLength(0)");
+	}
+
+	@Benchmark
+	@OperationsPerInvocation(LOOPS)
+	public Object overloadedStaticCall() throws ScriptException {
+		return engine.eval("importClass('java.lang.Math')\n" +
+			"for i in range(" + LOOPS + "): Math.max(i, 1.5)");
+	}
+}
@@ -0,0 +1,127 @@
+/*
+ * #%L
+ * JSR-223-compliant Python scripting language plugin linking to CPython
+ * %%
+ * Copyright (C) 2014 Board of Regents of the University of
+ * Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ * Institute of Molecular Cell Biology and Genetics.
+ * %%
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ * 
+ * 1. Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ * 
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ * #L%
+ */
+package org.scijava.plugins.scripting.cpython;
+
+import java.io.File;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.concurrent.CompletableFuture;
+
+import org.scijava.Context;
+import org.scijava.script.ScriptService;
+
+/**
+ * Measures how CPU-bound scripts scale with the process pool at 1, 4, 16
+ * and 32 worker processes.
+ * <p>
+ * Each worker count runs in its own JVM, started with
+ * {@code -Dscijava.cpython.processes=N}, which runs N engines side by side
+ * on a pure-Python loop. Run the benchmark from the project's test
+ * classpath, e.g. {@code mvn test-compile exec:java
+ * -Dexec.mainClass=org.scijava.plugins.scripting.cpython.ProcessPoolBenchmark
+ * -Dexec.classpathScope=test}, with {@code scijava.cpython.executable} set
+ * if the Python executable is not on the path as {@code pythonX.Y}.
+ * </p>
+ */
+public class ProcessPoolBenchmark {
+
+	private static final int[] WORKERS = { 1, 4, 16, 32 };
+	private static final int SCRIPTS_PER_ENGINE = 20;
+	private static final String SCRIPT =
+		"total = 0\n" +
+		"for i in range(200000):\n" +
+		"    total += i * i % 7\n" +
+		"total";
+
+	public static void main(final String[] args) throws Exception {
+		if (args.length > 0) {
+			run(Integer.parseInt(args[0]));
+			return;
+		}
+		final String java = System.getProperty("java.home") + File.separator + "bin" + File.separator + "java";
+		for (final int workers : WORKERS) {
+			final List<String> command = new ArrayList<String>();
+			command.add(java);
+			command.add("-Dscijava.cpython.processes=" + workers);
+			command.add("-Dscijava.cpython.poolSize=" + workers);
+			command.add("-Dscijava.cpython.prewarm=" + workers);
+			final String executable = System.getProperty("scijava.cpython.executable");
+			if (executable != null) {
+				command.add("-Dscijava.cpython.executable=" + executable);
+			}
+			command.add("-cp");
+			command.add(System.getProperty("java.class.path"));
+			command.add(ProcessPoolBenchmark.class.getName());
+			command.add(Integer.toString(workers));
+			final Process process = new ProcessBuilder(command).inheritIO().start();
+			if (process.waitFor() != 0) {
+				System.err.println(String.format("Run with %d workers failed", workers));
+			}
+		}
+	}
+
+	private static void run(final int workers) throws Exception {
+		final Context context = new Context(ScriptService.class);
+		try {
+			final CPythonScriptLanguage language = (CPythonScriptLanguage)
+				context.service(ScriptService.class).getLanguageByName("CPython");
+			final List<CPythonScriptEngine> engines = new ArrayList<CPythonScriptEngine>();
+			for (int i = 0; i < workers; i++) {
+				engines.add((CPythonScriptEngine) language.getScriptEngine());
+			}
+			// Start the worker processes and compile the script
+			time(engines, 1);
+			final long nanos = time(engines, SCRIPTS_PER_ENGINE);
+			final int scripts = workers * SCRIPTS_PER_ENGINE;
+			System.out.println(String.format("%2d workers: %6d scripts in %8.3f s, %8.2f scripts/s",
+				workers, scripts, nanos / 1e9, scripts / (nanos / 1e9)));
+			for (final CPythonScriptEngine engine : engines) {
+				engine.close();
+			}
+		} finally {
+			context.dispose();
+		}
+	}
+
+	private static long time(final List<CPythonScriptEngine> engines, final int scriptsPerEngine) throws Exception {
+		final long start = System.nanoTime();
+		final List<CompletableFuture<Object>> futures = new ArrayList<CompletableFuture<Object>>();
+		for (int i = 0; i < scriptsPerEngine; i++) {
+			for (final CPythonScriptEngine engine : engines) {
+				futures.add(engine.evalAsync(SCRIPT));
+			}
+		}
+		for (final CompletableFuture<Object> future : futures) {
+			future.get();
+		}
+		return System.nanoTime() - start;
+	}
+}
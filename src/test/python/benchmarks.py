@@ -0,0 +1,176 @@
+'''benchmarks.py - benchmarks of the Python side of scripting-cpython
+
+scripting-cpython is licensed under the BSD license.  See the
+accompanying file LICENSE for details.
+
+ Copyright (C) 2009 - 2014 Board of Regents of the University of
+ Wisconsin-Madison, Broad Institute of MIT and Harvard, and Max Planck
+ Institute of Molecular Cell Biology and Genetics.
+ All rights reserved.
+
+Times the bridge's hot paths in the bootstrap script without going
+through a script engine: converting bindings, wrapping Java objects,
+calling overloaded methods and moving arrays between numpy and Java.
+The Java side is covered by the JMH benchmarks (CPythonBenchmarks).
+
+Run with the project's classes and dependencies on the class path:
+
+    mvn test-compile dependency:build-classpath -Dmdep.outputFile=cp.txt
+    python src/test/python/benchmarks.py \\
+        --class-path target/classes:$(cat cp.txt)
+
+The results are written as JSON, by default to
+target/benchmarks/python-result.json.
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import javabridge as J
+import numpy as np
+
+ROOT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir))
+BOOTSTRAP = os.path.join(ROOT, "src", "main", "resources", "scripting-cpython.py")
+
+clock = getattr(time, "perf_counter", time.time)
+
+def load_bootstrap():
+    '''Load the bootstrap script as a module'''
+    if sys.version_info[0] >= 3:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location("scripting_cpython", BOOTSTRAP)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    import imp
+    return imp.load_source("scripting_cpython", BOOTSTRAP)
+
+def measure(fn, repeat, min_time=0.2):
+    '''Time a function
+    
+    The function is called in a loop long enough to take min_time
+    seconds, and the loop is timed "repeat" times.
+    
+    returns the seconds per call of each loop.
+    '''
+    loops = 1
+    while True:
+        start = clock()
+        for i in range(loops):
+            fn()
+        elapsed = clock() - start
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    samples = []
+    for i in range(repeat):
+        start = clock()
+        for j in range(loops):
+            fn()
+        samples.append((clock() - start) / loops)
+    return samples
+
+def bindings_benchmarks(m, n_bindings):
+    '''context_to_locals with n bindings, using none or all of them'''
+    jmap = m.new_hash_map_method.new()
+    env = J.get_env()
+    names = []
+    for i in range(n_bindings):
+        name = "b%d" % i
+        names.append(name)
+        value = [env.new_string_utf("binding %d" % i),
+                 J.get_nice_arg(i, "Ljava/lang/Object;"),
+                 J.get_nice_arg(float(i), "Ljava/lang/Object;"),
+                 J.make_instance("java/lang/StringBuilder", "()V")][i % 4]
+        m.map_put_method(jmap, env.new_string_utf(name), value)
+    
+    def use_none():
+        m.context_to_locals(jmap)
+        
+    def use_all():
+        context = m.context_to_locals(jmap)
+        for name in names:
+            context[name]
+    return {"context_to_locals.use_none": use_none,
+            "context_to_locals.use_all": use_all}
+
+def wrapper_benchmarks(m):
+    '''JWrapper construction and overloaded calls'''
+    o = J.make_instance("java/lang/StringBuilder", "()V")
+    sb = m.JWrapper(o)
+    Math = m.JClassWrapper("java.lang.Math")
+    
+    def append():
+        sb.append(1)
+        sb.setLength(0)
+    return {"JWrapper.construct": lambda: m.JWrapper(o),
+            "JWrapper.overloaded_call": append,
+            "JClassWrapper.overloaded_static_call": lambda: Math.max(1, 1.5)}
+
+def array_benchmarks(m, size):
+    '''Moving arrays of a given size in bytes between numpy and Java'''
+    a = np.zeros(size, np.uint8)
+    array_type = m.PRIMITIVE_ARRAY_TYPES["[B"]
+    jarray = array_type.to_java(a)
+    jbuffer = J.static_call("java/nio/ByteBuffer", "allocateDirect",
+                            "(I)Ljava/nio/ByteBuffer;", size)
+    return {"array.to_java": lambda: array_type.to_java(a),
+            "array.to_numpy": lambda: array_type.to_numpy(jarray),
+            "buffer.numpy_to_buffer": lambda: m.numpy_to_buffer(a),
+            "buffer.buffer_to_numpy": lambda: m.buffer_to_numpy(jbuffer)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[2])
+    parser.add_argument("--class-path", required=True,
+                        help="the class path of the project and its dependencies")
+    parser.add_argument("--output", 
+                        default=os.path.join(ROOT, "target", "benchmarks",
+                                             "python-result.json"),
+                        help="the file for the JSON results")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="the number of timed loops per benchmark")
+    args = parser.parse_args()
+    
+    J.start_vm(class_path=args.class_path.split(os.pathsep) + J.JARS,
+               run_headless=True)
+    try:
+        m = load_bootstrap()
+        cases = []
+        for n_bindings in (1, 10, 100):
+            for name, fn in bindings_benchmarks(m, n_bindings).items():
+                cases.append((name, dict(bindings=n_bindings), fn))
+        for name, fn in wrapper_benchmarks(m).items():
+            cases.append((name, {}, fn))
+        for size in (1 << 10, 1 << 20, 100 << 20):
+            for name, fn in array_benchmarks(m, size).items():
+                cases.append((name, dict(size=size), fn))
+        results = []
+        for name, params, fn in cases:
+            samples = measure(fn, args.repeat)
+            mean = sum(samples) / len(samples)
+            results.append(dict(
+                name=name, params=params, unit="s/op", samples=samples,
+                mean=mean, min=min(samples),
+                stdev=(sum([(s - mean) ** 2 for s in samples]) /
+                       len(samples)) ** .5))
+            print("%-40s %-20s %12.3f us" % (
+                name, ",".join(["%s=%s" % kv for kv in params.items()]),
+                mean * 1e6))
+        directory = os.path.dirname(os.path.abspath(args.output))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(args.output, "w") as fd:
+            json.dump(dict(
+                python=platform.python_version(), numpy=np.__version__,
+                timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                benchmarks=results), fd, indent=2)
+    finally:
+        J.kill_vm()
+
+if __name__ == "__main__":
+    main()